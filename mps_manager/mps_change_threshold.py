@@ -2,6 +2,12 @@
 #
 # Script for changing thresholds for MPS analog devices
 #
+# With --batch the thresholds of many devices are changed by a single
+# request, the file has a threshold per line:
+#   <device id or name> <table> <threshold_index> <integrator> <threshold_type> <value>
+# (lines starting with # are ignored). Nothing is changed unless all the
+# devices and thresholds are valid.
+#
 
 import sys
 import argparse
@@ -17,6 +23,36 @@ import socket
 from ctypes import *
 from struct import *
 
+def read_batch(file_name):
+  """
+  Returns the [dev_id, dev_name, t] of the devices in the batch file, in
+  the order they first appear
+  """
+  entries = []
+  devices = {} # device -> entry
+  f = open(file_name)
+  for line_number, line in enumerate(f.readlines()):
+    line = line.strip()
+    if (len(line) == 0 or line.startswith('#')):
+      continue
+
+    fields = line.split()
+    if (len(fields) != 6):
+      print('ERROR: {} line {}: expected 6 fields, got "{}"'.format(file_name, line_number + 1, line))
+      return None
+
+    device = fields[0]
+    if (not device in devices):
+      if (device.isdigit()):
+        devices[device] = [int(device), "None", []]
+      else:
+        devices[device] = [-1, device, []]
+      entries.append(devices[device])
+    devices[device][2].append(fields[1:])
+  f.close()
+
+  return entries
+
 #=== main ==================================================================================
 
 parser = argparse.ArgumentParser(description='change thresholds for analog devices',
@@ -35,6 +71,10 @@ parser.add_argument('-t', nargs=5, action='append',
                          '  idl: no beam thresholds, only t0 available\n')
 
 parser.add_argument('--disable', action='store_true', default=False, help="Disable specified thresholds")
+parser.add_argument('--batch', metavar='file', type=str, default=None,
+                    help='change the thresholds of many devices listed in the file, one\n'+
+                         'threshold per line: <device id or name> <table threshold_index\n'+
+                         'integrator threshold_type value>')
 
 group_list = parser.add_mutually_exclusive_group()
 group_list.add_argument('--device-id', metavar='database device id', type=int, nargs='?', help='database id for the device')
@@ -60,6 +100,31 @@ reason = args.reason[0]
 
 tm = ThresholdManagerClient(host=args.host, port=args.port)
 
+if (args.batch != None):
+  entries = read_batch(args.batch)
+  if (entries == None or len(entries) == 0):
+    print('ERROR: No thresholds in {}'.format(args.batch))
+    exit(1)
+
+  results = tm.change_thresholds_batch(user, reason,
+                                       [[dev_id, dev_name, t, args.disable]
+                                        for dev_id, dev_name, t in entries])
+  if (results == None):
+    exit(3)
+
+  failed = False
+  for [dev_id, dev_name, t], (status, message) in zip(entries, results):
+    device = dev_name if dev_id < 0 else dev_id
+    if (status == int(MpsManagerResponseType.OK.value)):
+      print('{}: OK'.format(device))
+    else:
+      failed = True
+      names = [r.name for r in MpsManagerResponseType if int(r.value) == status]
+      print('{}: {} - {}'.format(device, names[0] if len(names) > 0 else status, message))
+  if (failed):
+    exit(3)
+  exit(0)
+
 if (tm.build_threshold_table(args.t) == False):
   exit(1)
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Script for reading the MpsManager server statistics
+#
+
+import sys
+import argparse
+from tabulate import tabulate
+
+from argparse import RawTextHelpFormatter
+from mps_manager_protocol import *
+from threshold_manager_client import ThresholdManagerClient
+
+phases = ['total', 'queue', 'lock', 'db', 'pv_connect', 'pv_put', 'verify']
+
+def show_latency(stats):
+  print('=== Latency (last {:.0f} seconds)'.format(stats['period']))
+  table = [['Request', 'Phase', 'Count', 'Avg', 'P50', 'P90', 'P99', 'Max']]
+  for request_name in sorted(stats['latency'].keys()):
+    request = stats['latency'][request_name]
+    for phase in phases + sorted([p for p in request.keys() if not p in phases]):
+      if (not phase in request):
+        continue
+      h = request[phase]
+      table.append([request_name, phase, h['count'],
+                    '{:.3f}'.format(h['avg']), '{:.3f}'.format(h['p50']),
+                    '{:.3f}'.format(h['p90']), '{:.3f}'.format(h['p99']),
+                    '{:.3f}'.format(h['max'])])
+  print(tabulate(table, headers='firstrow', tablefmt='simple'))
+
+def show_status(stats):
+  print('=== Replies')
+  table = [['Request', 'Status', 'Count']]
+  for request_name in sorted(stats['status'].keys()):
+    for status, count in sorted(stats['status'][request_name].items()):
+      table.append([request_name, status, count])
+  print(tabulate(table, headers='firstrow', tablefmt='simple'))
+
+def show_histogram(stats, request_name, phase):
+  if (not request_name in stats['latency'] or
+      not phase in stats['latency'][request_name]):
+    print('No {} latency for {} requests'.format(phase, request_name))
+    return
+
+  print('=== {} {} latency histogram'.format(request_name, phase))
+  table = [['Up to (s)', 'Count']]
+  for bound, count in zip(stats['bounds'], stats['latency'][request_name][phase]['buckets']):
+    if (count > 0):
+      table.append(['{:.3f}'.format(bound), count])
+  print(tabulate(table, headers='firstrow', tablefmt='simple'))
+
+def show_restores(stats):
+  r = stats['restores']
+  print('=== Restores by application (time-to-connect, retried={})'.format(r['retried']))
+  table = [['App', 'Restores', 'Failed', 'Attempts', 'Connect last', 'Avg', 'Max']]
+  for app_id in sorted(r['applications'].keys(), key=int):
+    a = r['applications'][app_id]
+    table.append([app_id, a['restores'], a['failures'], a['attempts'],
+                  '{:.3f}'.format(a['connect_last']), '{:.3f}'.format(a['connect_avg']),
+                  '{:.3f}'.format(a['connect_max'])])
+  print(tabulate(table, headers='firstrow', tablefmt='simple'))
+
+def show_server(stats):
+  print('=== Server')
+  table = []
+  for name in ['reader', 'writer']:
+    p = stats['pools'][name]
+    table.append(['{} pool'.format(name.capitalize()),
+                  'workers={} active={} queued={} completed={} rejected={}'.\
+                    format(p['workers'], p['active'], p['depth'], p['completed'], p['rejected'])])
+  c = stats['connections']
+  table.append(['Connections', 'idle={} busy={} pipelined={}'.\
+                  format(c['idle'], c['busy'], c['pipelined'])])
+  l = stats['locks']
+  table.append(['Locks', 'keys={} read timeouts={} write timeouts={}'.\
+                  format(l['keys'], l['read']['timeouts'], l['write']['timeouts'])])
+  hb = stats['heartbeat']
+  table.append(['Heartbeat', 'jitter={:.3f}s max={:.3f}s skipped={}'.\
+                  format(hb['jitter'], hb['max_jitter'], hb['skipped'])])
+  print(tabulate(table, tablefmt='simple'))
+
+#=== main ==================================================================================
+
+parser = argparse.ArgumentParser(description='read the MpsManager server statistics',
+                                 formatter_class=RawTextHelpFormatter)
+parser.add_argument('--reset', action='store_true', default=False, dest='reset',
+                    help='Reset the latency/reply statistics after reading them')
+parser.add_argument('--restores', action='store_true', default=False, dest='restores',
+                    help='Print the restores and time-to-connect of each application')
+parser.add_argument('--histogram', metavar=('REQUEST', 'PHASE'), type=str, nargs=2,
+                    help='Print the histogram for a request type and phase (e.g. RESTORE_APP_THRESHOLDS total)')
+
+parser.add_argument('--port', metavar='port', type=int, default=1975, nargs='?', help='server port (default=1975)')
+parser.add_argument('--host', metavar='host', type=str, default='lcls-daemon2', nargs='?', help='server port (default=lcls-daemon2)')
+
+args = parser.parse_args()
+
+tm = ThresholdManagerClient(host=args.host, port=args.port)
+stats = tm.get_stats(args.reset)
+
+if (args.histogram):
+  show_histogram(stats, args.histogram[0].upper(), args.histogram[1].lower())
+elif (args.restores):
+  show_restores(stats)
+else:
+  show_server(stats)
+  show_latency(stats)
+  show_status(stats)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import socket
+import select
 import sys
 import os
 import errno
@@ -14,10 +15,20 @@ from mps_config import MPSConfig, runtime, models
 from mps_manager_protocol import *
 from runtime import *
 from sqlalchemy import func
+import epics
 from epics import PV
 
-from threshold_manager import ThresholdManager
+from threshold_manager import ThresholdManager, ThresholdChangeBatch
 from threshold_restorer import ThresholdRestorer
+from worker_pool import WorkerPool
+from request_server import RequestServer
+from rw_lock import LockManager
+from timer_thread import TimerThread
+from request_stats import RequestStats, RequestTiming
+from restore_coordinator import RestoreCoordinator
+from restore_plan import RestorePlanCache
+from pv_cache import PVCache
+from restore_policy import RestorePolicy, RestorePolicies, load_restore_policies
 from ctypes import *
 import threading
 from threading import Thread, Lock
@@ -28,6 +39,15 @@ def signal_hander(sig, frame):
 
 signal.signal(signal.SIGINT, signal_hander)
 
+def enum_name(enum_class, value, default='UNKNOWN'):
+    """
+    Returns the name of the enum_class member with the given int value
+    """
+    for member in enum_class:
+        if (int(member.value) == value):
+            return member.name
+    return default
+
 class DatabaseReader():
     def __init__(self, db_file_name, rt_file_name):
         self.mps = MPSConfig(db_file_name, rt_file_name)
@@ -39,50 +59,365 @@ class DatabaseReader():
         self.session.close()
         self.rt_session.close()
 
-class ReaderThread(threading.Thread):
-    def __init__(self, mps_manager, message, conn, ip, port, check_only=False):
-        threading.Thread.__init__(self)
+class DatabaseReaderPool():
+    """
+    Keeps DatabaseReaders (config/runtime sessions and MpsName) open between
+    requests, so the databases are not opened again for every request.
+
+    On checkin() the sessions are rolled back, which ends their transaction
+    and expires all loaded objects - the next user reloads them from the
+    database and sees the changes committed by the writers in the meantime.
+    Readers older than max_age seconds are discarded, and all readers are
+    discarded if the config database file is replaced/modified.
+    """
+    def __init__(self, db_file_name, rt_file_name, max_idle=10, max_age=600):
+        self.db_file_name = db_file_name
+        self.rt_file_name = rt_file_name
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.lock = Lock()
+        self.idle = [] # [[dbr, creation time, generation], ...]
+        self.generation = 0
+        self.db_mtime = self.get_db_mtime()
+        self.created = 0
+        self.checkouts = 0
+
+    def get_db_mtime(self):
+        try:
+            return os.path.getmtime(self.db_file_name)
+        except OSError:
+            return None
+
+    def checkout(self):
+        db_mtime = self.get_db_mtime()
+        self.lock.acquire()
+        if (db_mtime != self.db_mtime):
+            self.db_mtime = db_mtime
+            self.generation += 1
+            self.idle = []
+        self.checkouts += 1
+        item = None
+        if (len(self.idle) > 0):
+            item = self.idle.pop()
+        generation = self.generation
+        self.lock.release()
+
+        if (item == None):
+            dbr = DatabaseReader(self.db_file_name, self.rt_file_name)
+            dbr.pool_info = [time.time(), generation]
+            self.lock.acquire()
+            self.created += 1
+            self.lock.release()
+        else:
+            dbr = item
+
+        return dbr
+
+    def checkin(self, dbr):
+        try:
+            dbr.session.rollback()
+            dbr.rt_session.rollback()
+        except Exception:
+            return # Discard readers that can't be reset
+
+        created, generation = dbr.pool_info
+        self.lock.acquire()
+        if (generation == self.generation and
+            time.time() - created < self.max_age and
+            len(self.idle) < self.max_idle):
+            self.idle.append(dbr)
+        self.lock.release()
+
+    def prune(self):
+        """
+        Drops the idle readers that are too old or were opened before the
+        config database changed, called periodically by the housekeeping
+        """
+        db_mtime = self.get_db_mtime()
+        now = time.time()
+        self.lock.acquire()
+        if (db_mtime != self.db_mtime):
+            self.db_mtime = db_mtime
+            self.generation += 1
+        self.idle = [dbr for dbr in self.idle
+                     if dbr.pool_info[1] == self.generation and
+                     now - dbr.pool_info[0] < self.max_age]
+        self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        stats = {'idle': len(self.idle),
+                 'created': self.created,
+                 'checkouts': self.checkouts}
+        self.lock.release()
+        return stats
+
+class ReaderTask():
+    """
+    Request that only reads from the database (device check, get threshold
+    and restore), executed by one of the reader pool workers
+    """
+    def __init__(self, mps_manager, message, conn, ip, port, timing, check_only=False,
+                 progress=None):
         self.mps_manager = mps_manager
         self.message = message
         self.conn = conn
         self.ip = ip
         self.port = port
+        self.timing = timing
         self.check_only = check_only
-        self.dbr = DatabaseReader(self.mps_manager.db_file_name, self.mps_manager.rt_file_name)
-        
+        self.progress = progress # RestoreProgress if the client asked for it
+        self.submitted = time.time()
+
     def run(self):
         self.mps_manager.log_string('Reader [START]')
-        self.mps_manager.db_reader_start()
-        # Process request
-        if (self.check_only):
-            self.mps_manager.check_device_request(self.conn, self.dbr,
-                                                  self.message.request_device_id,
-                                                  self.message.request_device_name)
-        elif (self.message.request_type == int(MpsManagerRequestType.GET_THRESHOLD.value)):
-            self.mps_manager.get_threshold(self.dbr, self.message, self.conn, self.ip, self.port)
-        else: # The message.request_device_id contains the app_id
-            self.mps_manager.restore(self.conn, self.dbr, self.message.request_device_id)
-        self.mps_manager.db_reader_end()
+        self.mps_manager.begin_request(self.timing, self.submitted)
+        self.dbr = self.mps_manager.db_pool.checkout()
+        self.timing.stop('db')
+        done = False
+        deferred = False
+        try:
+            # Process request
+            if (self.check_only):
+                self.mps_manager.check_device_request(self.conn, self.dbr,
+                                                      self.message.request_device_id,
+                                                      self.message.request_device_name)
+            elif (self.message.request_type == int(MpsManagerRequestType.GET_THRESHOLD.value)):
+                self.mps_manager.get_threshold(self.dbr, self.message, self.conn, self.ip, self.port)
+            else: # The message.request_device_id contains the app_id
+                # The PV part of the restore continues in the RestoreCoordinator,
+                # the request is completed later by finish_restore()
+                deferred = self.mps_manager.restore(self.conn, self.dbr,
+                                                    self.message.request_device_id, self)
+            self.mps_manager.past_readers += 1
+            done = True
+        finally:
+            if (deferred):
+                self.mps_manager.suspend_request()
+            else:
+                self.finish(done)
         self.mps_manager.log_string('Reader [END]')
-    
-class WriterThread(threading.Thread):
-    def __init__(self, mps_manager, message, conn, ip, port):
-        threading.Thread.__init__(self)
+
+    def finish_restore(self, tr, lock_set, job):
+        """
+        Called on the restore pool when the RestoreCoordinator is done with
+        the PVs: verifies, releases the IOC and replies
+        """
+        self.mps_manager.resume_request(self.timing)
+        done = False
+        try:
+            try:
+                self.mps_manager.restore_reply(self.conn, tr, job.ok,
+                                               self.message.request_device_id, self.progress)
+                self.mps_manager.restore_policies.record(self.message.request_device_id,
+                                                         self.timing.status == MpsManagerResponseType.OK.name,
+                                                         job.attempt, job.connect_time)
+            finally:
+                tr.close()
+                self.mps_manager.unlock(lock_set)
+            done = True
+        finally:
+            self.finish(done)
+
+    def finish(self, done):
+        if (self.progress != None):
+            self.progress.finish()
+        self.mps_manager.db_pool.checkin(self.dbr)
+        self.mps_manager.request_done(self.conn, done)
+        self.mps_manager.end_request(self.timing)
+
+    def reject(self):
+        self.timing.status = MpsManagerResponseType.BUSY.name
+        if (self.progress != None):
+            self.progress.finish()
+        self.mps_manager.send_busy(self.conn, self.message.request_device_id,
+                                   'request queue full')
+        self.mps_manager.request_done(self.conn)
+        self.mps_manager.stats.record(self.timing)
+
+class WriterTask():
+    """
+    Threshold change request (single device or batch), executed by one of
+    the writer pool workers
+    """
+    def __init__(self, mps_manager, message, conn, ip, port, timing):
         self.mps_manager = mps_manager
         self.message = message
         self.conn = conn
         self.ip = ip
         self.port = port
-        self.dbr = DatabaseReader(self.mps_manager.db_file_name, self.mps_manager.rt_file_name)
-        
+        self.timing = timing
+        self.submitted = time.time()
+
     def run(self):
         self.mps_manager.log_string('Writer [START]')
-        self.mps_manager.db_write_lock.acquire()
-        self.mps_manager.change_threshold(self.dbr, self.message, self.conn, self.ip, self.port)
-        self.mps_manager.past_writers += 1
-        self.mps_manager.db_write_lock.release()
+        self.mps_manager.begin_request(self.timing, self.submitted)
+        self.dbr = self.mps_manager.db_pool.checkout()
+        self.timing.stop('db')
+        done = False
+        try:
+            if (self.message.request_type == int(MpsManagerRequestType.CHANGE_THRESHOLD_BATCH.value)):
+                done = self.mps_manager.change_threshold_batch(self.dbr, self.message, self.conn)
+            else:
+                self.mps_manager.change_threshold(self.dbr, self.message, self.conn, self.ip, self.port)
+                done = True
+            self.mps_manager.past_writers += 1
+        finally:
+            self.mps_manager.db_pool.checkin(self.dbr)
+            self.mps_manager.request_done(self.conn, done)
+            self.mps_manager.end_request(self.timing)
         self.mps_manager.log_string('Writer [END]')
 
+    def reject(self):
+        self.timing.status = MpsManagerResponseType.BUSY.name
+        self.mps_manager.send_busy(self.conn, self.message.request_device_id,
+                                   'request queue full')
+        self.mps_manager.request_done(self.conn)
+        self.mps_manager.stats.record(self.timing)
+
+class TaggedChannel():
+    """
+    Used in place of the socket by the request handlers when processing a
+    tagged request: reads come from the data received with the request and
+    writes are collected and sent as a single MpsManagerTaggedResponse
+    """
+    def __init__(self, server, conn, request_id, data):
+        self.server = server
+        self.conn = conn
+        self.request_id = request_id
+        self.data = data
+        self.reply = ''
+
+    def recv(self, size):
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
+
+    def send(self, data):
+        self.reply += data
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def finish(self, keep_alive=True):
+        response = MpsManagerTaggedResponse(self.request_id, self.reply)
+        self.server.reply(self.conn, response.pack(), keep_alive)
+
+class RestoreProgress():
+    """
+    Sends the progress of a restore to a client that asked for it (PROGRESS
+    request flag) as MpsManagerProgressResponse frames: when a phase ends
+    and at most every interval seconds while it progresses. For the phases
+    without intermediate progress (queued, lock, verify, release)
+    keep_alive() repeats the phase every interval seconds from a timer
+    thread, so the client can tell a long phase from a dead server.
+
+    Frames are only written as far as the socket buffer has room, without
+    waiting: the rest of a frame is sent with the next one or by finish()
+    (called by the worker before the final reply), and new frames are
+    dropped while one is pending. So a client that stopped reading can't
+    stall the RestoreCoordinator thread.
+    """
+    def __init__(self, conn, app_id, received, interval=1.0):
+        self.conn = conn
+        self.app_id = app_id
+        self.received = received
+        self.interval = interval
+        self.lock = Lock()
+        self.last_sent = 0.0
+        self.last_phase = None
+        self.pending = '' # part of a frame not sent yet
+        self.closed = False # no more frames after the final reply
+        self.ticker = None # Event stopping the keep_alive() thread
+
+    def update(self, phase, done, total, message='', final=False):
+        """
+        Reports done of total items of the phase, final when the phase ends
+        """
+        self.lock.acquire()
+        try:
+            self.stop_keep_alive()
+            self.send(phase, done, total, message, final)
+        finally:
+            self.lock.release()
+
+    def keep_alive(self, phase, total):
+        """
+        Reports the phase now and every interval seconds until the next
+        update() or finish()
+        """
+        self.lock.acquire()
+        try:
+            self.stop_keep_alive()
+            self.send(phase, 0, total, final=True)
+            ticker = threading.Event()
+            self.ticker = ticker
+        finally:
+            self.lock.release()
+
+        def run():
+            while (not ticker.wait(self.interval)):
+                self.lock.acquire()
+                try:
+                    if (not ticker.is_set()):
+                        self.send(phase, 0, total, 'in progress', final=True)
+                finally:
+                    self.lock.release()
+
+        thread = Thread(target=run, name='Progress-{}'.format(self.app_id))
+        thread.daemon = True
+        thread.start()
+
+    def stop_keep_alive(self):
+        if (self.ticker != None):
+            self.ticker.set()
+            self.ticker = None
+
+    def send(self, phase, done, total, message='', final=False):
+        """
+        Writes a frame without blocking, called with the lock held
+        """
+        now = time.time()
+        if (self.closed or
+            (not final and phase == self.last_phase and now - self.last_sent < self.interval)):
+            return
+
+        if (len(self.pending) == 0):
+            self.last_sent = now
+            self.last_phase = phase
+            self.pending = MpsManagerProgressResponse(self.app_id, phase, done, total,
+                                                      now - self.received, message[:160]).pack()
+        try:
+            readable, writable, errors = select.select([], [self.conn], [], 0)
+            if (len(writable) > 0):
+                self.pending = self.pending[self.conn.send(self.pending):]
+        except (socket.error, select.error) as e:
+            if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                self.closed = True # The final reply reports the closed connection
+
+    def finish(self):
+        """
+        Stops the frames and sends the rest of a pending one, so the final
+        reply can follow. Blocks like the final reply (bound by the request
+        timeout).
+        """
+        self.lock.acquire()
+        try:
+            self.stop_keep_alive()
+            if (not self.closed and len(self.pending) > 0):
+                try:
+                    self.conn.sendall(self.pending)
+                except socket.error:
+                    pass
+            self.pending = ''
+            self.closed = True
+        finally:
+            self.lock.release()
+
 class MpsManager: 
   session = 0
   host = 'lcls-dev3'
@@ -98,9 +433,28 @@ class MpsManager:
   past_readers = 0
   past_writers = 0
   hb_pv = None
+  hb_jitter_pv = None
   hb_count = 0
+  hb_interval = 5
+  stats_interval = 160
+  housekeeping_interval = 60
+  max_batch = 1000 # entries in a CHANGE_THRESHOLD_BATCH request
+
+  # Order in which queued requests are served (lower first). Restores gate
+  # MPS_EN after an IOC reboot, they go ahead of threshold changes and
+  # of the display reads/device checks, which are the first to be dropped
+  # when the queues are full.
+  request_priority = {int(MpsManagerRequestType.RESTORE_APP_THRESHOLDS.value): 0,
+                      int(MpsManagerRequestType.CHANGE_THRESHOLD.value): 1,
+                      int(MpsManagerRequestType.CHANGE_THRESHOLD_BATCH.value): 1,
+                      int(MpsManagerRequestType.DEVICE_CHECK.value): 2,
+                      int(MpsManagerRequestType.GET_THRESHOLD.value): 3}
 
-  def __init__(self, host, port, log_file_name, db_file_name, hb_pv_name, stdout):
+  def __init__(self, host, port, log_file_name, db_file_name, hb_pv_name, stdout,
+               num_readers=8, num_writers=4, request_timeout=60, lock_timeout=30,
+               idle_timeout=60, max_requests=100, max_queued=256, hb_jitter_pv_name=None,
+               connect_timeout=20, max_pvs=20000, pv_idle_timeout=600,
+               differential_restore=False, restore_policy_file=None):
       self.db_file_name = db_file_name
       self.rt_file_name = '{}/{}_runtime.db'.format(os.path.dirname(self.db_file_name),
                                          os.path.basename(self.db_file_name).\
@@ -111,11 +465,36 @@ class MpsManager:
       self.log_file_name = log_file_name
       self.file = None
       self.log_file_lock = Lock()
-      self.db_read_lock = Lock()
-      self.db_write_lock = Lock()
-      self.db_readers = 0
-      self.readers = []
-      self.writers = []
+      # Requests lock only the devices/applications they use, only the
+      # runtime database commits are serialized by the commit_lock
+      self.lock_manager = LockManager()
+      self.lock_timeout = lock_timeout
+      self.commit_lock = Lock()
+      self.num_readers = num_readers
+      self.num_writers = num_writers
+      self.request_timeout = request_timeout
+      self.idle_timeout = idle_timeout
+      self.max_requests = max_requests
+      self.max_queued = max_queued
+      self.connect_timeout = connect_timeout
+      self.max_pvs = max_pvs
+      self.pv_idle_timeout = pv_idle_timeout
+      self.differential_restore = differential_restore
+      # Timeouts and retries of the restores, per application if set in the
+      # restore policy file, with the time-to-connect observed for each one
+      default_policy = RestorePolicy(connect_timeout=connect_timeout)
+      if (restore_policy_file != None):
+          try:
+              self.restore_policies = load_restore_policies(restore_policy_file, default_policy)
+          except Exception as e:
+              print('ERROR: Cannot read restore policy file {} ({})'.format(restore_policy_file, str(e)))
+              exit(1)
+      else:
+          self.restore_policies = RestorePolicies(default_policy)
+      # Latency histograms and reply statuses per request type, the timing
+      # of the request being processed is kept per worker thread
+      self.stats = RequestStats()
+      self.request_context = threading.local()
 
       if (hb_pv_name != None):
           self.hb_pv = PV(hb_pv_name)
@@ -123,6 +502,12 @@ class MpsManager:
               print('ERROR: Cannot connect to specified heart beat PV ({})'.format(hb_pv_name))
               exit(1)
 
+      if (hb_jitter_pv_name != None):
+          self.hb_jitter_pv = PV(hb_jitter_pv_name)
+          if (self.hb_jitter_pv.host == None):
+              print('ERROR: Cannot connect to specified heart beat jitter PV ({})'.format(hb_jitter_pv_name))
+              exit(1)
+
       try:
           self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
           self.tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -153,60 +538,68 @@ class MpsManager:
               exit(1)
 
       myAddr = (self.host, self.port)
-  
-  def db_reader_start(self):
-      self.db_read_lock.acquire()
-      self.db_readers += 1
-      if (self.db_readers == 1):
-          self.db_write_lock.acquire()
-      self.db_read_lock.release()
-
-  def db_reader_end(self):
-      self.db_read_lock.acquire()
-      self.db_readers -= 1
-      if (self.db_readers == 0):
-          self.db_write_lock.release()
-      self.past_readers += 1
-      self.db_read_lock.release()
-      
-  def cleanup(self):
-      old=self.readers
-      self.readers = []
-      for r in old:
-          if not r.isAlive():
-              del r
-          else:
-              self.readers.append(r)
 
-      old=self.writers
-      self.writers = []
-      for r in old:
-          if not r.isAlive():
-              del r
-          else:
-              self.readers.append(r)
+      self.db_pool = DatabaseReaderPool(self.db_file_name, self.rt_file_name,
+                                        max_idle=self.num_readers + self.num_writers)
+      self.db_pool.checkin(self.db_pool.checkout()) # Open the databases before the first request
+
+      # Compiled restore plans per application, dropped when the thresholds
+      # of their devices are changed or the databases are modified
+      self.plan_cache = RestorePlanCache(self.db_file_name, self.rt_file_name)
+
+      # Threshold and release PVs stay connected between requests, those not
+      # used for pv_idle_timeout seconds are disconnected by the housekeeping
+      self.pv_cache = PVCache(max_size=self.max_pvs, max_idle=self.pv_idle_timeout)
+
+      # Requests are served by fixed-size pools, restores/reads and threshold
+      # changes are queued separately so writers don't wait behind readers.
+      # Requests beyond max_queued are answered BUSY (see request_priority).
+      self.reader_pool = WorkerPool('Reader', self.num_readers, self.log_string,
+                                    epics.ca.use_initial_context,
+                                    self.max_queued, self.reject_request)
+      self.writer_pool = WorkerPool('Writer', self.num_writers, self.log_string,
+                                    epics.ca.use_initial_context,
+                                    self.max_queued, self.reject_request)
 
+      # The PVs of concurrent restores are connected and written together by
+      # the coordinator, the restore pool verifies, releases and replies
+      self.restore_coordinator = RestoreCoordinator('RestoreCoordinator', self.log_string,
+                                                    epics.ca.use_initial_context)
+      self.restore_pool = WorkerPool('Restore', self.num_readers, self.log_string,
+                                     epics.ca.use_initial_context)
 
+      # Heartbeat, statistics and housekeeping run from their own thread, so
+      # they keep their pace however busy the request handling gets
+      self.timers = TimerThread('Timers', self.log_string, epics.ca.use_initial_context)
+      self.timers.add('heartbeat', self.hb_interval, self.heartbeat)
+      self.timers.add('stats', self.stats_interval, self.log_stats)
+      self.timers.add('housekeeping', self.housekeeping_interval, self.housekeeping)
+  
   def run(self):
-      done = False
       self.log_string("+== MpsManager Server ==============================")
       self.log_string("| Host      : {}".format(self.host))
       self.log_string("| Port      : {}".format(self.port))
       self.log_string("| Config Db : {}".format(self.db_file_name))
       self.log_string("| Runtime Db: {}".format(self.rt_file_name))
+      self.log_string("| Workers   : R={}/W={}".format(self.num_readers, self.num_writers))
+      self.log_string("| Lock wait : {}s".format(self.lock_timeout))
+      self.log_string("| Keep-alive: {}s/{} requests".format(self.idle_timeout, self.max_requests))
+      self.log_string("| Max queued: {}".format(self.max_queued))
+      self.log_string("| PV connect: {}s".format(self.restore_policies.default.connect_timeout))
+      self.log_string("| PV cache  : {} PVs/{}s idle".format(self.max_pvs, self.pv_idle_timeout))
+      policy = self.restore_policies.default
+      self.log_string("| Restore   : {}, {} attempts/{}s (backoff {}s, {} overrides)".\
+                          format('differential' if self.differential_restore else 'full',
+                                 policy.max_attempts, policy.deadline, policy.backoff,
+                                 len(self.restore_policies.overrides)))
       self.log_string("+===================================================")
-      self.tcp_server.settimeout(5)
-      while not done:
-          self.tcp_server.listen(4)
-          try:
-              (conn, (ip, port)) = self.tcp_server.accept()
-              self.process_request(conn, ip, port)
-          except socket.timeout:
-              self.heartbeat() # Increment heart beat PV every 5 seconds
-              self.cleanup()   # Removes finished worker threads
-              if (self.hb_count % 32 == 0):
-                  self.log_stats()
-              
+      self.server = RequestServer(self.tcp_server, self.frame_size, self.process_request,
+                                  self.process_tagged_request, self.log_string,
+                                  idle_timeout=self.idle_timeout,
+                                  max_requests=self.max_requests)
+      self.timers.start()
+      self.server.run()
+
   def log_string(self, message):
       self.log_file_lock.acquire()
       if self.log_file_name != None:
@@ -218,12 +611,64 @@ class MpsManager:
       self.log_file_lock.release()
 
   def log_stats(self):
+      r = self.reader_pool.get_stats(reset=True)
+      w = self.writer_pool.get_stats(reset=True)
       message = 'Active R={}/W={}, Past R={}/W={}'.\
-          format(len(self.readers), len(self.writers),
+          format(r['active'], w['active'],
                  self.past_readers, self.past_writers)
+      message += ', Queued R={}/W={} (max R={}/W={})'.\
+          format(r['depth'], w['depth'], r['max_depth'], w['max_depth'])
+      message += ', Wait avg R={:.3f}s/W={:.3f}s (max R={:.3f}s/W={:.3f}s)'.\
+          format(r['avg_wait'], w['avg_wait'], r['max_wait'], w['max_wait'])
+      message += ', Rejected R={}/W={}'.format(r['rejected'], w['rejected'])
+      l = self.lock_manager.get_stats(reset=True)
+      message += ', Locked keys={}'.format(l['keys'])
+      for kind, name in [('read', 'R'), ('write', 'W')]:
+          count = l[kind]['count']
+          message += ', Lock {} count={} avg={:.3f}s max={:.3f}s timeouts={}'.\
+              format(name, count, l[kind]['total_wait'] / count if count > 0 else 0.0,
+                     l[kind]['max_wait'], l[kind]['timeouts'])
+      c = self.server.get_stats()
+      message += ', Connections idle={}/busy={} (pipelined requests={})'.\
+          format(c['idle'], c['busy'], c['pipelined'])
+      rc = self.restore_coordinator.get_stats(reset=True)
+      message += ', Restores active={} (max={}) completed={} failed={}'.\
+          format(rc['active'], rc['max_active'], rc['completed'], rc['failed'])
+      rp = self.restore_policies.get_stats(reset=True)
+      message += ', Restore connect p50={:.3f}s max={:.3f}s (retried={})'.\
+          format(rp['connect']['p50'], rp['connect']['max'], rp['retried'])
+      p = self.plan_cache.get_stats(reset=True)
+      message += ', Restore plans={} (hits={}/misses={}/invalidated={})'.\
+          format(p['plans'], p['hits'], p['misses'], p['invalidated'])
+      pv = self.pv_cache.get_stats(reset=True)
+      message += ', PVs={} (in use={}/connected={}, created={}/reused={}/evicted={})'.\
+          format(pv['pvs'], pv['in_use'], pv['connected'], pv['created'], pv['hits'], pv['evicted'])
+      db = self.db_pool.get_stats()
+      message += ', Db sessions idle={}/created={}/used={}'.\
+          format(db['idle'], db['created'], db['checkouts'])
+      hb = self.timers.get_stats(reset=True)['heartbeat']
+      message += ', Heartbeat jitter avg={:.3f}s max={:.3f}s (skipped={})'.\
+          format(hb['avg_jitter'], hb['max_jitter'], hb['skipped'])
+      self.log_string(message)
+
+      stats = self.stats.get_stats()
+      message = 'Latency ({:.0f}s)'.format(stats['period'])
+      for request_name in sorted(stats['latency'].keys()):
+          total = stats['latency'][request_name]['total']
+          message += ', {} n={} p50={:.3f}s p99={:.3f}s max={:.3f}s'.\
+              format(request_name, total['count'], total['p50'], total['p99'], total['max'])
+          errors = ['{}={}'.format(status, count)
+                    for status, count in sorted(stats['status'].get(request_name, {}).items())
+                    if status != MpsManagerResponseType.OK.name]
+          if (len(errors) > 0):
+              message += ' ({})'.format(' '.join(errors))
       self.log_string(message)
       
   def heartbeat(self):
+      """
+      Increments the heart beat PV every hb_interval seconds, and publishes
+      how late (seconds) this beat was with respect to its schedule
+      """
       self.hb_count += 1
       try:
           if (self.hb_pv != None):
@@ -231,36 +676,225 @@ class MpsManager:
       except epics.ca.CASeverityException:
           self.log_string('ERROR: Cannot update heartbeat PV ({})'.format(self.hb_pv.pvname)) 
 
+      try:
+          if (self.hb_jitter_pv != None):
+              self.hb_jitter_pv.put(self.timers.get_stats()['heartbeat']['jitter'])
+      except epics.ca.CASeverityException:
+          self.log_string('ERROR: Cannot update heartbeat jitter PV ({})'.format(self.hb_jitter_pv.pvname))
+
+  def housekeeping(self):
+      self.db_pool.prune()
+      self.plan_cache.prune()
+      self.pv_cache.prune()
+
   def decode_message(self, message, conn, ip, port):
+      progress = message.request_type & int(MpsManagerRequestFlags.PROGRESS.value)
+      message.request_type &= ~int(MpsManagerRequestFlags.PROGRESS.value)
+      priority = self.request_priority.get(message.request_type)
+      timing = RequestTiming(enum_name(MpsManagerRequestType, message.request_type))
       if (message.request_type == int(MpsManagerRequestType.RESTORE_APP_THRESHOLDS.value)):
           self.log_string('Request for restore app thresholds')
-          reader = ReaderThread(self, message, conn, ip, port)
-          self.readers.append(reader)
-          reader.start()
+          if (progress and not isinstance(conn, TaggedChannel)):
+              progress = RestoreProgress(conn, message.request_device_id, timing.received)
+              progress.keep_alive('queued', 0) # Until a worker takes the request
+          else:
+              progress = None
+          self.reader_pool.submit_priority(priority, ReaderTask(self, message, conn, ip, port, timing,
+                                                                progress=progress).run)
       elif (message.request_type == int(MpsManagerRequestType.CHANGE_THRESHOLD.value)):
           self.log_string('Request for change device thresholds')
-          writer = WriterThread(self, message, conn, ip, port)
-          self.writers.append(writer)
-          writer.start()
+          self.writer_pool.submit_priority(priority, WriterTask(self, message, conn, ip, port, timing).run)
+      elif (message.request_type == int(MpsManagerRequestType.CHANGE_THRESHOLD_BATCH.value)):
+          self.log_string('Request for change thresholds of {} devices'.format(message.request_device_id))
+          self.writer_pool.submit_priority(priority, WriterTask(self, message, conn, ip, port, timing).run)
       elif (message.request_type == int(MpsManagerRequestType.GET_THRESHOLD.value)):
           self.log_string('Request for current device thresholds')
-          reader = ReaderThread(self, message, conn, ip, port)
-          self.readers.append(reader)
-          reader.start()
+          self.reader_pool.submit_priority(priority, ReaderTask(self, message, conn, ip, port, timing).run)
       elif (message.request_type == int(MpsManagerRequestType.DEVICE_CHECK.value)):
           self.log_string('Request for restore app thresholds')
-          reader = ReaderThread(self, message, conn, ip, port, True)
-          self.readers.append(reader)
-          reader.start()
+          self.reader_pool.submit_priority(priority, ReaderTask(self, message, conn, ip, port, timing, True).run)
+      elif (message.request_type == int(MpsManagerRequestType.STATS.value)):
+          # Answered right away, the statistics must be available when the
+          # worker pools are saturated. The reply is written by the server
+          # loop without blocking, a client not reading it stalls no one.
+          self.log_string('Request for server statistics')
+          self.request_done(conn, True, self.stats_reply(message.request_device_id != 0))
       else:
           self.log_string('Invalid request type: {}'.format(message.request_type))
+          timing.status = MpsManagerResponseType.BAD_REQUEST.name
+          self.stats.record(timing)
+          self.request_done(conn, False)
+
+  def begin_request(self, timing, submitted):
+      """
+      Called by the worker starting a request: records the queue wait and
+      makes timing the current RequestTiming for this thread (used by
+      get_timing()/set_status()), the 'db' phase starts with the checkout
+      of the database sessions
+      """
+      timing.add('queue', time.time() - submitted)
+      self.request_context.timing = timing
+      timing.start('db')
+
+  def end_request(self, timing):
+      self.request_context.timing = None
+      self.stats.record(timing)
+
+  def suspend_request(self):
+      """
+      Called by a worker handing its request over to another thread
+      """
+      self.request_context.timing = None
+
+  def resume_request(self, timing):
+      self.request_context.timing = timing
+
+  def get_timing(self):
+      """
+      Returns the RequestTiming of the request processed by this thread
+      """
+      timing = getattr(self.request_context, 'timing', None)
+      if (timing == None):
+          return RequestTiming()
+      return timing
+
+  def set_status(self, status):
+      """
+      Sets the reply status (MpsManagerResponseType value, or name for the
+      statuses not covered by it) of the request processed by this thread
+      """
+      if (isinstance(status, int)):
+          status = enum_name(MpsManagerResponseType, status)
+      self.get_timing().status = status
+
+  def stats_reply(self, reset):
+      stats = self.stats.get_stats(reset)
+      stats['pools'] = {'reader': self.reader_pool.get_stats(),
+                        'writer': self.writer_pool.get_stats()}
+      stats['locks'] = self.lock_manager.get_stats()
+      stats['connections'] = self.server.get_stats()
+      stats['db_sessions'] = self.db_pool.get_stats()
+      stats['restore_plans'] = self.plan_cache.get_stats()
+      stats['pvs'] = self.pv_cache.get_stats()
+      stats['restores'] = self.restore_policies.get_stats()
+      stats['heartbeat'] = self.timers.get_stats()['heartbeat']
+      return MpsManagerStatsResponse(stats).pack()
+
+  def reject_request(self, task, args):
+      """
+      Called by the worker pools with the requests that did not fit in the
+      queue, task is the run() method of the ReaderTask/WriterTask
+      """
+      task.__self__.reject()
+
+  def frame_size(self, data):
+      """
+      Returns the size of the request frame starting with data, and whether
+      it is a tagged (pipelined) request
+      """
+      request = MpsManagerRequest()
+      if (len(data) < request.size()):
+          return request.size(), False
+
+      request.unpack(data[:request.size()])
+      if (not request.request_type & int(MpsManagerRequestFlags.TAGGED.value)):
+          return request.size(), False
 
-  def process_request(self, conn, ip, port):
+      size = request.size() + MpsManagerRequestTag().size()
+      request_type = request.request_type & ~int(MpsManagerRequestFlags.TAGGED.value)
+      if (request_type == int(MpsManagerRequestType.CHANGE_THRESHOLD.value)):
+          size += MpsManagerThresholdRequest().size()
+      elif (request_type == int(MpsManagerRequestType.CHANGE_THRESHOLD_BATCH.value)):
+          # Batches over max_batch are rejected without their entries (the
+          # connection is closed, see process_tagged_request())
+          if (request.request_device_id > 0 and request.request_device_id <= self.max_batch):
+              size += request.request_device_id * MpsManagerThresholdRequest().size()
+      return size, True
+
+  def process_tagged_request(self, data, conn, ip, port):
+      """
+      Called by the RequestServer with a complete tagged request, the reply
+      is sent back through the TaggedChannel when the worker is done. Returns
+      False if the connection can't be read any further.
+      """
+      message = MpsManagerRequest()
+      message.unpack(data[:message.size()])
+      message.request_type &= ~int(MpsManagerRequestFlags.TAGGED.value)
+      data = data[message.size():]
+
+      # The entries of a batch over max_batch are not part of the frame (see
+      # frame_size()), they would be read as requests: the batch is rejected
+      # and the connection closed after the replies
+      truncated = (message.request_type == int(MpsManagerRequestType.CHANGE_THRESHOLD_BATCH.value) and
+                   message.request_device_id > self.max_batch)
+
+      tag = MpsManagerRequestTag()
+      tag.unpack(data[:tag.size()])
+      channel = TaggedChannel(self.server, conn, tag.request_id, data[tag.size():])
+      self.decode_message(message, channel, ip, port)
+      return not truncated
+
+  def process_request(self, data, conn, ip, port):
+    """
+    Called by the RequestServer with a complete request, from this point on
+    the worker owns the connection, blocking operations are bound by the
+    request timeout
+    """
     message=MpsManagerRequest()
-    data = conn.recv(message.size())
-    if data:
-        message.unpack(data)
-        self.decode_message(message, conn, ip, port)
+    message.unpack(data)
+    conn.settimeout(self.request_timeout)
+    self.decode_message(message, conn, ip, port)
+
+  def request_done(self, conn, keep_alive=True, data=''):
+      """
+      Returns the connection to the server loop to wait for the next request
+      from the same client. Connections are closed after failed requests
+      (after the pending replies, for tagged requests). data, if given, is
+      the reply, sent by the server loop without blocking (for the requests
+      answered from the loop itself).
+      """
+      if (isinstance(conn, TaggedChannel)):
+          conn.sendall(data)
+          conn.finish(keep_alive)
+      else:
+          self.server.resume(conn, keep_alive, data)
+
+  def send_busy(self, conn, device_id, reason='timeout waiting for lock'):
+      """
+      Reply to a request that could not be served, either because the
+      device/application locks were not available in time or because the
+      request queue was full
+      """
+      self.log_string('Busy: {} (id={})'.format(reason, device_id))
+      self.set_status(int(MpsManagerResponseType.BUSY.value))
+      response = MpsManagerResponse()
+      response.status = int(MpsManagerResponseType.BUSY.value)
+      response.device_id = device_id
+      response.status_message = 'Server busy, try again later'
+      conn.send(response.pack())
+
+  def lock(self, shared=[], exclusive=[]):
+      """
+      Acquire locks for the devices/applications used by a request, returns
+      None if the locks are not available within the lock timeout
+      """
+      lock_set = self.lock_manager.acquire(shared, exclusive, self.lock_timeout)
+      if (lock_set != None):
+          self.get_timing().add('lock', lock_set.wait)
+          self.log_string('Lock wait={:.3f}s (shared={}, exclusive={})'.\
+                              format(lock_set.wait, shared, exclusive))
+      return lock_set
+
+  def unlock(self, lock_set):
+      self.lock_manager.release(lock_set)
+
+  def get_app_device_ids(self, dbr, app_id):
+      try:
+          app = dbr.session.query(models.ApplicationCard).\
+              filter(models.ApplicationCard.global_id==app_id).one()
+      except:
+          return []
+      return [c.analog_device.id for c in app.analog_channels]
 
   def is_analog(self, dbr, dev_id):
     analog_devices = dbr.session.query(models.AnalogDevice).filter(models.AnalogDevice.id==dev_id).all()
@@ -366,12 +1000,32 @@ class MpsManager:
           response.status_message = 'Device is valid (name={}, id={}, info={})'.format(rt_d.mpsdb_name,
                                                                                        rt_d.mpsdb_id,
                                                                                        status_message)
+      self.set_status(response.status)
       conn.send(response.pack())
 
-  def check_analog_device_request(self, conn, dbr, device_id, device_name):
+  def check_analog_device_request(self, conn, dbr, device_id, device_name, exclusive=False):
+      """
+      Checks the device and locks it (shared lock for reading thresholds,
+      exclusive for changing) before replying to the client. Returns the
+      runtime device, is_bpm and the locks to be released by the caller
+      (rt_d is None if the device is invalid or if the lock timed out).
+      """
       self.log_string('Checking device id={}, name={}'.\
                           format(device_id, device_name))
+      timing = self.get_timing()
+      timing.start('db')
       rt_d, is_bpm = self.check_analog_device(dbr, int(device_id), device_name)
+      timing.stop('db')
+      lock_set = None
+      if (rt_d != None):
+          if (exclusive):
+              lock_set = self.lock(exclusive=[('device', rt_d.id)])
+          else:
+              lock_set = self.lock(shared=[('device', rt_d.id)])
+          if (lock_set == None):
+              self.send_busy(conn, device_id)
+              return None, None, None
+
       response = MpsManagerResponse()
       if (rt_d == None):
           response.status = int(MpsManagerResponseType.BAD_DEVICE.value)
@@ -386,87 +1040,293 @@ class MpsManager:
           response.device_id = rt_d.mpsdb_id
           response.status_message = 'Device is valid (name={}, id={})'.format(rt_d.mpsdb_name,
                                                                               rt_d.mpsdb_id)
+      self.set_status(response.status)
       conn.send(response.pack())
 
-      return rt_d, is_bpm
+      return rt_d, is_bpm, lock_set
 
-  def restore(self, conn, dbr, app_id):
+  def restore(self, conn, dbr, app_id, task):
+      """
+      Reads the application thresholds and hands them to the restore
+      coordinator. Returns True if the restore continues there (the reply is
+      then sent by task.finish_restore()), False if it is already answered.
+      """
       self.log_string('Restoring thresholds for app={}'.format(app_id))
-      # Restore thresholds here
-      tr = ThresholdRestorer(db=dbr.session, rt_db=dbr.rt_session, mps_names=dbr.mps_names, 
-                             force_write=False, verbose=True)
+      # The app is locked for restore, and its devices can't change meanwhile
+      device_ids = self.plan_cache.get_device_ids(app_id)
+      if (device_ids == None):
+          device_ids = self.get_app_device_ids(dbr, app_id)
+      device_keys = [('device', d) for d in device_ids]
+      if (task.progress != None):
+          task.progress.keep_alive('lock', 0)
+      lock_set = self.lock(shared=device_keys, exclusive=[('app', app_id)])
+      if (lock_set == None):
+          if (task.progress != None):
+              task.progress.finish()
+          self.send_busy(conn, app_id)
+          return False
+
+      deferred = False
+      try:
+          tr = ThresholdRestorer(db=dbr.session, rt_db=dbr.rt_session, mps_names=dbr.mps_names, 
+                                 force_write=False, verbose=True, timing=self.get_timing(),
+                                 pv_cache=self.pv_cache, differential=self.differential_restore,
+                                 policy=self.restore_policies.get(app_id))
+          if (task.progress != None):
+              task.progress.keep_alive('db', 0)
+          restore_list = tr.prepare(app_id, self.plan_cache)
+          if (restore_list == None):
+              tr.close()
+              self.restore_reply(conn, tr, False, app_id, task.progress)
+              return False
 
+          progress = None
+          if (task.progress != None):
+              task.progress.update('db', len(restore_list), len(restore_list), final=True)
+              progress = task.progress.update
+          self.restore_coordinator.submit(tr, restore_list,
+                                          lambda job: self.restore_pool.submit(task.finish_restore,
+                                                                               tr, lock_set, job),
+                                          progress)
+          deferred = True
+          return True
+      finally:
+          if (not deferred):
+              self.unlock(lock_set)
+
+  def restore_reply(self, conn, tr, restored, app_id, progress=None):
+      """
+      Verifies the restored thresholds, releases the IOC and sends the reply
+      """
       response = MpsManagerResponse()
-      if (tr.restore(app_id) == False):
+      if (restored == False):
           response.status = int(MpsManagerResponseType.RESTORE_FAIL.value)
           response.status_message = tr.error_message
-          conn.send(response.pack())
+          self.send_restore_reply(conn, response, progress)
           return
       else:
-          if (tr.check(app_id) == False):
+          if (progress != None and tr.restore_list != None):
+              total = 2 * len(tr.restore_list)
+              progress.keep_alive('verify', total)
+          checked = tr.check(app_id)
+          if (progress != None and tr.restore_list != None):
+              progress.update('verify', total - len(tr.mismatches), total, final=True)
+          if (checked == False):
               response.status = int(MpsManagerResponseType.RESTORE_FAIL.value)
               response.status_message = tr.error_message
-              conn.send(response.pack())
+              self.send_restore_reply(conn, response, progress)
               return
           else:
-              if (tr.release() == False):
+              if (progress != None):
+                  progress.keep_alive('release', 2)
+              released = tr.release()
+              if (progress != None):
+                  progress.update('release', 0 if released == False else 2, 2, final=True)
+              if (released == False):
                   response.status = int(MpsManagerResponseType.RESTORE_FAIL.value)
                   response.status_message = tr.error_message
-                  conn.send(response.pack())
+                  self.send_restore_reply(conn, response, progress)
                   return
 
       response.status = int(MpsManagerResponseType.OK.value)
       response.device_id = app_id
       response.status_message = 'Thresholds restored for app {}'.format(app_id)
+      if (tr.differential):
+          response.status_message += ' ({} PVs already set)'.format(tr.skipped)
+      self.send_restore_reply(conn, response, progress)
+
+  def send_restore_reply(self, conn, response, progress):
+      if (progress != None):
+          progress.finish() # The rest of a pending frame goes first
+      self.set_status(response.status)
       conn.send(response.pack())
 
   def get_threshold(self, dbr, message, conn, ip, port):
       self.log_string('Getting thresholds for device id={}, name={}'.\
                           format(message.request_device_id, message.request_device_name))
-      rt_d, is_bpm = self.check_analog_device_request(conn, dbr, int(message.request_device_id),
-                                                      message.request_device_name)
+      rt_d, is_bpm, lock_set = self.check_analog_device_request(conn, dbr, int(message.request_device_id),
+                                                                message.request_device_name)
       if rt_d == None:
           self.log_string('Get threshold: invalid device')
           return
 
-      tm = ThresholdManager(dbr.session, dbr.rt_session, dbr.mps_names)
-      threshold_message = tm.get_thresholds(rt_d, is_bpm)
-      threshold_message.device_name = message.request_device_name
-      threshold_message.device_id = message.request_device_id
-      conn.send(threshold_message.pack())
+      try:
+          self.get_timing().start('db')
+          tm = ThresholdManager(dbr.session, dbr.rt_session, dbr.mps_names)
+          threshold_message = tm.get_thresholds(rt_d, is_bpm)
+          self.get_timing().stop('db')
+          threshold_message.device_name = message.request_device_name
+          threshold_message.device_id = message.request_device_id
+          conn.send(threshold_message.pack())
+      finally:
+          self.unlock(lock_set)
 
   def change_threshold(self, dbr, message, conn, ip, port):
       self.log_string('Checking device id={}, name={}'.\
                           format(message.request_device_id, message.request_device_name))
-      rt_d, is_bpm = self.check_analog_device_request(conn, dbr, int(message.request_device_id),
-                                                      message.request_device_name)
+      rt_d, is_bpm, lock_set = self.check_analog_device_request(conn, dbr, int(message.request_device_id),
+                                                                message.request_device_name,
+                                                                exclusive=True)
       if rt_d == None:
           self.log_string('Change threshold: invalid device')
           return
 
+      try:
+          self.change_device_threshold(dbr, rt_d, is_bpm, conn)
+      finally:
+          self.unlock(lock_set)
+
+  def change_device_threshold(self, dbr, rt_d, is_bpm, conn):
       # Receive list of thresholds to be changed
       threshold_message = MpsManagerThresholdRequest()
-      data = conn.recv(threshold_message.size())
-      print('Received {} bytes'.format(len(data)))
+      data = receive(conn, threshold_message.size())
+      if (data == None):
+          self.log_string('Change threshold: connection closed by client')
+          return
       threshold_message.unpack(data)
 
-      tm = ThresholdManager(dbr.session, dbr.rt_session, dbr.mps_names)
-      log, error_pvs, status = tm.change_thresholds(rt_d, threshold_message.user_name,
-                                                    threshold_message.reason, is_bpm,
-                                                    threshold_message.lc1_active, threshold_message.lc1_value,
-                                                    threshold_message.idl_active, threshold_message.idl_value,
-                                                    threshold_message.lc2_active, threshold_message.lc2_value,
-                                                    threshold_message.alt_active, threshold_message.alt_value,
-                                                    threshold_message.disable)
+      tm = ThresholdManager(dbr.session, dbr.rt_session, dbr.mps_names, self.commit_lock,
+                            self.get_timing(), self.plan_cache, self.pv_cache)
+      try:
+          log, error_pvs, status = tm.change_thresholds(rt_d, threshold_message.user_name,
+                                                        threshold_message.reason, is_bpm,
+                                                        threshold_message.lc1_active, threshold_message.lc1_value,
+                                                        threshold_message.idl_active, threshold_message.idl_value,
+                                                        threshold_message.lc2_active, threshold_message.lc2_value,
+                                                        threshold_message.alt_active, threshold_message.alt_value,
+                                                        threshold_message.disable)
+      finally:
+          tm.close()
 
       self.log_string('\n' + log + ': ' + error_pvs)
       if status:
+          self.set_status(int(MpsManagerResponseType.OK.value))
           response_message = MpsManagerThresholdResponse(status=0, message="OK")
       else:
+          self.set_status(int(MpsManagerResponseType.THRESHOLD_FAIL.value))
           response_message = MpsManagerThresholdResponse(status=1, 
                                                          message='{}:{}'.format(log,error_pvs))
       conn.send(response_message.pack())
 
+  def change_threshold_batch(self, dbr, message, conn):
+      """
+      Changes the thresholds of the devices in a CHANGE_THRESHOLD_BATCH
+      request. All the devices are checked, locked and their changes verified
+      before anything is changed, if any entry is invalid none is applied.
+      The PVs of all the devices are written at once and the database
+      changes committed in one transaction. Returns False if the connection
+      must be closed (entries not received).
+      """
+      count = message.request_device_id
+      if (count <= 0 or count > self.max_batch):
+          self.log_string('Change threshold batch: invalid number of entries ({})'.format(count))
+          self.batch_reply(conn, int(MpsManagerResponseType.BAD_REQUEST.value), [],
+                           'Invalid number of entries ({}, max={})'.format(count, self.max_batch))
+          return False
+
+      requests = []
+      for index in range(count):
+          request = MpsManagerThresholdRequest()
+          data = receive(conn, request.size())
+          if (data == None):
+              self.log_string('Change threshold batch: connection closed by client')
+              return False
+          request.unpack(data)
+          requests.append(request)
+
+      timing = self.get_timing()
+      timing.start('db')
+      devices = [self.check_analog_device(dbr, int(request.device_id), request.device_name)
+                 for request in requests]
+      timing.stop('db')
+
+      device_ids = sorted(set([rt_d.id for rt_d, is_bpm in devices if rt_d != None]))
+      lock_set = self.lock(exclusive=[('device', device_id) for device_id in device_ids])
+      if (lock_set == None):
+          self.send_busy(conn, 0) # No entry responses follow
+          return True
+
+      try:
+          results, applied = self.change_batch_thresholds(dbr, requests, devices)
+      finally:
+          self.unlock(lock_set)
+
+      statuses = [status for status, device_id, status_message in results]
+      failed = len(statuses) - statuses.count(int(MpsManagerResponseType.OK.value))
+      if (not applied):
+          status = int(MpsManagerResponseType.NOT_APPLIED.value)
+          status_message = 'No thresholds changed, {} invalid entries'.\
+              format(count - statuses.count(int(MpsManagerResponseType.NOT_APPLIED.value)))
+      elif (failed == 0):
+          status = int(MpsManagerResponseType.OK.value)
+          status_message = 'Thresholds changed for {} devices'.format(count)
+      else:
+          status = int(MpsManagerResponseType.THRESHOLD_FAIL.value)
+          status_message = 'Thresholds changed for {} devices, PVs not written for {}'.\
+              format(count, failed)
+      self.batch_reply(conn, status, results, status_message)
+      return True
+
+  def change_batch_thresholds(self, dbr, requests, devices):
+      """
+      Verifies and applies the batch changes, the devices are locked by the
+      caller. Returns the (status, device id, message) of each entry and
+      whether the changes were applied.
+      """
+      batch = ThresholdChangeBatch(dbr.session, dbr.rt_session, dbr.mps_names, self.commit_lock,
+                                   self.get_timing(), self.plan_cache, self.pv_cache)
+      try:
+          results = []
+          entries = [] # index in results of the entries added to the batch
+          seen = []
+          for request, (rt_d, is_bpm) in zip(requests, devices):
+              if (rt_d == None):
+                  if (request.device_id < 0):
+                      device = 'name={}'.format(request.device_name)
+                  else:
+                      device = 'id={}'.format(request.device_id)
+                  results.append((int(MpsManagerResponseType.BAD_DEVICE.value), request.device_id,
+                                  'Device not valid ({})'.format(device)))
+              elif (rt_d.id in seen):
+                  results.append((int(MpsManagerResponseType.BAD_REQUEST.value), rt_d.mpsdb_id,
+                                  'Device {} already in the batch'.format(rt_d.mpsdb_name)))
+              else:
+                  seen.append(rt_d.id)
+                  error_message, error_pvs, status = batch.add(rt_d, is_bpm, request)
+                  if (status):
+                      entries.append(len(results))
+                      results.append((int(MpsManagerResponseType.OK.value), rt_d.mpsdb_id, ''))
+                  else:
+                      results.append((int(MpsManagerResponseType.THRESHOLD_FAIL.value), rt_d.mpsdb_id,
+                                      '{}:{}'.format(error_message, error_pvs)))
+
+          if (len(entries) < len(results)):
+              self.log_string('Change threshold batch: {} invalid entries, nothing changed'.\
+                                  format(len(results) - len(entries)))
+              for index in entries:
+                  results[index] = (int(MpsManagerResponseType.NOT_APPLIED.value), results[index][1],
+                                    'Not applied, other entries are invalid')
+              return results, False
+
+          for index, (log, error_pvs) in zip(entries, batch.apply()):
+              self.log_string('\n' + log + ': ' + error_pvs)
+              if (error_pvs == ''):
+                  results[index] = (int(MpsManagerResponseType.OK.value), results[index][1], 'OK')
+              else:
+                  results[index] = (int(MpsManagerResponseType.THRESHOLD_FAIL.value), results[index][1],
+                                    'Failed to write PVs:\n{}'.format(error_pvs))
+          return results, True
+      finally:
+          batch.close()
+
+  def batch_reply(self, conn, status, results, status_message):
+      self.set_status(status)
+      response = MpsManagerResponse(status, len(results), status_message)
+      data = response.pack()
+      for entry_status, device_id, entry_message in results:
+          data += MpsManagerResponse(entry_status, device_id, entry_message).pack()
+      conn.sendall(data)
+
   def send_response(self, response, requestor):
       self.sock.sendto(response.pack(), requestor)
       
@@ -474,8 +1334,17 @@ class MpsManager:
 #===========================================================================
 # Main
 
-def main(host, port, log_file_name, database_name, hb_pv_name, stdout):
-    mps_manager = MpsManager(host, port, log_file_name, database_name, hb_pv_name, stdout)
+def main(host, port, log_file_name, database_name, hb_pv_name, stdout, num_readers, num_writers,
+         lock_timeout, idle_timeout, max_requests, max_queued, hb_jitter_pv_name, connect_timeout,
+         max_pvs, pv_idle_timeout, differential_restore, restore_policy_file):
+    mps_manager = MpsManager(host, port, log_file_name, database_name, hb_pv_name, stdout,
+                             num_readers, num_writers, lock_timeout=lock_timeout,
+                             idle_timeout=idle_timeout, max_requests=max_requests,
+                             max_queued=max_queued, hb_jitter_pv_name=hb_jitter_pv_name,
+                             connect_timeout=connect_timeout, max_pvs=max_pvs,
+                             pv_idle_timeout=pv_idle_timeout,
+                             differential_restore=differential_restore,
+                             restore_policy_file=restore_policy_file)
     mps_manager.run()
 
 if __name__ == "__main__":
@@ -488,6 +1357,31 @@ if __name__ == "__main__":
     parser.add_argument('-c', action='store_true', default=False, dest='stdout', help='Print log messages to stdout')
     parser.add_argument('--hb', metavar='PV', type=str, nargs='?', 
                         default=None, required=False, help='PV used as heart beat by the server')
+    parser.add_argument('--hb-jitter', metavar='PV', type=str, nargs='?',
+                        default=None, required=False,
+                        help='PV updated with the heart beat jitter in seconds (how late each beat was)')
+    parser.add_argument('--readers', metavar='N', type=int, default=8,
+                        help='number of worker threads for restore/read requests (default=8)')
+    parser.add_argument('--writers', metavar='N', type=int, default=4,
+                        help='number of worker threads for threshold change requests (default=4)')
+    parser.add_argument('--lock-timeout', metavar='seconds', type=float, default=30,
+                        help='time to wait for device/application locks before replying busy (default=30)')
+    parser.add_argument('--idle-timeout', metavar='seconds', type=float, default=60,
+                        help='close client connections idle for longer than this (default=60)')
+    parser.add_argument('--max-requests', metavar='N', type=int, default=100,
+                        help='number of requests served on a connection before closing it (default=100)')
+    parser.add_argument('--max-queued', metavar='N', type=int, default=256,
+                        help='requests waiting for a worker before replying busy, 0 for no limit (default=256)')
+    parser.add_argument('--connect-timeout', metavar='seconds', type=float, default=20,
+                        help='time to wait for the application PVs to connect when restoring (default=20)')
+    parser.add_argument('--max-pvs', metavar='N', type=int, default=20000,
+                        help='number of PVs kept connected between requests (default=20000)')
+    parser.add_argument('--pv-idle-timeout', metavar='seconds', type=float, default=600,
+                        help='disconnect cached PVs not used for longer than this (default=600)')
+    parser.add_argument('--differential-restore', action='store_true', default=False,
+                        help='read the IOC thresholds when restoring and write only those that differ')
+    parser.add_argument('--restore-policy', metavar='file', type=str, default=None,
+                        help='YAML file with the restore timeouts/retries, and per application overrides')
 
     args = parser.parse_args()
 
@@ -507,5 +1401,12 @@ if __name__ == "__main__":
        
     main(host=host, port=port, log_file_name=log_file_name,
          database_name=args.database[0].name,
-         hb_pv_name=args.hb, stdout=stdout)
+         hb_pv_name=args.hb, stdout=stdout,
+         num_readers=args.readers, num_writers=args.writers,
+         lock_timeout=args.lock_timeout, idle_timeout=args.idle_timeout,
+         max_requests=args.max_requests, max_queued=args.max_queued,
+         hb_jitter_pv_name=args.hb_jitter, connect_timeout=args.connect_timeout,
+         max_pvs=args.max_pvs, pv_idle_timeout=args.pv_idle_timeout,
+         differential_restore=args.differential_restore,
+         restore_policy_file=args.restore_policy)
 
@@ -1,6 +1,20 @@
 from ctypes import *
 from enum import Enum
 from struct import *
+import json
+
+def receive(sock, size):
+    """
+    Receive exactly size bytes from the socket (recv() may return less than
+    a full message). Returns None if the connection is closed before that.
+    """
+    data = ''
+    while (len(data) < size):
+        chunk = sock.recv(size - len(data))
+        if (not chunk):
+            return None
+        data += chunk
+    return data
 
 class MpsManagerRequestType(Enum):
     """
@@ -10,20 +24,91 @@ class MpsManagerRequestType(Enum):
     CHANGE_THRESHOLD - sent after a DEVICE_CHECK, for each threshold change request
     RESTORE_APP_THRESHOLDS - sent by IOC after a reboot
     GET_THRESHOLD - request current thresholds from database
+    STATS - request the server latency/status statistics, answered with a
+    MpsManagerStatsResponse. The statistics are reset after being read if
+    request_device_id is not zero.
+    CHANGE_THRESHOLD_BATCH - changes the thresholds of many devices at once,
+    no DEVICE_CHECK needed. request_device_id holds the number of entries,
+    followed by one MpsManagerThresholdRequest per device. Nothing is
+    changed unless all the entries are valid. The reply is a
+    MpsManagerResponse with the overall status, its device_id is the number
+    of MpsManagerResponses that follow, one per entry in order (none if the
+    request was not processed, e.g. BUSY or BAD_REQUEST).
     """
     DEVICE_CHECK = '1'
     CHANGE_THRESHOLD = '2'
     RESTORE_APP_THRESHOLDS = '3'
     GET_THRESHOLD = '4'
-    
+    STATS = '5'
+    CHANGE_THRESHOLD_BATCH = '6'
+
+class MpsManagerRequestFlags(Enum):
+    """
+    Flags added (or'ed) to the MpsManagerRequest.request_type:
+    TAGGED - the request is followed by a MpsManagerRequestTag with the
+    request id, and for CHANGE_THRESHOLD/CHANGE_THRESHOLD_BATCH by the
+    MpsManagerThresholdRequest(s).
+    The server processes tagged requests from the same connection
+    concurrently, the reply for each one is a MpsManagerTaggedResponse
+    holding the request id, replies may arrive in any order.
+    PROGRESS - for RESTORE_APP_THRESHOLDS, the server sends a
+    MpsManagerProgressResponse when each phase of the restore ends and at
+    least every second while it goes on, before the final MpsManagerResponse.
+    Ignored for tagged requests.
+    """
+    TAGGED = '256'
+    PROGRESS = '512'
+
 class MpsManagerResponseType(Enum):
     BAD_REQUEST = '1'
     BAD_DEVICE = '2'
     RESTORE_FAIL = '3'
     RESTORE_INVALID_APP = '4'
     RESTORE_INVALID_DEVICE = '5'
+    BUSY = '6' # server could not process the request in time, client may retry
+    PROGRESS = '7' # MpsManagerProgressResponse, the final response follows
+    THRESHOLD_FAIL = '8' # invalid thresholds, or PVs not written
+    NOT_APPLIED = '9' # batch entry valid, but not applied because others are not
     OK = '10'
 
+class MpsManagerProgressResponse():
+    """
+    Progress of a restore, sent to clients that set the PROGRESS flag. It
+    has the size of a MpsManagerResponse and the PROGRESS status, so the
+    client reads MpsManagerResponse sized frames until the status is not
+    PROGRESS. Holds the application id, the phase ('db', 'connect', 'put',
+    'retry', 'verify' or 'release'), the PVs done and total in the phase,
+    the seconds since the request was received and a message.
+    """
+    def __init__(self, device_id=0, phase='', done=0, total=0, elapsed=0.0, message=''):
+        self.status = int(MpsManagerResponseType.PROGRESS.value)
+        self.device_id = device_id
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.elapsed = elapsed
+        self.message = message
+
+        self.format = "ii20siif168s"
+        self.struct = Struct(self.format)
+
+    def size(self):
+        return calcsize(self.format)
+
+    def pack(self):
+        return self.struct.pack(self.status, self.device_id, self.phase, self.done,
+                                self.total, self.elapsed, self.message)
+
+    def unpack(self, data):
+        self.status, self.device_id, self.phase, self.done, self.total, self.elapsed, self.message = \
+            self.struct.unpack(data)
+        self.phase = self.phase.rstrip('\0')
+        self.message = self.message.rstrip('\0')
+
+    def to_string(self):
+        return '{} {}/{} ({:.3f}s) {}'.format(self.phase, self.done, self.total,
+                                              self.elapsed, self.message)
+
 class MpsManagerRequest():
     def __init__(self, request_type=100, request_device_id=0, request_device_name="None"):
         self.request_type = request_type # int
@@ -46,6 +131,77 @@ class MpsManagerRequest():
     def to_string(self):
         return 'message.to_string() TDB'
 
+class MpsManagerRequestTag():
+    def __init__(self, request_id=0):
+        self.request_id = request_id # int
+
+        self.format = "i"
+        self.struct = Struct(self.format)
+
+    def size(self):
+        return calcsize(self.format)
+
+    def pack(self):
+        return self.struct.pack(self.request_id)
+
+    def unpack(self, data):
+        self.request_id, = self.struct.unpack(data)
+
+class MpsManagerTaggedResponse():
+    """
+    Reply to a tagged request: the request id and the length of the data
+    that follows, which holds the same messages sent in reply to the
+    untagged request (e.g. MpsManagerResponse + MpsManagerThresholdRequest
+    for GET_THRESHOLD)
+    """
+    def __init__(self, request_id=0, data=''):
+        self.request_id = request_id
+        self.data = data
+
+        self.format = "ii"
+        self.struct = Struct(self.format)
+
+    def size(self):
+        return calcsize(self.format)
+
+    def pack(self):
+        return self.struct.pack(self.request_id, len(self.data)) + self.data
+
+    def unpack(self, data):
+        """
+        Unpacks the header, returns the length of the data that follows
+        """
+        self.request_id, length = self.struct.unpack(data)
+        return length
+
+class MpsManagerStatsResponse():
+    """
+    Reply to a STATS request: the length of the data that follows, which is
+    the JSON encoded statistics dict
+    """
+    def __init__(self, stats=None):
+        self.stats = stats
+
+        self.format = "i"
+        self.struct = Struct(self.format)
+
+    def size(self):
+        return calcsize(self.format)
+
+    def pack(self):
+        data = json.dumps(self.stats)
+        return self.struct.pack(len(data)) + data
+
+    def unpack(self, data):
+        """
+        Unpacks the header, returns the length of the data that follows
+        """
+        length, = self.struct.unpack(data)
+        return length
+
+    def unpack_stats(self, data):
+        self.stats = json.loads(data)
+
 class MpsManagerResponse():
     def __init__(self, status=0, device_id=0, status_message=''):
         self.status = status
@@ -17,6 +17,9 @@ import socket
 from ctypes import *
 from struct import *
 
+def show_progress(frame):
+  print('  {}'.format(frame.to_string()))
+
 #=== main ==================================================================================
 
 parser = argparse.ArgumentParser(description='restore thresholds for analog applications',
@@ -24,6 +27,10 @@ parser = argparse.ArgumentParser(description='restore thresholds for analog appl
 
 parser.add_argument('--app-id', metavar='app_id', type=int, nargs='?', required=True,
                     help='global application id')
+parser.add_argument('--progress', action='store_true', default=False, dest='progress',
+                    help='Print the restore progress sent by the server')
+parser.add_argument('--timeout', metavar='seconds', type=float, default=None, dest='timeout',
+                    help='With --progress, fail if nothing is received from the server for\nthis many seconds (default=wait forever)')
 parser.add_argument('--port', metavar='port', type=int, default=1975, nargs='?', help='server port (default=1975)')
 parser.add_argument('--host', metavar='host', type=str, default='lcls-daemon2', nargs='?', help='server port (default=lcls-daemon2)')
 
@@ -31,6 +38,10 @@ args = parser.parse_args()
 
 rm = ThresholdManagerClient(host=args.host, port=args.port)
 
-if (rm.restore(args.app_id) == False):
+progress = None
+if (args.progress):
+  progress = show_progress
+
+if (rm.restore(args.app_id, progress, args.timeout) == False):
   exit(3)
 
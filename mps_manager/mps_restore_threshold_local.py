@@ -7,6 +7,13 @@
 # 1 - Failed to restore one or more PVs
 # 2 - Failed to check on or more PVs
 #
+# With --all, --crate or --app-ids many applications are restored by one
+# run: the databases are opened once, the applications are read from them
+# one after the other and their PVs are connected and written in parallel
+# (at most --jobs applications at a time) by a RestoreCoordinator. A
+# summary with the outcome and timing of each application is printed at
+# the end, the exit code is 1 if any application failed.
+#
 
 from mps_config import MPSConfig, models, runtime
 from mps_names import MpsName
@@ -20,12 +27,115 @@ import os
 import re
 import subprocess
 import yaml
+import Queue
 import epics
 from epics import PV
 from argparse import RawTextHelpFormatter
+from tabulate import tabulate
 from threshold_restorer import ThresholdRestorer
+from restore_coordinator import RestoreCoordinator
+from restore_policy import RestorePolicy
 from mps_manager import DatabaseReader
 
+def get_app_ids(session, args):
+  """
+  Returns the global ids of the applications selected by --all, --crate
+  or --app-ids (--all and --crate select only applications with analog
+  channels, the others have no thresholds)
+  """
+  if (args.app_ids != None):
+    return args.app_ids
+
+  app_ids = []
+  for app in session.query(models.ApplicationCard).all():
+    if (len(app.analog_channels) == 0):
+      continue
+    if (args.crate != None and args.crate != app.crate.get_name() and
+        args.crate != str(app.crate.crate_id)):
+      continue
+    app_ids.append(app.global_id)
+  return sorted(app_ids)
+
+def restore_apps(dbr, app_ids, args, policy):
+  """
+  Restores the applications, at most args.jobs at a time. The database is
+  read by this thread (the sessions are not shared), the coordinator
+  thread connects and writes the PVs of the applications already read.
+  Returns a list with the outcome of each application.
+  """
+  coordinator = RestoreCoordinator('BulkRestore', thread_init=epics.ca.use_initial_context)
+  finished = Queue.Queue()
+  pending = list(app_ids)
+  results = {} # app_id -> result
+  active = 0
+  try:
+    while (len(pending) > 0 or active > 0):
+      while (len(pending) > 0 and active < args.jobs):
+        app_id = pending.pop(0)
+        tr = ThresholdRestorer(dbr.session, dbr.rt_session, dbr.mps_names, args.force_write,
+                               args.verbose, differential=args.differential, policy=policy)
+        result = {'app_id': app_id, 'start': time.time(), 'restorer': tr}
+        results[app_id] = result
+        restore_list = tr.prepare(app_id)
+        if (restore_list == None):
+          tr.close()
+          finish_app(result, False, tr.error_message or 'nothing to restore')
+          continue
+        result['pvs'] = 2 * len(restore_list)
+        coordinator.submit(tr, restore_list,
+                           lambda job, app_id=app_id: finished.put((app_id, job)))
+        active += 1
+
+      if (active > 0):
+        app_id, job = finished.get()
+        active -= 1
+        check_app(results[app_id], job, args)
+  finally:
+    coordinator.stop()
+
+  return [results[app_id] for app_id in app_ids]
+
+def check_app(result, job, args):
+  """
+  Called once the coordinator is done with the application PVs, reads the
+  thresholds back if requested (-c)
+  """
+  tr = job.restorer
+  result['attempts'] = job.attempt
+  try:
+    if (not job.ok):
+      finish_app(result, False, tr.error_message)
+    elif (args.check and not tr.check(result['app_id'])):
+      finish_app(result, False, tr.error_message or 'check failed')
+    else:
+      finish_app(result, True)
+  finally:
+    tr.close()
+
+def finish_app(result, ok, error=''):
+  result['ok'] = ok
+  result['error'] = error.replace('\n', ' ').strip()
+  result['total'] = time.time() - result['start']
+  print('App {}: {} ({:.3f}s)'.format(result['app_id'], 'restored' if ok else 'FAILED',
+                                      result['total']))
+
+def show_summary(results):
+  table = [['App', 'Status', 'PVs', 'Attempts', 'Total', 'DB', 'Connect', 'Put', 'Verify', 'Error']]
+  for result in results:
+    times = result['restorer'].timing.times
+    table.append([result['app_id'], 'OK' if result['ok'] else 'FAILED',
+                  result.get('pvs', 0), result.get('attempts', 0),
+                  '{:.3f}'.format(result['total'])] +
+                 ['{:.3f}'.format(times.get(phase, 0.0))
+                  for phase in ['db', 'pv_connect', 'pv_put', 'verify']] +
+                 [result['error'][:60]])
+  print(tabulate(table, headers='firstrow', tablefmt='simple'))
+
+  failed = [result['app_id'] for result in results if not result['ok']]
+  print('{} applications restored, {} failed{}'.\
+          format(len(results) - len(failed), len(failed),
+                 '' if len(failed) == 0 else ': ' + ' '.join([str(app_id) for app_id in failed])))
+
 #=== MAIN ==================================================================================
 
 parser = argparse.ArgumentParser(description='Restore threshold values from the runtime database (without connecting to MpsManager)',
@@ -34,10 +144,22 @@ parser.add_argument('database', metavar='db', type=file, nargs=1,
                     help='database file name (e.g. mps_gun.db, where the runtime database is named mps_gun_runtime.db')
 
 parser.add_argument('--app-id', metavar='ID', type=int, nargs='?', help='application global id')
+parser.add_argument('--app-ids', metavar='ID', type=int, nargs='+', default=None,
+                    help='restore the listed applications (global ids)')
+parser.add_argument('--crate', metavar='CRATE', type=str, default=None,
+                    help='restore the applications in the crate (crate name or id)')
+parser.add_argument('--all', action='store_true', default=False, dest='all',
+                    help='restore all the applications with analog channels')
+parser.add_argument('--jobs', metavar='N', type=int, default=16,
+                    help='with --all/--crate/--app-ids, applications restored at the\nsame time (default=16)')
+parser.add_argument('--connect-timeout', metavar='seconds', type=float, default=20,
+                    help='seconds to wait for the PVs of an application to connect\n(default=20)')
 parser.add_argument('-c', action='store_true', default=False, dest='check',
                     help='read back threshold values from PV and compare with runtime database thresholds')
 parser.add_argument('-f', action='store_true', default=False, dest='force_write',
                     help='restore thresholds even if PVs are not writable (changes only the database)')
+parser.add_argument('-d', action='store_true', default=False, dest='differential',
+                    help='read the thresholds from the IOC and write only those that differ from the runtime database')
 parser.add_argument('-v', action='store_true', default=False,
                     dest='verbose', help='verbose output')
 
@@ -53,7 +175,22 @@ rt_file_name = '{}/{}_runtime.db'.format(os.path.dirname(db_file_name),
 
 dbr = DatabaseReader(db_file_name, rt_file_name)
 
-tr = ThresholdRestorer(dbr.session, dbr.rt_session, dbr.mps_names, args.force_write, args.verbose)
+if (args.all or args.crate != None or args.app_ids != None):
+  app_ids = get_app_ids(dbr.session, args)
+  if (len(app_ids) == 0):
+    print('ERROR: No applications selected')
+    exit(1)
+  start = time.time()
+  results = restore_apps(dbr, app_ids, args,
+                         RestorePolicy(connect_timeout=args.connect_timeout, max_attempts=1))
+  show_summary(results)
+  print('Total time: {:.3f}s'.format(time.time() - start))
+  if (len([result for result in results if not result['ok']]) > 0):
+    exit(1)
+  exit(0)
+
+tr = ThresholdRestorer(dbr.session, dbr.rt_session, dbr.mps_names, args.force_write, args.verbose,
+                       differential=args.differential, connect_timeout=args.connect_timeout)
 
 if (not tr.restore(args.app_id)):
   exit(1)
@@ -0,0 +1,253 @@
+import threading
+import time
+import warnings
+import epics
+
+# GetBatch.poll() checks for replies with a zero timeout, pyepics warns
+# each time one is still pending
+warnings.filterwarnings('ignore', message=r"ca\.get\('.*'\) timed out after 0\.00 seconds")
+
+class ConnectionWait:
+  """
+  Tracks the connection of a set of PVs: a connection callback is added to
+  each PV, calling notify() (if given) whenever one of them connects, and
+  update() returns True once all are connected. close() removes the
+  callbacks.
+  """
+  def __init__(self, pvs, notify=None):
+    self.pvs = list(pvs)
+    self.missing = list(pvs)
+    self.notify = notify
+    for pv in self.pvs:
+      pv.connection_callbacks.append(self.on_connection)
+
+  def on_connection(self, pvname=None, conn=None, **kws):
+    if (self.notify != None):
+      self.notify()
+
+  def update(self):
+    self.missing = [pv for pv in self.missing if not pv.connected]
+    return len(self.missing) == 0
+
+  def close(self):
+    for pv in self.pvs:
+      if (self.on_connection in pv.connection_callbacks):
+        pv.connection_callbacks.remove(self.on_connection)
+
+class PutBatch:
+  """
+  Writes many PVs at once: start() issues all puts without waiting, the
+  completion callbacks mark each put as done and call notify() (if given).
+  puts is a list of (pv, value). finish() returns the outcome of each put,
+  in the same order: None if the put completed, or the error ('read-only',
+  'not connected', 'timeout' or the exception message).
+  """
+  def __init__(self, puts, notify=None):
+    self.puts = puts
+    self.notify = notify
+    self.lock = threading.Lock()
+    self.results = [None] * len(puts)
+    self.completed = [False] * len(puts)
+    self.pending = 0
+
+  def start(self):
+    for index, (pv, value) in enumerate(self.puts):
+      if (not pv.connected):
+        self.complete(index, 'not connected')
+        continue
+
+      self.lock.acquire()
+      self.pending += 1
+      self.lock.release()
+      try:
+        pv.put(value, wait=False, use_complete=True,
+               callback=self.on_put_complete, callback_data=index)
+      except epics.ca.CASeverityException:
+        self.complete(index, 'read-only', True)
+      except Exception as e:
+        self.complete(index, str(e), True)
+
+  def complete(self, index, error=None, issued=False):
+    self.lock.acquire()
+    if (not self.completed[index]):
+      self.completed[index] = True
+      self.results[index] = error
+      if (issued):
+        self.pending -= 1
+    self.lock.release()
+
+  def on_put_complete(self, pvname=None, data=None, **kws):
+    self.complete(data, None, True)
+    if (self.notify != None):
+      self.notify()
+
+  def count_completed(self):
+    self.lock.acquire()
+    count = self.completed.count(True)
+    self.lock.release()
+    return count
+
+  def done(self):
+    self.lock.acquire()
+    pending = self.pending
+    self.lock.release()
+    return pending == 0
+
+  def finish(self):
+    """
+    Marks the puts still pending as timed out, returns the results
+    """
+    self.lock.acquire()
+    for index in range(len(self.puts)):
+      if (not self.completed[index]):
+        self.completed[index] = True
+        self.results[index] = 'timeout'
+    self.pending = 0
+    self.lock.release()
+    return self.results
+
+class GetBatch:
+  """
+  Reads many PVs at once without waiting: start() sends the read requests
+  of all the connected PVs, poll() collects the replies received so far
+  and returns True once all are in. There is no completion callback for
+  reads, poll() must be called again to see new replies. finish() returns
+  the value of each PV, in the same order (None for PVs not connected or
+  not answered).
+  """
+  def __init__(self, pvs):
+    self.pvs = list(pvs)
+    self.values = [None] * len(self.pvs)
+    self.pending = [] # indexes of the PVs read, in request order
+    self.issued = 0
+
+  def start(self):
+    for index, pv in enumerate(self.pvs):
+      if (not pv.connected):
+        continue
+      try:
+        epics.ca.get(pv.chid, wait=False)
+        self.pending.append(index)
+      except Exception:
+        pass
+    self.issued = len(self.pending)
+
+  def collect(self, index):
+    """
+    Returns True if the read of the PV at index is over (value stored)
+    """
+    try:
+      value = epics.ca.get_complete(self.pvs[index].chid, timeout=0)
+      if (value is None):
+        return False
+    except Exception:
+      value = None
+    self.values[index] = value
+    return True
+
+  def poll(self):
+    """
+    Collects the replies received, never blocks. An IOC answers in request
+    order, the pass stops at the first reply missing.
+    """
+    while (len(self.pending) > 0 and self.collect(self.pending[0])):
+      self.pending.pop(0)
+    return len(self.pending) == 0
+
+  def count_completed(self):
+    return self.issued - len(self.pending)
+
+  def finish(self):
+    """
+    Collects all the replies received, the reads still pending are given up,
+    returns the values
+    """
+    for index in self.pending:
+      self.collect(index)
+    self.pending = []
+    return self.values
+
+def wait_for(check, timeout, start):
+  """
+  Calls start(notify) and waits until check() returns True or timeout
+  seconds have passed, waking up each time notify() is called
+  """
+  cond = threading.Condition(threading.Lock())
+
+  def notify():
+    cond.acquire()
+    cond.notify_all()
+    cond.release()
+
+  deadline = time.time() + timeout
+  start(notify)
+  cond.acquire()
+  try:
+    while (not check()):
+      remaining = deadline - time.time()
+      if (remaining <= 0):
+        break
+      cond.wait(remaining)
+  finally:
+    cond.release()
+
+def wait_connected(pvs, timeout):
+  """
+  Waits until all the PVs are connected, or until timeout seconds have
+  passed. Instead of polling, the wait is woken up by the PV connection
+  callbacks, so it returns as soon as the last PV connects. Returns the
+  list of PVs still not connected (empty if all are).
+  """
+  waits = []
+  def start(notify):
+    waits.append(ConnectionWait(pvs, notify))
+
+  try:
+    wait_for(lambda: waits[0].update(), timeout, start)
+  finally:
+    waits[0].close()
+  return waits[0].missing
+
+def put_many(puts, timeout):
+  """
+  Writes many PVs at once (see PutBatch) and waits for all the puts to
+  complete, with a single deadline, so the total time is about one network
+  round trip instead of one per PV. Returns the outcome of each put.
+  """
+  batches = []
+  def start(notify):
+    batches.append(PutBatch(puts, notify))
+    batches[0].start()
+
+  wait_for(lambda: batches[0].done(), timeout, start)
+  return batches[0].finish()
+
+def get_many(pvs, timeout):
+  """
+  Reads many PVs at once: the read requests of all the connected PVs are
+  sent before waiting for any reply, and the replies are collected with a
+  single deadline. Returns the value of each PV, in the same order (None
+  for PVs not connected or not answered in time).
+  """
+  issued = []
+  for pv in pvs:
+    requested = False
+    if (pv.connected):
+      try:
+        epics.ca.get(pv.chid, wait=False)
+        requested = True
+      except Exception:
+        pass
+    issued.append(requested)
+
+  deadline = time.time() + timeout
+  values = []
+  for pv, requested in zip(pvs, issued):
+    value = None
+    if (requested):
+      try:
+        value = epics.ca.get_complete(pv.chid, timeout=max(deadline - time.time(), 0.001))
+      except Exception:
+        pass
+    values.append(value)
+  return values
@@ -0,0 +1,98 @@
+import threading
+import time
+from epics import PV
+
+class PVCache:
+  """
+  Process-wide cache of channel access PVs, so requests on the same device
+  or application reuse connected channels instead of searching and
+  connecting them again every time.
+
+  get() returns the PV for a name (creating it on first use) and counts the
+  reference, release() drops the reference instead of disconnecting. PVs
+  without references for more than max_idle seconds are disconnected by
+  prune() (called by the housekeeping), and the least recently used ones
+  are disconnected as soon as there are more than max_size PVs. PVs of an
+  IOC that reboots stay in the cache and reconnect by themselves, the
+  requests wait for them with connection callbacks.
+  """
+  def __init__(self, max_size=20000, max_idle=600):
+    self.max_size = max_size
+    self.max_idle = max_idle
+    self.lock = threading.Lock()
+    self.entries = {} # pv name -> [pv, references, last release time]
+    self.created = 0
+    self.hits = 0
+    self.evicted = 0
+
+  def get(self, pv_name):
+    self.lock.acquire()
+    entry = self.entries.get(pv_name)
+    if (entry == None):
+      entry = [PV(pv_name), 0, time.time()]
+      self.entries[pv_name] = entry
+      self.created += 1
+    else:
+      self.hits += 1
+    entry[1] += 1
+    self.lock.release()
+    return entry[0]
+
+  def release(self, pv):
+    self.lock.acquire()
+    entry = self.entries.get(pv.pvname)
+    if (entry == None or entry[0] is not pv):
+      self.lock.release()
+      pv.disconnect() # Not from the cache (or already evicted)
+      return
+
+    entry[1] -= 1
+    entry[2] = time.time()
+    evicted = []
+    if (len(self.entries) > self.max_size):
+      evicted = self.evict(len(self.entries) - self.max_size)
+    self.lock.release()
+
+    for pv in evicted:
+      pv.disconnect()
+
+  def evict(self, count, idle_since=None):
+    """
+    Removes up to count unreferenced PVs (only those released before
+    idle_since if given), least recently used first. Must be called with
+    the lock held, returns the PVs to disconnect.
+    """
+    idle = [(entry[2], name) for name, entry in self.entries.items()
+            if entry[1] <= 0 and (idle_since == None or entry[2] < idle_since)]
+    idle.sort()
+    evicted = []
+    for last_used, name in idle[:count]:
+      evicted.append(self.entries.pop(name)[0])
+    self.evicted += len(evicted)
+    return evicted
+
+  def prune(self):
+    """
+    Disconnects the PVs not used for more than max_idle seconds
+    """
+    self.lock.acquire()
+    evicted = self.evict(len(self.entries), time.time() - self.max_idle)
+    self.lock.release()
+
+    for pv in evicted:
+      pv.disconnect()
+
+  def get_stats(self, reset=False):
+    self.lock.acquire()
+    stats = {'pvs': len(self.entries),
+             'in_use': len([entry for entry in self.entries.values() if entry[1] > 0]),
+             'connected': len([entry for entry in self.entries.values() if entry[0].connected]),
+             'created': self.created,
+             'hits': self.hits,
+             'evicted': self.evicted}
+    if (reset):
+      self.created = 0
+      self.hits = 0
+      self.evicted = 0
+    self.lock.release()
+    return stats
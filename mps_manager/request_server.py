@@ -0,0 +1,338 @@
+import socket
+import select
+import errno
+import time
+import os
+import threading
+from collections import deque
+
+class Connection:
+  """
+  Client connection handled by the RequestServer, holds the bytes received
+  so far for the request being assembled, and the replies to pipelined
+  requests waiting to be sent
+  """
+  def __init__(self, sock, ip, port):
+    self.sock = sock
+    self.fileno = sock.fileno()
+    self.ip = ip
+    self.port = port
+    self.data = ''
+    self.requests = 0
+    self.pending = 0 # pipelined requests being processed
+    self.closing = False # input discarded, shut down once the replies are sent
+    self.out = ''
+    self.lock = threading.Lock() # protects pending and out
+    self.last_activity = time.time()
+
+class RequestServer:
+  """
+  Non-blocking network front end for the MpsManager. Connections are accepted
+  and request frames are assembled from a poll() loop, so a slow or stalled
+  client never delays the others.
+
+  A regular request is handed with its connection to the dispatch function
+  (which queues the database and PV work on the worker pools) and the
+  connection is removed from the loop. When the worker is done with the
+  request it calls resume() and the connection goes back to the loop to wait
+  for the next request from the same client, until the client closes it, the
+  idle timeout expires or max_requests have been served.
+
+  A pipelined request is handed to dispatch_pipelined without the socket,
+  the connection stays in the loop and further requests are read and
+  dispatched while the previous ones are processed. Workers send the replies
+  with reply(), in any order, and the loop writes them out.
+
+  frame_size: function(data) returning (size, pipelined) for the request
+              frame starting with data, data may hold only part of the frame
+  dispatch: function(data, sock, ip, port) called with each complete request
+  dispatch_pipelined: function(data, conn, ip, port) called with each
+                      complete pipelined request, returns False if nothing
+                      more can be read from the connection (e.g. the request
+                      is not entirely part of the frame), the connection is
+                      then shut down once the pending replies are sent
+  expire_interval: how often (seconds) connections are checked for timeouts
+  frame_timeout: connections that don't complete a request within this
+                 many seconds are closed
+  idle_timeout: connections without requests for this many seconds are closed
+  max_requests: number of regular requests served by a connection before it
+                is closed, pipelined requests are not counted (a client may
+                send any number of them on one connection)
+  max_pipelined: requests from a connection processed at the same time, no
+                 more requests are read from it until replies are sent
+  """
+  def __init__(self, tcp_server, frame_size, dispatch, dispatch_pipelined, log,
+               expire_interval=5, frame_timeout=10, idle_timeout=60,
+               max_requests=100, max_pipelined=256, backlog=socket.SOMAXCONN):
+    self.tcp_server = tcp_server
+    self.frame_size = frame_size
+    self.dispatch = dispatch
+    self.dispatch_pipelined = dispatch_pipelined
+    self.log = log
+    self.expire_interval = expire_interval
+    self.frame_timeout = frame_timeout
+    self.idle_timeout = idle_timeout
+    self.max_requests = max_requests
+    self.max_pipelined = max_pipelined
+    self.backlog = backlog
+    self.connections = {} # fileno -> Connection, polled by the loop
+    self.busy = {} # fileno -> Connection, owned by a worker
+    self.busy_lock = threading.Lock()
+    self.resumed = deque() # Connections returned by the workers
+    self.replied = deque() # Connections with new replies to send
+    self.wake_read, self.wake_write = os.pipe()
+    self.poller = select.poll()
+    self.done = False
+
+  def run(self):
+    self.tcp_server.setblocking(0)
+    self.tcp_server.listen(self.backlog)
+    self.poller.register(self.tcp_server.fileno(), select.POLLIN)
+    self.poller.register(self.wake_read, select.POLLIN)
+    next_expire = time.time() + self.expire_interval
+
+    while not self.done:
+      timeout = max(0, next_expire - time.time())
+      try:
+        events = self.poller.poll(timeout * 1000)
+      except select.error as e:
+        if (e.args[0] == errno.EINTR):
+          continue
+        raise
+
+      for fd, event in events:
+        if (fd == self.tcp_server.fileno()):
+          self.accept()
+        elif (fd == self.wake_read):
+          os.read(self.wake_read, 4096)
+          self.add_resumed()
+          self.add_replied()
+        elif (fd in self.connections):
+          conn = self.connections[fd]
+          if (event & (select.POLLERR | select.POLLNVAL)):
+            self.close(conn)
+            continue
+          if (event & select.POLLOUT):
+            self.flush(conn)
+          if (event & (select.POLLIN | select.POLLHUP) and fd in self.connections):
+            self.receive(conn)
+
+      now = time.time()
+      if (now >= next_expire):
+        self.expire(now)
+        next_expire = now + self.expire_interval
+
+  def add(self, conn):
+    conn.data = ''
+    conn.last_activity = time.time()
+    self.connections[conn.fileno] = conn
+    self.poller.register(conn.fileno, select.POLLIN)
+
+  def update(self, conn):
+    """
+    Sets the poll events for the connection: stop reading while too many
+    pipelined requests are being processed, and wait for the socket to be
+    writable while there are replies to send
+    """
+    conn.lock.acquire()
+    pending = conn.pending
+    has_output = len(conn.out) > 0
+    conn.lock.release()
+
+    if (not has_output and pending == 0):
+      if (conn.closing):
+        # The client reads the replies up to the end of the stream and closes
+        # the connection (otherwise closed by expire())
+        try:
+          conn.sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+          self.close(conn)
+          return
+      elif (conn.requests >= self.max_requests):
+        self.close(conn)
+        return
+
+    events = 0
+    if (conn.closing or
+        (pending < self.max_pipelined and conn.requests < self.max_requests)):
+      events |= select.POLLIN
+    if (has_output):
+      events |= select.POLLOUT
+    self.poller.modify(conn.fileno, events)
+
+  def accept(self):
+    """
+    Accepts all pending connections
+    """
+    while True:
+      try:
+        (sock, (ip, port)) = self.tcp_server.accept()
+      except socket.error as e:
+        if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+          self.log('ERROR: Failed to accept connection ({})'.format(str(e)))
+        return
+
+      sock.setblocking(0)
+      self.add(Connection(sock, ip, port))
+
+  def receive(self, conn):
+    if (conn.closing):
+      # Whatever follows is discarded (closing the socket with unread data
+      # would reset the connection and drop the replies)
+      try:
+        data = conn.sock.recv(4096)
+      except socket.error as e:
+        if (e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+          return
+        data = ''
+      if (not data):
+        self.close(conn)
+      return
+
+    size, pipelined = self.frame_size(conn.data)
+    try:
+      # Never read past the end of the request, the worker reads whatever
+      # follows it (e.g. the thresholds of a CHANGE_THRESHOLD request)
+      data = conn.sock.recv(size - len(conn.data))
+    except socket.error as e:
+      if (e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+        return
+      self.close(conn)
+      return
+
+    if (not data):
+      self.close(conn)
+      return
+
+    conn.data += data
+    conn.last_activity = time.time()
+    size, pipelined = self.frame_size(conn.data)
+    if (len(conn.data) < size):
+      return
+
+    data = conn.data
+    conn.data = ''
+    if (pipelined):
+      conn.lock.acquire()
+      conn.pending += 1
+      conn.lock.release()
+      self.update(conn)
+      if (self.dispatch_pipelined(data, conn, conn.ip, conn.port) == False):
+        self.log('ERROR: Invalid request from {}:{}, closing connection'.format(conn.ip, conn.port))
+        conn.closing = True
+        self.update(conn)
+      return
+
+    conn.lock.acquire()
+    in_use = conn.pending > 0 or len(conn.out) > 0
+    conn.lock.release()
+    if (in_use):
+      self.log('ERROR: Request from {}:{} sent before the pipelined replies, closing connection'.\
+                 format(conn.ip, conn.port))
+      self.close(conn)
+      return
+
+    conn.requests += 1
+    self.remove(conn)
+    self.busy_lock.acquire()
+    self.busy[conn.fileno] = conn
+    self.busy_lock.release()
+    conn.sock.setblocking(1)
+    self.dispatch(data, conn.sock, conn.ip, conn.port)
+
+  def resume(self, sock, keep_alive=True, data=''):
+    """
+    Called by the workers when done with a request, the connection is either
+    returned to the loop to wait for the next request or closed. data, if
+    given, is the reply to the request, written by the loop without blocking
+    the caller (the connection is closed after it if max_requests have been
+    served). May be called from any thread.
+    """
+    self.busy_lock.acquire()
+    conn = self.busy.pop(sock.fileno(), None)
+    self.busy_lock.release()
+
+    if (conn == None or not keep_alive or
+        (conn.requests >= self.max_requests and len(data) == 0)):
+      sock.close()
+      return
+
+    conn.lock.acquire()
+    conn.out += data
+    conn.lock.release()
+    self.resumed.append(conn)
+    os.write(self.wake_write, 'r')
+
+  def add_resumed(self):
+    while (len(self.resumed) > 0):
+      conn = self.resumed.popleft()
+      conn.sock.setblocking(0)
+      self.add(conn)
+      self.update(conn)
+
+  def reply(self, conn, data, keep_alive=True):
+    """
+    Called by the workers with the reply to a pipelined request of conn, the
+    data is sent by the loop. If keep_alive is False no more requests are
+    read and the connection is shut down once the pending replies are sent.
+    May be called from any thread.
+    """
+    conn.lock.acquire()
+    conn.out += data
+    conn.pending -= 1
+    if (not keep_alive):
+      conn.closing = True
+    conn.lock.release()
+    self.replied.append(conn)
+    os.write(self.wake_write, 'w')
+
+  def add_replied(self):
+    while (len(self.replied) > 0):
+      conn = self.replied.popleft()
+      if (self.connections.get(conn.fileno) is conn):
+        conn.last_activity = time.time()
+        self.update(conn)
+
+  def flush(self, conn):
+    conn.lock.acquire()
+    try:
+      sent = conn.sock.send(conn.out)
+      conn.out = conn.out[sent:]
+    except socket.error as e:
+      if (e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+        conn.lock.release()
+        self.close(conn)
+        return
+    conn.lock.release()
+    self.update(conn)
+
+  def expire(self, now):
+    """
+    Closes connections that have been waiting for too long for a request
+    """
+    for conn in self.connections.values():
+      if (len(conn.data) > 0):
+        if (now - conn.last_activity > self.frame_timeout):
+          self.log('Closing stalled connection from {}:{}'.format(conn.ip, conn.port))
+          self.close(conn)
+      elif (conn.pending == 0 and len(conn.out) == 0 and
+            now - conn.last_activity > self.idle_timeout):
+        self.close(conn)
+
+  def remove(self, conn):
+    self.poller.unregister(conn.fileno)
+    del self.connections[conn.fileno]
+
+  def close(self, conn):
+    self.remove(conn)
+    conn.sock.close()
+
+  def get_stats(self):
+    self.busy_lock.acquire()
+    busy = len(self.busy)
+    self.busy_lock.release()
+    pipelined = sum([conn.pending for conn in self.connections.values()])
+    return {'idle': len(self.connections), 'busy': busy, 'pipelined': pipelined}
+
+  def stop(self):
+    self.done = True
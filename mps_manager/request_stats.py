@@ -0,0 +1,121 @@
+import threading
+import time
+
+class LatencyHistogram:
+  """
+  Histogram of durations (seconds) with exponential buckets: the first
+  bucket holds values up to 1ms and each following bucket doubles the
+  upper bound (the last one, ~17 minutes, also holds anything longer).
+  Percentiles are estimated as the upper bound of the bucket they fall in.
+  """
+  bounds = [0.001 * 2 ** i for i in range(21)]
+
+  def __init__(self):
+    self.buckets = [0] * len(self.bounds)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def record(self, value):
+    index = 0
+    while (index < len(self.bounds) - 1 and value > self.bounds[index]):
+      index += 1
+    self.buckets[index] += 1
+    self.count += 1
+    self.total += value
+    if (value > self.max):
+      self.max = value
+
+  def percentile(self, p):
+    if (self.count == 0):
+      return 0.0
+    rank = p * self.count / 100.0
+    seen = 0
+    for index, count in enumerate(self.buckets):
+      seen += count
+      if (seen >= rank and count > 0):
+        return min(self.bounds[index], self.max)
+    return self.max
+
+  def to_dict(self):
+    return {'count': self.count,
+            'avg': self.total / self.count if self.count > 0 else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': list(self.buckets)}
+
+class RequestTiming:
+  """
+  Time spent by one request in each phase ('queue', 'db', 'pv_connect',
+  'pv_put', 'verify'), the total time since the request was received and
+  the status of the reply. Handed to RequestStats.record() when the
+  request is done.
+  """
+  def __init__(self, request_name='NONE'):
+    self.request_name = request_name
+    self.received = time.time()
+    self.times = {}
+    self.started = {}
+    self.status = None
+
+  def start(self, phase):
+    self.started[phase] = time.time()
+
+  def stop(self, phase):
+    start = self.started.pop(phase, None)
+    if (start != None):
+      self.add(phase, time.time() - start)
+
+  def add(self, phase, seconds):
+    self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+class RequestStats:
+  """
+  Latency histograms per request type and phase, and the number of replies
+  per request type and status, collected from the RequestTimings of the
+  completed requests
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.histograms = {} # request name -> {phase -> LatencyHistogram}
+    self.statuses = {} # request name -> {status -> count}
+
+  def record(self, timing):
+    total = time.time() - timing.received
+    self.lock.acquire()
+    phases = self.histograms.setdefault(timing.request_name, {})
+    phases.setdefault('total', LatencyHistogram()).record(total)
+    for phase, seconds in timing.times.items():
+      phases.setdefault(phase, LatencyHistogram()).record(seconds)
+    if (timing.status != None):
+      statuses = self.statuses.setdefault(timing.request_name, {})
+      statuses[timing.status] = statuses.get(timing.status, 0) + 1
+    self.lock.release()
+
+  def get_stats(self, reset=False):
+    """
+    Returns a dict with the histogram summaries ('latency': request name ->
+    phase -> count/avg/p50/p90/p99/max/buckets), the reply counts
+    ('status': request name -> status -> count), the bucket bounds and the
+    period covered in seconds. If reset is True the statistics start over.
+    """
+    self.lock.acquire()
+    stats = {'period': time.time() - self.start_time,
+             'bounds': LatencyHistogram.bounds,
+             'latency': {},
+             'status': {}}
+    for request_name, phases in self.histograms.items():
+      stats['latency'][request_name] = {}
+      for phase, histogram in phases.items():
+        stats['latency'][request_name][phase] = histogram.to_dict()
+    for request_name, statuses in self.statuses.items():
+      stats['status'][request_name] = dict(statuses)
+    if (reset):
+      self.start_time = time.time()
+      self.histograms = {}
+      self.statuses = {}
+    self.lock.release()
+    return stats
@@ -0,0 +1,294 @@
+import threading
+import traceback
+import time
+
+from pv_batch import ConnectionWait, GetBatch, PutBatch
+
+class RestoreJob:
+  """
+  Restore of one application handled by the RestoreCoordinator: the
+  ThresholdRestorer holding the application (already prepared), its
+  restore list, the function called with the job when it is done, and
+  optionally the function called with the progress of each phase
+  (phase, done, total, message, final - see RestoreProgress.update()).
+  When done, ok tells if all PVs were connected and written (the error
+  is in restorer.error_message otherwise), attempt is the number of
+  attempts made and connect_time the seconds from the start until all PVs
+  were connected (None if they never were).
+  """
+  CONNECT = 'connect'
+  READ = 'read'
+  PUT_VALUES = 'put values'
+  PUT_ENABLE = 'put enable'
+  RETRY = 'retry'
+  DONE = 'done'
+
+  def __init__(self, restorer, restore_list, done, progress=None):
+    self.restorer = restorer
+    self.restore_list = restore_list
+    self.done = done
+    self.progress = progress
+    self.state = None
+    self.ok = False
+    self.start = time.time()
+    self.attempt = 0
+    self.connect_time = None
+    self.deadline = 0.0
+    self.phase_start = 0.0
+    self.connection = None
+    self.reads = None # GetBatch of the current IOC values (differential restore)
+    self.enable_puts = None # written once the value puts are done
+    self.values_written = 0
+    self.puts = None
+    self.batch = None
+
+class RestoreCoordinator:
+  """
+  Runs the channel access part (PV connection, threshold value puts and
+  enable puts) of many application restores at the same time from a
+  single thread, without holding a worker per restore.
+
+  Jobs are advanced by the connection and put callbacks: as soon as all
+  PVs of an application are connected its value puts are issued, once
+  those complete its enable puts, all jobs that are ready in the same pass
+  are issued together. Each job has its own deadlines and result, an IOC
+  that is late or failing does not hold back the others, so many
+  restores complete in about the time of the slowest one. A failed
+  attempt is retried after a backoff, as allowed by the restorer policy
+  (see RestorePolicy). For
+  differential restores (see ThresholdRestorer.get_puts()) the IOC values
+  are read before the value puts are issued, the reads of all the jobs are
+  in flight at the same time and checked every read_poll seconds (there is
+  no completion callback for reads), for at most the restorer diff_timeout.
+
+  thread_init: optional function called once by the thread when it starts
+               (e.g. to attach the thread to the channel access context)
+  """
+  progress_interval = 1.0 # jobs are advanced (and report progress) at least this often
+  read_poll = 0.01 # pending reads are checked this often
+
+  def __init__(self, name='Restore', log=None, thread_init=None):
+    self.name = name
+    self.log = log
+    self.thread_init = thread_init
+    self.cond = threading.Condition(threading.Lock())
+    self.new_jobs = []
+    self.jobs = []
+    self.changed = False
+    self.done = False
+    self.completed = 0
+    self.failed = 0
+    self.max_jobs = 0
+    self.thread = threading.Thread(target=self.run, name=name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, restorer, restore_list, done, progress=None):
+    """
+    Starts restoring restore_list (from restorer.prepare()), done(job) is
+    called from the coordinator thread when finished
+    """
+    job = RestoreJob(restorer, restore_list, done, progress)
+    self.cond.acquire()
+    self.new_jobs.append(job)
+    self.changed = True
+    self.cond.notify()
+    self.cond.release()
+    return job
+
+  def notify(self):
+    """
+    Called by the PV connection/put callbacks
+    """
+    self.cond.acquire()
+    self.changed = True
+    self.cond.notify()
+    self.cond.release()
+
+  def run(self):
+    if (self.thread_init != None):
+      self.thread_init()
+
+    while not self.done:
+      self.cond.acquire()
+      if (not self.changed):
+        timeout = self.progress_interval
+        if (len(self.jobs) > 0):
+          timeout = max(0, min([job.deadline for job in self.jobs] +
+                               [time.time() + self.progress_interval]) - time.time())
+          if (RestoreJob.READ in [job.state for job in self.jobs]):
+            timeout = min(timeout, self.read_poll)
+        self.cond.wait(timeout)
+      self.changed = False
+      new_jobs = self.new_jobs
+      self.new_jobs = []
+      self.cond.release()
+
+      for job in new_jobs:
+        self.connect(job)
+      self.jobs += new_jobs
+      if (len(self.jobs) > self.max_jobs):
+        self.max_jobs = len(self.jobs)
+
+      now = time.time()
+      for job in list(self.jobs):
+        try:
+          self.advance(job, now)
+        except Exception as e:
+          job.restorer.error_message = 'ERROR: Restore failed ({})'.format(str(e))
+          if (self.log != None):
+            self.log('ERROR: {} job failed: {}\n{}'.\
+                       format(self.name, str(e), traceback.format_exc()))
+          self.finish(job, False)
+
+  def connect(self, job):
+    tr = job.restorer
+    job.attempt += 1
+    tr.put_results = []
+    job.state = RestoreJob.CONNECT
+    job.phase_start = time.time()
+    job.deadline = job.phase_start + tr.connect_timeout
+    job.connection = ConnectionWait(tr.get_restore_pvs(job.restore_list), self.notify)
+
+  def read(self, job):
+    job.state = RestoreJob.READ
+    job.phase_start = time.time()
+    job.deadline = job.phase_start + job.restorer.diff_timeout
+    job.reads = GetBatch(job.connection.pvs)
+    job.reads.start()
+    if (job.reads.poll()):
+      self.notify() # All read already (e.g. nothing to read), advance again
+
+  def put(self, job, state, puts):
+    job.state = state
+    job.phase_start = time.time()
+    job.deadline = job.phase_start + job.restorer.put_timeout
+    job.puts = puts
+    job.batch = PutBatch(puts, self.notify)
+    job.batch.start()
+    if (job.batch.done()):
+      self.notify() # No puts pending (e.g. nothing to write), advance again
+
+  def advance(self, job, now):
+    tr = job.restorer
+    if (job.state == RestoreJob.CONNECT):
+      connected = job.connection.update()
+      total = len(job.connection.pvs)
+      if (not connected and now < job.deadline):
+        self.report(job, 'connect', total - len(job.connection.missing), total)
+        return
+      self.report(job, 'connect', total - len(job.connection.missing), total, final=True)
+      job.connection.close()
+      tr.timing.add('pv_connect', now - job.phase_start)
+      if (not tr.check_connected(job.connection.pvs, job.connection.missing)):
+        self.retry(job, now)
+        return
+      if (job.connect_time == None):
+        job.connect_time = now - job.start
+      if (tr.differential):
+        self.read(job)
+        return
+      value_puts, job.enable_puts = tr.get_puts(job.restore_list)
+      self.put(job, RestoreJob.PUT_VALUES, value_puts)
+
+    elif (job.state == RestoreJob.READ):
+      total = len(job.reads.pvs)
+      if (not job.reads.poll() and now < job.deadline):
+        self.report(job, 'read', job.reads.count_completed(), total)
+        return
+      values = job.reads.finish()
+      self.report(job, 'read', len([value for value in values if value is not None]), total,
+                  final=True)
+      tr.timing.add('pv_put', now - job.phase_start)
+      value_puts, job.enable_puts = tr.get_puts(job.restore_list, values)
+      self.put(job, RestoreJob.PUT_VALUES, value_puts)
+
+    elif (job.state == RestoreJob.PUT_VALUES or job.state == RestoreJob.PUT_ENABLE):
+      done = job.batch.count_completed()
+      total = len(job.enable_puts)
+      if (job.state == RestoreJob.PUT_VALUES):
+        total += len(job.puts)
+      else:
+        done += job.values_written
+        total += job.values_written
+      if (not job.batch.done() and now < job.deadline):
+        self.report(job, 'put', done, total)
+        return
+      tr.timing.add('pv_put', now - job.phase_start)
+      if (not tr.check_put_results(job.puts, job.batch.finish())):
+        self.retry(job, now)
+        return
+      if (job.state == RestoreJob.PUT_VALUES):
+        job.values_written = len(job.puts)
+        self.report(job, 'put', job.values_written, total)
+        self.put(job, RestoreJob.PUT_ENABLE, job.enable_puts)
+      else:
+        self.report(job, 'put', total, total, final=True)
+        self.finish(job, True)
+
+    elif (job.state == RestoreJob.RETRY):
+      if (now < job.deadline):
+        return
+      self.connect(job)
+
+  def retry(self, job, now):
+    """
+    Schedules the next attempt of a failed job after the policy backoff,
+    or finishes it if no more attempts are allowed
+    """
+    policy = job.restorer.policy
+    if (not policy.retry(job.attempt, now - job.start)):
+      self.finish(job, False)
+      return
+
+    job.state = RestoreJob.RETRY
+    job.deadline = now + policy.get_backoff(job.attempt)
+    self.report(job, 'retry', job.attempt, policy.max_attempts,
+                job.restorer.error_message, final=True)
+    if (self.log != None):
+      self.log('{}: attempt {} failed, retrying in {:.1f}s ({})'.\
+                 format(self.name, job.attempt, job.deadline - now,
+                        job.restorer.error_message))
+
+  def report(self, job, phase, done, total, message='', final=False):
+    if (job.progress != None):
+      job.progress(phase, done, total, message, final)
+
+  def finish(self, job, ok):
+    if (job.connection != None):
+      job.connection.close()
+    job.state = RestoreJob.DONE
+    job.ok = ok
+    if (job in self.jobs):
+      self.jobs.remove(job)
+    if (ok):
+      self.completed += 1
+    else:
+      self.failed += 1
+
+    try:
+      job.done(job)
+    except Exception as e:
+      if (self.log != None):
+        self.log('ERROR: {} done callback failed: {}\n{}'.\
+                   format(self.name, str(e), traceback.format_exc()))
+
+  def stop(self):
+    self.done = True
+    self.notify()
+    self.thread.join()
+
+  def get_stats(self, reset=False):
+    """
+    Returns the number of restores in progress (and the max since the last
+    reset), completed and failed
+    """
+    self.cond.acquire()
+    stats = {'active': len(self.jobs) + len(self.new_jobs),
+             'max_active': self.max_jobs,
+             'completed': self.completed,
+             'failed': self.failed}
+    if (reset):
+      self.max_jobs = len(self.jobs)
+    self.cond.release()
+    return stats
@@ -0,0 +1,161 @@
+import threading
+import os
+
+class RestorePlan:
+  """
+  What a restore of one application writes, compiled from the config and
+  runtime databases by the ThresholdRestorer: the application info (for
+  the log and the release PVs), the ids of its devices (to lock them) and
+  the active thresholds as an ordered list of (pv name, enable pv name,
+  value, device id).
+  """
+  def __init__(self, app_id, name, description, crate, slot, pv_name, device_ids, items):
+    self.app_id = app_id
+    self.name = name
+    self.description = description
+    self.crate = crate
+    self.slot = slot
+    self.pv_name = pv_name
+    self.device_ids = device_ids
+    self.items = items
+
+class RestorePlanCache:
+  """
+  Keeps the RestorePlan of each application (by ApplicationCard.global_id)
+  so repeated restores go straight to channel access, without reading the
+  application, devices and thresholds from the databases again.
+
+  Plans are dropped when their thresholds may have changed:
+   - invalidate_device() is called by the ThresholdManager when it commits
+     a change to a device, dropping the plans of the applications using it
+   - all plans are dropped when the config database file changes, or when
+     the runtime database is modified by someone else (e.g. the local
+     threshold change script) - the runtime database modification time is
+     taken again after each of our own commits
+
+  A plan compiled while an invalidation happened is not kept (see token()).
+  """
+  def __init__(self, db_file_name, rt_file_name):
+    self.db_file_name = db_file_name
+    self.rt_file_name = rt_file_name
+    self.lock = threading.Lock()
+    self.plans = {} # app_id -> RestorePlan
+    self.device_apps = {} # device_id -> set of app_ids
+    self.generation = 0
+    self.db_mtime = self.get_mtime(self.db_file_name)
+    self.rt_mtime = self.get_mtime(self.rt_file_name)
+    self.hits = 0
+    self.misses = 0
+    self.invalidated = 0
+
+  def get_mtime(self, file_name):
+    try:
+      return os.path.getmtime(file_name)
+    except OSError:
+      return None
+
+  def check_files(self):
+    """
+    Drops all plans if the databases were changed by someone else, must be
+    called with the lock held
+    """
+    db_mtime = self.get_mtime(self.db_file_name)
+    rt_mtime = self.get_mtime(self.rt_file_name)
+    if (db_mtime != self.db_mtime or rt_mtime != self.rt_mtime):
+      self.db_mtime = db_mtime
+      self.rt_mtime = rt_mtime
+      self.clear()
+
+  def clear(self):
+    self.invalidated += len(self.plans)
+    self.plans = {}
+    self.device_apps = {}
+    self.generation += 1
+
+  def token(self):
+    """
+    Returns the token to pass to add() with a plan compiled from now on
+    """
+    self.lock.acquire()
+    self.check_files()
+    generation = self.generation
+    self.lock.release()
+    return generation
+
+  def get(self, app_id):
+    self.lock.acquire()
+    self.check_files()
+    plan = self.plans.get(app_id)
+    if (plan == None):
+      self.misses += 1
+    else:
+      self.hits += 1
+    self.lock.release()
+    return plan
+
+  def get_device_ids(self, app_id):
+    """
+    Returns the device ids of the application plan (None if there is no
+    plan), not counted as a hit/miss
+    """
+    self.lock.acquire()
+    self.check_files()
+    plan = self.plans.get(app_id)
+    self.lock.release()
+    if (plan == None):
+      return None
+    return plan.device_ids
+
+  def add(self, plan, token):
+    """
+    Keeps the plan, unless something was invalidated since token() was
+    called (the plan may have been compiled from old thresholds)
+    """
+    self.lock.acquire()
+    self.check_files()
+    if (token == self.generation):
+      self.plans[plan.app_id] = plan
+      for device_id in plan.device_ids:
+        self.device_apps.setdefault(device_id, set()).add(plan.app_id)
+    self.lock.release()
+
+  def invalidate_device(self, device_id):
+    """
+    Drops the plans of the applications using the device, called right after
+    a commit of its thresholds (with the commit lock held, so the runtime
+    database modification time is that of our own commit)
+    """
+    self.lock.acquire()
+    for app_id in self.device_apps.pop(device_id, set()):
+      plan = self.plans.pop(app_id, None)
+      if (plan != None):
+        self.invalidated += 1
+        for other_id in plan.device_ids:
+          if (other_id in self.device_apps):
+            self.device_apps[other_id].discard(app_id)
+    self.generation += 1
+    if (self.get_mtime(self.db_file_name) == self.db_mtime):
+      self.rt_mtime = self.get_mtime(self.rt_file_name)
+    self.lock.release()
+
+  def prune(self):
+    """
+    Drops the plans if the databases changed, called periodically by the
+    housekeeping so stale plans are not kept until the next restore
+    """
+    self.lock.acquire()
+    self.check_files()
+    self.lock.release()
+
+  def get_stats(self, reset=False):
+    self.lock.acquire()
+    stats = {'plans': len(self.plans),
+             'hits': self.hits,
+             'misses': self.misses,
+             'invalidated': self.invalidated}
+    if (reset):
+      self.hits = 0
+      self.misses = 0
+      self.invalidated = 0
+    self.lock.release()
+    return stats
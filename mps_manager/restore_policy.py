@@ -0,0 +1,167 @@
+import threading
+import yaml
+
+from request_stats import LatencyHistogram
+
+class RestorePolicy:
+  """
+  How long and how many times a restore tries to reach an IOC:
+
+  connect_timeout: seconds to wait for the application PVs to connect, in
+                   each attempt
+  put_timeout: seconds to wait for each batch of PV writes to complete
+  max_attempts: number of times the restore (PV connection and writes) is
+                tried before failing
+  backoff: seconds to wait before the second attempt, doubled for each
+           further attempt up to max_backoff
+  deadline: no attempt is started later than this many seconds after the
+            restore started
+  failure_budget: after this many consecutive failed restores of an
+                  application its restores make a single attempt, until
+                  one succeeds (a dead IOC does not keep retrying)
+  """
+  fields = ['connect_timeout', 'put_timeout', 'max_attempts', 'backoff',
+            'max_backoff', 'deadline', 'failure_budget']
+
+  def __init__(self, connect_timeout=20, put_timeout=10, max_attempts=3, backoff=2.0,
+               max_backoff=10.0, deadline=60, failure_budget=3):
+    self.connect_timeout = connect_timeout
+    self.put_timeout = put_timeout
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.deadline = deadline
+    self.failure_budget = failure_budget
+
+  def copy(self, **overrides):
+    """
+    Returns a copy of the policy with some fields changed, fails with
+    ValueError for unknown fields
+    """
+    for field in overrides.keys():
+      if (not field in self.fields):
+        raise ValueError('Invalid restore policy field "{}"'.format(field))
+    values = dict([(field, getattr(self, field)) for field in self.fields])
+    values.update(overrides)
+    return RestorePolicy(**values)
+
+  def get_backoff(self, attempt):
+    """
+    Returns the seconds to wait after the given (failed) attempt
+    """
+    return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+  def retry(self, attempt, elapsed):
+    """
+    Returns True if another attempt can be made after the given (failed)
+    attempt, elapsed seconds after the restore started
+    """
+    return (attempt < self.max_attempts and
+            elapsed + self.get_backoff(attempt) < self.deadline)
+
+  def to_dict(self):
+    return dict([(field, getattr(self, field)) for field in self.fields])
+
+class RestorePolicies:
+  """
+  The server RestorePolicy and its per-application overrides, and what was
+  observed when restoring each application: number of restores, failures
+  and attempts, and the time-to-connect (from the start of the restore
+  until all its PVs were connected) - the data to tune the policy from.
+  """
+  def __init__(self, default, overrides={}):
+    self.default = default
+    self.overrides = {} # app_id -> RestorePolicy
+    for app_id, fields in overrides.items():
+      self.overrides[int(app_id)] = default.copy(**(fields or {}))
+    self.lock = threading.Lock()
+    self.apps = {} # app_id -> dict of counters, see record()
+    self.connect = LatencyHistogram()
+    self.retried = 0
+
+  def get(self, app_id):
+    """
+    Returns the policy for the application, limited to a single attempt if
+    its failure budget is exhausted
+    """
+    policy = self.overrides.get(app_id, self.default)
+    self.lock.acquire()
+    failures = self.apps.get(app_id, {}).get('consecutive_failures', 0)
+    self.lock.release()
+    if (failures >= policy.failure_budget):
+      return policy.copy(max_attempts=1)
+    return policy
+
+  def record(self, app_id, ok, attempts, connect_time):
+    """
+    Records the outcome of a restore, connect_time is None if its PVs never
+    all connected
+    """
+    self.lock.acquire()
+    app = self.apps.setdefault(app_id, {'restores': 0, 'failures': 0,
+                                        'consecutive_failures': 0, 'attempts': 0,
+                                        'connects': 0, 'connect_last': 0.0,
+                                        'connect_total': 0.0, 'connect_max': 0.0})
+    app['restores'] += 1
+    app['attempts'] += attempts
+    if (ok):
+      app['consecutive_failures'] = 0
+    else:
+      app['failures'] += 1
+      app['consecutive_failures'] += 1
+    if (attempts > 1):
+      self.retried += 1
+    if (connect_time != None):
+      app['connects'] += 1
+      app['connect_last'] = connect_time
+      app['connect_total'] += connect_time
+      app['connect_max'] = max(app['connect_max'], connect_time)
+      self.connect.record(connect_time)
+    self.lock.release()
+
+  def get_stats(self, reset=False):
+    """
+    Returns the policies, the time-to-connect histogram of all restores
+    (since the last reset) and the counters of each application
+    """
+    self.lock.acquire()
+    apps = {}
+    for app_id, app in self.apps.items():
+      apps[str(app_id)] = dict(app)
+      apps[str(app_id)]['connect_avg'] = app['connect_total'] / app['connects'] \
+          if app['connects'] > 0 else 0.0
+    stats = {'policy': self.default.to_dict(),
+             'overrides': dict([(str(app_id), policy.to_dict())
+                                for app_id, policy in self.overrides.items()]),
+             'connect': self.connect.to_dict(),
+             'retried': self.retried,
+             'applications': apps}
+    if (reset):
+      self.connect = LatencyHistogram()
+      self.retried = 0
+    self.lock.release()
+    return stats
+
+def load_restore_policies(file_name, default):
+  """
+  Reads the restore policy from a YAML file, e.g.
+
+    default:
+      max_attempts: 3
+      deadline: 60
+    applications:
+      12:
+        connect_timeout: 40
+
+  The fields not in the file are taken from default (a RestorePolicy)
+  """
+  f = open(file_name)
+  try:
+    config = yaml.safe_load(f)
+  finally:
+    f.close()
+  if (config == None):
+    config = {}
+
+  return RestorePolicies(default.copy(**(config.get('default') or {})),
+                         config.get('applications') or {})
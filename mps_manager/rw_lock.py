@@ -0,0 +1,185 @@
+import threading
+import time
+
+class ReadWriteLock:
+  """
+  Readers/writer lock with writer preference: once a writer is waiting no
+  new readers are admitted, so a steady stream of readers can't starve
+  writers. Acquire functions take an optional timeout and return the time
+  spent waiting for the lock (seconds), or None if the timeout expired.
+  """
+  def __init__(self):
+    self.cond = threading.Condition(threading.Lock())
+    self.readers = 0
+    self.writer = False
+    self.waiting_writers = 0
+
+  def wait(self, start, timeout):
+    """
+    Waits on the condition until notified or the timeout expires, returns
+    False if there is no time left. Must be called with self.cond held
+    """
+    if (timeout == None):
+      self.cond.wait()
+      return True
+
+    remaining = start + timeout - time.time()
+    if (remaining <= 0):
+      return False
+    self.cond.wait(remaining)
+    return True
+
+  def acquire_read(self, timeout=None):
+    start = time.time()
+    self.cond.acquire()
+    try:
+      while (self.writer or self.waiting_writers > 0):
+        if (not self.wait(start, timeout)):
+          return None
+      self.readers += 1
+      return time.time() - start
+    finally:
+      self.cond.release()
+
+  def release_read(self):
+    self.cond.acquire()
+    self.readers -= 1
+    if (self.readers == 0):
+      self.cond.notify_all()
+    self.cond.release()
+
+  def acquire_write(self, timeout=None):
+    start = time.time()
+    self.cond.acquire()
+    try:
+      self.waiting_writers += 1
+      while (self.writer or self.readers > 0):
+        if (not self.wait(start, timeout)):
+          self.waiting_writers -= 1
+          # Readers held back by this writer may proceed
+          self.cond.notify_all()
+          return None
+      self.waiting_writers -= 1
+      self.writer = True
+      return time.time() - start
+    finally:
+      self.cond.release()
+
+  def release_write(self):
+    self.cond.acquire()
+    self.writer = False
+    self.cond.notify_all()
+    self.cond.release()
+
+class LockSet:
+  """
+  Locks held by one request, returned by LockManager.acquire()
+  """
+  def __init__(self):
+    self.locks = [] # [(key, lock, exclusive), ...]
+    self.wait = 0.0
+
+class LockManager:
+  """
+  Keeps one ReadWriteLock per key (e.g. ('device', id) or ('app', id)), so
+  requests only wait for others that touch the same devices/applications.
+  Locks are created on demand and dropped when no longer used. A request
+  acquires all its keys at once, always in sorted order, which prevents
+  deadlocks between requests locking overlapping sets of keys.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.locks = {} # key -> [ReadWriteLock, users]
+    self.stats = {'read': self.new_stats(), 'write': self.new_stats()}
+
+  def new_stats(self):
+    return {'count': 0, 'timeouts': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+  def get_lock(self, key):
+    self.lock.acquire()
+    if (not key in self.locks):
+      self.locks[key] = [ReadWriteLock(), 0]
+    self.locks[key][1] += 1
+    rw_lock = self.locks[key][0]
+    self.lock.release()
+    return rw_lock
+
+  def put_lock(self, key):
+    self.lock.acquire()
+    self.locks[key][1] -= 1
+    if (self.locks[key][1] == 0):
+      del self.locks[key]
+    self.lock.release()
+
+  def record(self, kind, wait):
+    self.lock.acquire()
+    stats = self.stats[kind]
+    if (wait == None):
+      stats['timeouts'] += 1
+    else:
+      stats['count'] += 1
+      stats['total_wait'] += wait
+      if (wait > stats['max_wait']):
+        stats['max_wait'] = wait
+    self.lock.release()
+
+  def acquire(self, shared=[], exclusive=[], timeout=None):
+    """
+    Acquires shared (read) locks for the keys in shared and exclusive (write)
+    locks for the keys in exclusive. Returns a LockSet to be passed to
+    release(), or None if not all locks could be taken within timeout seconds
+    (in which case none is held).
+    """
+    keys = {}
+    for key in shared:
+      keys[key] = False
+    for key in exclusive:
+      keys[key] = True
+
+    start = time.time()
+    lock_set = LockSet()
+    kind = 'write' if len(exclusive) > 0 else 'read'
+    for key in sorted(keys.keys()):
+      remaining = None
+      if (timeout != None):
+        remaining = max(0, start + timeout - time.time())
+
+      rw_lock = self.get_lock(key)
+      if (keys[key]):
+        wait = rw_lock.acquire_write(remaining)
+      else:
+        wait = rw_lock.acquire_read(remaining)
+
+      if (wait == None):
+        self.put_lock(key)
+        self.release(lock_set)
+        self.record(kind, None)
+        return None
+
+      lock_set.locks.append((key, rw_lock, keys[key]))
+
+    lock_set.wait = time.time() - start
+    self.record(kind, lock_set.wait)
+    return lock_set
+
+  def release(self, lock_set):
+    for key, rw_lock, exclusive in reversed(lock_set.locks):
+      if (exclusive):
+        rw_lock.release_write()
+      else:
+        rw_lock.release_read()
+      self.put_lock(key)
+    lock_set.locks = []
+
+  def get_stats(self, reset=False):
+    """
+    Returns the shared ('read') and exclusive ('write') acquisition
+    statistics and the number of keys currently locked
+    """
+    self.lock.acquire()
+    stats = {'read': dict(self.stats['read']), 'write': dict(self.stats['write']),
+             'keys': len(self.locks)}
+    if (reset):
+      self.stats = {'read': self.new_stats(), 'write': self.new_stats()}
+    self.lock.release()
+    return stats
@@ -0,0 +1,111 @@
+import numpy
+from threshold_fields import FIELDS, THRESHOLD_TABLES, INTEGRATORS
+
+# table -> grid of ThresholdFields, indexed like the arrays ([row][col])
+FIELD_GRID = {}
+for table, count, relation, history_name in THRESHOLD_TABLES:
+  FIELD_GRID[table] = [[None] * len(INTEGRATORS) for row in range(2 * count)]
+for field in FIELDS:
+  FIELD_GRID[field.table][field.row][field.col] = field
+
+class ThresholdArrays:
+  """
+  The thresholds of one device as fixed-shape arrays per table ('lc1',
+  'idl', 'lc2' and 'alt'), laid out like the MpsManagerThresholdRequest
+  arrays: a row per threshold index, LOLO rows first and HIHI rows after
+  them, and a column per integrator (see ThresholdField.row/col).
+
+  value holds the thresholds, active their active flags and mask tells
+  which entries are set - e.g. the thresholds given in a change request,
+  the others keep their database value.
+  """
+  def __init__(self):
+    self.value = {}
+    self.active = {}
+    self.mask = {}
+    for table, count, relation, history_name in THRESHOLD_TABLES:
+      shape = (2 * count, len(INTEGRATORS))
+      self.value[table] = numpy.zeros(shape)
+      self.active[table] = numpy.zeros(shape, dtype=bool)
+      self.mask[table] = numpy.zeros(shape, dtype=bool)
+
+  def is_set(self, field):
+    return self.mask[field.table][field.row, field.col]
+
+  def set(self, field, value, active=True):
+    self.value[field.table][field.row, field.col] = value
+    self.active[field.table][field.row, field.col] = active
+    self.mask[field.table][field.row, field.col] = True
+
+  def get(self, field):
+    return (float(self.value[field.table][field.row, field.col]),
+            bool(self.active[field.table][field.row, field.col]))
+
+  def get_changes(self):
+    """
+    Returns the [(ThresholdField, value), ...] of the entries set, by table
+    """
+    changes = []
+    for table, count, relation, history_name in THRESHOLD_TABLES:
+      grid = FIELD_GRID[table]
+      values = self.value[table]
+      for row, col in zip(*numpy.nonzero(self.mask[table])):
+        changes.append((grid[row][col], float(values[row, col])))
+    return changes
+
+  def get_invalid(self, db):
+    """
+    Returns the [(LOLO ThresholdField, HIHI ThresholdField), ...] where HIHI
+    is not greater than LOLO, checking the entries set merged with the
+    thresholds in db (ThresholdArrays of the database values) - a pair is
+    checked if either of its thresholds is set
+    """
+    invalid = []
+    for table, count, relation, history_name in THRESHOLD_TABLES:
+      value = numpy.where(self.mask[table], self.value[table], db.value[table])
+      mask = self.mask[table][:count] | self.mask[table][count:]
+      bad = mask & (value[:count] >= value[count:])
+      grid = FIELD_GRID[table]
+      for row, col in zip(*numpy.nonzero(bad)):
+        invalid.append((grid[row][col], grid[row + count][col]))
+    return invalid
+
+  def to_request(self, message):
+    """
+    Copies the values and active flags to the MpsManagerThresholdRequest
+    arrays
+    """
+    for table, count, relation, history_name in THRESHOLD_TABLES:
+      setattr(message, '{}_value'.format(table), self.value[table].tolist())
+      setattr(message, '{}_active'.format(table), self.active[table].tolist())
+
+def get_request_arrays(lc1_active, lc1_value, idl_active, idl_value,
+                       lc2_active, lc2_value, alt_active, alt_value):
+  """
+  Returns the ThresholdArrays of the MpsManagerThresholdRequest arrays,
+  the entries with active == 1 are set
+  """
+  arrays = ThresholdArrays()
+  for table, active, value in [('lc1', lc1_active, lc1_value), ('idl', idl_active, idl_value),
+                               ('lc2', lc2_active, lc2_value), ('alt', alt_active, alt_value)]:
+    arrays.mask[table] = numpy.array(active) == 1
+    arrays.active[table] = arrays.mask[table].copy()
+    arrays.value[table] = numpy.array(value, dtype=float)
+  return arrays
+
+def get_device_arrays(rt_d):
+  """
+  Returns the ThresholdArrays with all the thresholds of the runtime Device
+  """
+  arrays = ThresholdArrays()
+  for table, grid in FIELD_GRID.items():
+    values = []
+    active = []
+    for fields in grid:
+      t_row = getattr(rt_d, fields[0].relation)
+      values.append([getattr(t_row, field.column) for field in fields])
+      active.append([getattr(t_row, field.active_column) for field in fields])
+    arrays.value[table] = numpy.array(values, dtype=float)
+    arrays.active[table] = numpy.array(active, dtype=bool)
+    arrays.mask[table][:] = True
+  return arrays
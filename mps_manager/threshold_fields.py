@@ -0,0 +1,86 @@
+from collections import namedtuple
+import runtime
+
+class ThresholdField(namedtuple('ThresholdField',
+                                ['table', 't_index', 'integrator', 't_type',
+                                 'relation', 'column', 'active_column',
+                                 'history_class', 'row', 'col'])):
+  """
+  Where one threshold lives, for a (table, threshold index, integrator,
+  type) key such as ('lc2', 't3', 'i1', 'h'):
+
+  relation: runtime Device attribute holding the threshold row
+            (e.g. 'threshold3', 'threshold_alt3', 'threshold_lc1')
+  column, active_column: value and active flag columns in that row
+                         (e.g. 'i1_h', 'i1_h_active')
+  history_class: runtime class of the history entries of the row
+  row, col: position of the value in the MpsManagerThresholdRequest
+            arrays of the table (HIHI rows follow the LOLO rows)
+
+  The PV name is built by MpsName.getThresholdPv() from the device name,
+  table, t_index, integrator and t_type.
+  """
+  __slots__ = ()
+
+  def get_value(self, rt_d):
+    return getattr(getattr(rt_d, self.relation), self.column)
+
+  def get_active(self, rt_d):
+    return getattr(getattr(rt_d, self.relation), self.active_column)
+
+  def set(self, rt_d, value, active):
+    row = getattr(rt_d, self.relation)
+    setattr(row, self.column, value)
+    setattr(row, self.active_column, active)
+
+# Runtime Device attribute and history class of a threshold row, for a
+# (table, threshold index) key
+ThresholdRow = namedtuple('ThresholdRow', ['relation', 'history_class'])
+
+# Tables, number of thresholds and runtime relation/history class name
+# formats (with the threshold number)
+THRESHOLD_TABLES = [('lc1', 1, 'threshold_lc1', 'ThresholdHistoryLc1'),
+                    ('idl', 1, 'threshold_idl', 'ThresholdHistoryIdl'),
+                    ('lc2', 8, 'threshold{}', 'Threshold{}History'),
+                    ('alt', 8, 'threshold_alt{}', 'ThresholdAlt{}History')]
+INTEGRATORS = ['i0', 'i1', 'i2', 'i3']
+THRESHOLD_TYPES = ['l', 'h']
+
+# Names accepted in threshold change requests
+INTEGRATOR_NAMES = {'i0': 'i0', 'i1': 'i1', 'i2': 'i2', 'i3': 'i3',
+                    'x': 'i0', 'y': 'i1', 'tmit': 'i2'}
+TYPE_NAMES = {'lolo': 'l', 'hihi': 'h'}
+
+# Value and active flag columns of a threshold row, copied to its history
+# entries
+HISTORY_COLUMNS = tuple(['{}_{}{}'.format(integrator, t_type, suffix)
+                         for integrator in INTEGRATORS for t_type in THRESHOLD_TYPES
+                         for suffix in ['', '_active']])
+
+def build_fields():
+  fields = []
+  for table, count, relation, history_name in THRESHOLD_TABLES:
+    for t in range(count):
+      history_class = getattr(runtime, history_name.format(t))
+      for type_index, t_type in enumerate(THRESHOLD_TYPES):
+        for col, integrator in enumerate(INTEGRATORS):
+          fields.append(ThresholdField(table, 't{}'.format(t), integrator, t_type,
+                                       relation.format(t),
+                                       '{}_{}'.format(integrator, t_type),
+                                       '{}_{}_active'.format(integrator, t_type),
+                                       history_class, t + type_index * count, col))
+  return tuple(fields)
+
+# All the thresholds, built once at import (not to be modified)
+FIELDS = build_fields()
+# (table, t_index, integrator, t_type) -> ThresholdField
+FIELDS_BY_KEY = dict([((f.table, f.t_index, f.integrator, f.t_type), f) for f in FIELDS])
+# (table, t_index) -> ThresholdRow
+ROWS_BY_KEY = dict([((f.table, f.t_index), ThresholdRow(f.relation, f.history_class))
+                    for f in FIELDS])
+
+def get_field(table, t_index, integrator, t_type):
+  """
+  Returns the ThresholdField, None if there is no such threshold
+  """
+  return FIELDS_BY_KEY.get((table, t_index, integrator, t_type))
@@ -6,7 +6,6 @@ import sys
 import argparse
 import time 
 import os
-import re
 import subprocess
 import yaml
 import epics
@@ -14,133 +13,150 @@ from epics import PV
 from argparse import RawTextHelpFormatter
 from pprint import *
 from mps_manager_protocol import *
+from request_stats import RequestTiming
+from pv_batch import wait_connected, put_many
+from threshold_fields import ROWS_BY_KEY, HISTORY_COLUMNS, INTEGRATOR_NAMES, TYPE_NAMES, get_field
+from threshold_arrays import ThresholdArrays, get_request_arrays, get_device_arrays
 
 class ThresholdManager:
   """
   Changes thresholds of analog devices - save value in database and set device using channel access
   """
-  def __init__(self, session, rt_session, mps_names):
+  def __init__(self, session, rt_session, mps_names, commit_lock=None, timing=None,
+               plan_cache=None, pv_cache=None, connect_timeout=5, put_timeout=10):
     self.session = session
     self.rt_session = rt_session
     self.mps_names = mps_names
-
-  def update_threshold(self, rt_d, t_table, integrator_k, t_type, value_v, active):
+    self.commit_lock = commit_lock
+    self.timing = timing # RequestTiming for the database/PV times
+    if (self.timing == None):
+      self.timing = RequestTiming()
+    self.plan_cache = plan_cache # RestorePlanCache to invalidate on commit
+    self.pv_cache = pv_cache # PVCache the threshold PVs are taken from
+    self.connect_timeout = connect_timeout # seconds to wait for the PVs before writing
+    self.put_timeout = put_timeout # deadline (seconds) for all the PV writes of a change
+    self.changes = None # ThresholdArrays with the thresholds to change
+    self.pvs = {} # ThresholdField -> (pv, enable pv) of the changes
+
+  def commit(self, device_ids=[]):
     """
-    Save the threshold value to the database as the current value, also
-    set the active field (it will be False if the threshold was never used before)
+    Commit the runtime database changes, serialized with the other writers
+    if a commit_lock was given. The restore plans using the changed devices
+    are dropped from the plan_cache.
     """
-    setattr(getattr(rt_d, t_table), '{0}_{1}'.format(integrator_k,t_type), value_v)
-    setattr(getattr(rt_d, t_table), '{0}_{1}_active'.format(integrator_k,t_type), active)
-    self.rt_session.commit()
-
-  def get_threshold(self, rt_d, t_table, integrator_k, t_type):
+    self.timing.start('db')
+    if (self.commit_lock != None):
+      self.commit_lock.acquire()
+    try:
+      if (self.plan_cache != None):
+        self.plan_cache.prune() # Changes made by others before this commit
+      self.rt_session.commit()
+      if (self.plan_cache != None):
+        for device_id in device_ids:
+          self.plan_cache.invalidate_device(device_id)
+    finally:
+      if (self.commit_lock != None):
+        self.commit_lock.release()
+      self.timing.stop('db')
+
+  def rollback(self):
     """
-    Get the threshold value and its active state
+    Discards the runtime database changes not committed yet
     """
-    value = getattr(getattr(rt_d, t_table), '{0}_{1}'.format(integrator_k,t_type))
-    active = getattr(getattr(rt_d, t_table), '{0}_{1}_active'.format(integrator_k,t_type))
-    return value, active
+    self.rt_session.rollback()
 
-  def get_threshold_history_name(self, table_k, t_index):
+  def update_threshold(self, rt_d, field, value_v, active):
     """
-    Returns the database table that contains the history for the type of
-    threshold.
+    Save the threshold value (field is its ThresholdField) to the database
+    as the current value, also set the active field (it will be False if
+    the threshold was never used before).
+    The change is committed by change_thresholds(), with the rest of the change.
     """
-    if (table_k == 'idl'):
-      return 'ThresholdHistoryIdl'
-    elif (table_k == 'lc1'):
-      return 'ThresholdHistoryLc1'
-    elif (table_k == 'lc2'):
-      return 'Threshold{0}History'.format(t_index[1])
-    elif (table_k == 'alt'):
-      return 'ThresholdAlt{0}History'.format(t_index[1])
-
-    return None
-  
-  def add_history(self, table_k, t_index, rt_d, t_table, user, reason):
+    field.set(rt_d, value_v, active)
+
+  def make_history(self, table_k, t_index, rt_d, user, reason):
     """
     Make an entry recording the threshold setting history - sets the user
     name, date and reason for the change
     """
-    hist_name = self.get_threshold_history_name(table_k, t_index)
-    hist_class = globals()[hist_name]
-    hist = hist_class(user=user, reason=reason, device_id=rt_d.id)
+    row = ROWS_BY_KEY[(table_k, t_index)]
+    hist = row.history_class(user=user, reason=reason, device_id=rt_d.id)
 
     # Copy thresholds from rt_d.threshold to history
-    for k in getattr(rt_d, t_table).__dict__.keys():
-      if (re.match('i[0-3]_[lh]', k)):
-        db_value = float(getattr(getattr(rt_d, t_table), k))
-        setattr(hist, k, db_value)
+    t_row = getattr(rt_d, row.relation)
+    for k in HISTORY_COLUMNS:
+      setattr(hist, k, float(getattr(t_row, k)))
 
-    self.rt_session.add(hist)
-    self.rt_session.commit()
+    return hist
+
+  def add_history(self, hists):
+    """
+    Adds the history entries of a change to the session, inserted with one
+    statement per history table (committed by change_thresholds())
+    """
+    hists = sorted(hists, key=lambda hist: type(hist).__name__)
+    self.rt_session.bulk_save_objects(hists)
 
     return True
 
-  def write_threshold(self, pv, value, pv_enable, pv_enable_value):
-    try:
-      pv.put(value)
-    except epics.ca.CASeverityException:
-      if (self.force_write):
-        return True
-      else:
-        print('ERROR: Tried to write to a read-only PV ({}={})'.format(pv.pvname, value))
-        return False
+  def get_pv(self, pv_name):
+    if (self.pv_cache != None):
+      return self.pv_cache.get(pv_name)
+    return PV(pv_name)
 
+  def close(self):
+    """
+    Releases the threshold PVs of the last change to the PV cache
+    """
+    if (self.pv_cache != None):
+      for pv, pv_enable in self.pvs.values():
+        self.pv_cache.release(pv)
+        self.pv_cache.release(pv_enable)
+    self.pvs = {}
+    self.changes = None
+
+  def write_thresholds(self, pv_enable_value):
+    """
+    Writes the thresholds in self.changes and their enable PVs at once (see
+    put_thresholds()). Returns False if any PV write failed and the failed
+    PVs, one '* PV=value (error)' line each.
+    """
+    value_puts, enable_puts = self.get_puts(pv_enable_value)
+    self.timing.start('pv_put')
     try:
-      pv_enable.put(pv_enable_value)
-    except epics.ca.CASeverityException:
-      if (self.force_write):
-        return True
-      else:
-        print('ERROR: Tried to write to a read-only PV ({}={})'.format(pv_enable.pvname, pv_enable_value))
-        return False
-
-    return True
+      errors = put_thresholds(value_puts, enable_puts, self.connect_timeout,
+                              self.put_timeout, self.force_write)
+    finally:
+      self.timing.stop('pv_put')
 
-  def build_entries(self, table_name, active, values, t_type, t_index):
-    integrator_index = 0
-    table = []
-    for a, v in zip(active, values):
-      threshold_index_str = 'T{}'.format(t_index)
-      integrator_index_str = 'I{}'.format(integrator_index)
-      if a == 1:
-        table.append([table_name, threshold_index_str,
-                      integrator_index_str, t_type, v])
-      integrator_index += 1
-      if integrator_index == 4:
-        integrator_index = 0
-
-    return table
+    pv_names = ''.join(['* {}\n'.format(error) for error in errors if error != None])
+    return pv_names == '', pv_names
 
   def build_table(self, lc1_active, lc1_value, idl_active, idl_value,
                   lc2_active, lc2_value, alt_active, alt_value):
-    table = []
-    table += self.build_entries('lc1', lc1_active[0], lc1_value[0], 'lolo', 0)
-    table += self.build_entries('lc1', lc1_active[1], lc1_value[1], 'hihi', 0)
-    
-    table += self.build_entries('idl', idl_active[0], idl_value[0], 'lolo', 0)
-    table += self.build_entries('idl', idl_active[1], idl_value[1], 'hihi', 0)
-
-    for t in range(0,8):
-      table += self.build_entries('lc2', lc2_active[t], lc2_value[t], 'lolo', t)
-      table += self.build_entries('lc2', lc2_active[t+8], lc2_value[t+8], 'hihi', t)
-    
-      table += self.build_entries('alt', alt_active[t], alt_value[t], 'lolo', t)
-      table += self.build_entries('alt', alt_active[t+8], alt_value[t+8], 'hihi', t)
-    
-    return table
+    """
+    Returns the ThresholdArrays with the thresholds to change (those with
+    active == 1 in the request arrays)
+    """
+    return get_request_arrays(lc1_active, lc1_value, idl_active, idl_value,
+                              lc2_active, lc2_value, alt_active, alt_value)
 
   #
   # Update the thresholds in database and make enty in the history table.
+  # The values, active flags and history entries are committed together
+  # once all the thresholds are written, if anything fails before that
+  # the database is left unchanged.
   #
   def change_thresholds(self, rt_d, user, reason, is_bpm,
                         lc1_active, lc1_value, idl_active, idl_value,
                         lc2_active, lc2_value, alt_active, alt_values,
                         disable):
 
-    t = self.build_table(lc1_active, lc1_value, idl_active, idl_value,
-                         lc2_active, lc2_value, alt_active, alt_values)
+    message, pv_names, status = self.prepare_change(rt_d, is_bpm,
+                                                   lc1_active, lc1_value, idl_active, idl_value,
+                                                   lc2_active, lc2_value, alt_active, alt_values)
+    if (not status):
+      return message, pv_names, False
 
     if disable:
       pv_enable_value = 0
@@ -149,9 +165,43 @@ class ThresholdManager:
       pv_enable_value = 1
       active = True
 
+    log = self.get_log_header(rt_d, user, reason)
+    hists = []
+
+    try:
+      log, pv_change_status, pv_names = \
+          self.update_thresholds(rt_d, user, reason, pv_enable_value, active, log, hists)
+      self.add_history(hists)
+      self.commit([rt_d.id])
+    except:
+      self.rollback()
+      raise
+
+    log = log + "==="
+    
+    if (not pv_change_status):
+      print('ERROR: Failed to update the following PVs:')
+      print(pv_names)
+      return log, pv_names, False
+
+    return log, '', True
+
+  def prepare_change(self, rt_d, is_bpm, lc1_active, lc1_value, idl_active, idl_value,
+                     lc2_active, lc2_value, alt_active, alt_values):
+    """
+    Checks a change without making it: builds the changes from the request
+    arrays, creates their PVs and verifies the thresholds. Returns the error
+    message, the names of the PVs at fault and False if the change is not
+    allowed.
+    """
+    changes = self.build_table(lc1_active, lc1_value, idl_active, idl_value,
+                               lc2_active, lc2_value, alt_active, alt_values)
+
     force_write = True
     ignore_pv = True
-    message, pv_names, status = self.build_threshold_table(rt_d, t, force_write, ignore_pv, is_bpm)
+    self.timing.start('pv_connect')
+    message, pv_names, status = self.connect_threshold_pvs(rt_d, changes, force_write, ignore_pv, is_bpm)
+    self.timing.stop('pv_connect')
     if (not status):
       return message, pv_names, False
 
@@ -159,62 +209,60 @@ class ThresholdManager:
     if (not status):
       return message, '', False
 
+    return 'OK', '', True
+
+  def get_log_header(self, rt_d, user, reason):
     log = '=== Threshold Change for device "{0}" ===\n'.format(rt_d.mpsdb_name)
     log = log + 'User: {0}\n'.format(user)
     log = log + 'Reason: {0}\n'.format(reason)
     log = log + 'Date: {0}\n\n'.format(time.strftime("%Y/%m/%d %H:%M:%S"))
-    pv_change_status = True
-    pv_names = ''
-
-    for table_k, table_v in self.table.items():
-      for threshold_k, threshold_v in table_v.items():
-        for integrator_k, integrator_v in threshold_v.items():
-          # Get threshold table
-          t_table = self.get_threshold_table_name(table_k, integrator_k, threshold_k)
-          for value_k, value_v in integrator_v.items():
-            if (value_k == 'l'):
-              pv = integrator_v['l_pv']
-              pv_enable = integrator_v['l_pv_enable']
-            elif (value_k == 'h'):
-              pv = integrator_v['h_pv']
-              pv_enable = integrator_v['h_pv_enable']
-
-            if (value_k == 'l' or value_k == 'h'):
-              old_value = getattr(getattr(rt_d, t_table), '{1}_{2}'.format(t_table, integrator_k, value_k))
-              if (not self.write_threshold(pv, value_v, pv_enable, pv_enable_value)):
-                pv_change_status = False
-                pv_names = '{}* {}={}\n'.format(pv_names,pv.pvname, value_v)
-              self.update_threshold(rt_d, t_table, integrator_k, value_k, value_v, active)
-              pv_name = pv.pvname
-              log = log + '{}: threshold={} integrator={} type={} prev={} new={}\n'.\
-                  format(pv_name, threshold_k, integrator_k, value_k, old_value, value_v)
-
-        self.add_history(table_k, threshold_k, rt_d, t_table, user, reason)
-
+    return log
 
-    log = log + "==="
-    
-    if (not pv_change_status):
-      print('ERROR: Failed to update the following PVs:')
-      print(pv_names)
-      return log, pv_names, False
+  def update_thresholds(self, rt_d, user, reason, pv_enable_value, active, log, hists):
+    """
+    Writes the thresholds in self.changes to the PVs and to the session (not
+    committed), the history entries are appended to hists. Returns the log,
+    False if any PV write failed and the names of the failed PVs.
+    """
+    pv_change_status, pv_names = self.write_thresholds(pv_enable_value)
 
-    return log, '', True
+    log = log + self.update_database(rt_d, user, reason, active, hists)
+    return log, pv_change_status, pv_names
 
-  def get_threshold_table_name(self, table_name, integrator_name, threshold_name):
-    if (table_name == 'lc2'):
-      t_table = 'threshold{0}'.format(threshold_name[1])
+  def update_database(self, rt_d, user, reason, active, hists):
+    """
+    Sets the thresholds in self.changes in the session (not committed), the
+    history entries are appended to hists. Returns the log lines.
+    """
+    log = ''
+    rows = [] # (table, threshold index) of the changed threshold rows
 
-    if (table_name == 'alt'):
-      t_table = 'threshold_alt{0}'.format(threshold_name[1])
+    for field, value_v in self.changes.get_changes():
+      pv, pv_enable = self.pvs[field]
+      old_value = field.get_value(rt_d)
+      self.update_threshold(rt_d, field, value_v, active)
+      log = log + '{}: threshold={} integrator={} type={} prev={} new={}\n'.\
+          format(pv.pvname, field.t_index, field.integrator, field.t_type, old_value, value_v)
+      if (not (field.table, field.t_index) in rows):
+        rows.append((field.table, field.t_index))
 
-    if (table_name == 'lc1'):
-      t_table = 'threshold_lc1'
+    for table_k, threshold_k in rows:
+      hists.append(self.make_history(table_k, threshold_k, rt_d, user, reason))
 
-    if (table_name == 'idl'):
-      t_table = 'threshold_idl'
+    return log
 
-    return t_table
+  def get_puts(self, pv_enable_value):
+    """
+    Returns the (pv, value) writes of the thresholds in self.changes and the
+    (enable pv, pv_enable_value) writes, in the same order
+    """
+    value_puts = []
+    enable_puts = []
+    for field, value_v in self.changes.get_changes():
+      pv, pv_enable = self.pvs[field]
+      value_puts.append((pv, value_v))
+      enable_puts.append((pv_enable, pv_enable_value))
+    return value_puts, enable_puts
 
   #
   # Check if the specified thresholds are valid, i.e. HIHI > LOLO value
@@ -222,66 +270,28 @@ class ThresholdManager:
   # current value in the database
   #
   def verify_thresholds(self, rt_d):
-    for table_k, table_v in self.table.items():
-      for threshold_k, threshold_v in table_v.items():
-        for integrator_k, integrator_v in threshold_v.items():
-
-          new_low = None
-          new_high = None
-
-          if ('l' in integrator_v.keys()):
-            new_low = float(integrator_v['l'])
-          if ('h' in integrator_v.keys()):
-            new_high = float(integrator_v['h'])
-
-
-          if (new_low != None and new_high != None):
-            if (new_low >= new_high):
-              error_message = 'ERROR: Invalid thresholds for device {0}, table {1}, integrator {2}, threshold {3}'.\
-                  format(rt_d.mpsdb_name, table_k, integrator_k, threshold_k)
-              error_message += '\nERROR: HIHI threshold (value={0}) smaller or equal to LOLO (value={1}), cannot proceed'.format(new_high, new_low)
-              print(error_message)
-
-              return error_message, False
-
-          if (new_low == None or new_high == None):
-            t_table = self.get_threshold_table_name(table_k, integrator_k, threshold_k)
-            t_type = 'h'
-            if (new_low == None):
-              t_type = 'l'
-
-            db_value = float(getattr(getattr(rt_d, t_table), '{0}_{1}'.format(integrator_k,t_type)))
-
-            if (new_low == None):
-  #            print 'Checking new_high{1} <= db_value{0}'.format(db_value, new_high)
-              if (new_high <= db_value):
-                error_message = 'ERROR: Invalid thresholds for device {0}, table {1}, integrator {2}, threshold {3}'.\
-                  format(rt_d.mpsdb_name, table_k, integrator_k, threshold_k)
-                error_message += '\nERROR: Specified HIHI value ({0}) is smaller or equal than the database LOLO value ({1})'.\
-                    format(new_high, db_value)
-                return error_message, False
-
-            if (new_high == None):
-   #           print 'Checking new_low {0} >= db_value{1}'.format(new_low, db_value)
-              if (new_low >= db_value):
-                error_message = 'ERROR: Invalid thresholds for device {0}, table {1}, integrator {2}, threshold {3}'.\
-                  format(rt_d.mpsdb_name, table_k, integrator_k, threshold_k)
-                error_message += '\nERROR: Specified LOLO value ({0}) is greater or equal than the database HIHI value ({1})'.\
-                    format(new_low, db_value)
-                return error_message, False
-
-  #        print 'low={0} high={1}'.format(new_low, new_high)
-
-    return '', True
+    invalid = self.changes.get_invalid(get_device_arrays(rt_d))
+    if (len(invalid) == 0):
+      return '', True
+
+    low_field, high_field = invalid[0]
+    error_message = 'ERROR: Invalid thresholds for device {0}, table {1}, integrator {2}, threshold {3}'.\
+        format(rt_d.mpsdb_name, low_field.table, low_field.integrator, low_field.t_index)
+    if (self.changes.is_set(low_field) and self.changes.is_set(high_field)):
+      error_message += '\nERROR: HIHI threshold (value={0}) smaller or equal to LOLO (value={1}), cannot proceed'.\
+          format(self.changes.get(high_field)[0], self.changes.get(low_field)[0])
+      print(error_message)
+    elif (self.changes.is_set(high_field)):
+      error_message += '\nERROR: Specified HIHI value ({0}) is smaller or equal than the database LOLO value ({1})'.\
+          format(self.changes.get(high_field)[0], float(low_field.get_value(rt_d)))
+    else:
+      error_message += '\nERROR: Specified LOLO value ({0}) is greater or equal than the database HIHI value ({1})'.\
+          format(self.changes.get(low_field)[0], float(high_field.get_value(rt_d)))
+
+    return error_message, False
 
   def build_threshold_table(self, rt_d, t, force_write, ignore_pv, is_bpm):
     # fist check the parameters
-    valid_pvs = True
-    bad_pv_names = ''
-    ro_pvs = False
-    ro_pv_names = '' # read-only pv names
-    self.force_write = force_write
-    self.ignore_pv = ignore_pv
     for l in t:
       [table_name, t_index, integrator, t_type, value] = l
 
@@ -346,67 +356,53 @@ class ThresholdManager:
             format(t_type, l)
         return False
 
-    # build a dictionary with the input parameters
-    self.table = {}
+    # build the ThresholdArrays with the input parameters (the first value
+    # given for a threshold is used)
+    changes = ThresholdArrays()
     for l in t:
       [table_name, t_index, integrator, t_type, value] = l
 
-      table_name = table_name.lower()
-      t_index = t_index.lower()
-      integrator = integrator.lower()
-      t_type = t_type.lower()
-
       # Rename fields to match database
-      if (integrator == 'x'):
-        integrator = 'i0'
-
-      if (integrator == 'y'):
-        integrator = 'i1'
-
-      if (integrator == 'tmit'):
-        integrator = 'i2'
-
-      if (t_type == 'lolo'):
-        t_type = 'l'
+      field = get_field(table_name.lower(), t_index.lower(),
+                        INTEGRATOR_NAMES[integrator.lower()], TYPE_NAMES[t_type.lower()])
+      if (not changes.is_set(field)):
+        changes.set(field, value)
 
-      if (t_type == 'hihi'):
-        t_type = 'h'
-
-      if (not table_name in self.table.keys()):
-        self.table[table_name]={}
-
-      if (not t_index in self.table[table_name].keys()):
-        self.table[table_name][t_index]={}
-
-      if (not integrator in self.table[table_name][t_index].keys()):
-        self.table[table_name][t_index][integrator]={}
-
-      if (not t_type in self.table[table_name][t_index][integrator].keys()):
-        self.table[table_name][t_index][integrator][t_type]=value
-        pv_name = self.mps_names.getThresholdPv(self.mps_names.getAnalogDeviceNameFromId(rt_d.mpsdb_id),
-                                                table_name, t_index, integrator, t_type, is_bpm)
-        pv_name_enable = pv_name + '_EN'
-        pv = PV(pv_name)
-        pv_enable = PV(pv_name_enable)
-
-        if (t_type == 'l'):
-          self.table[table_name][t_index][integrator]['l_pv']=pv
-          self.table[table_name][t_index][integrator]['l_pv_enable']=pv_enable
-        else:
-          self.table[table_name][t_index][integrator]['h_pv']=pv
-          self.table[table_name][t_index][integrator]['h_pv_enable']=pv_enable
+    return self.connect_threshold_pvs(rt_d, changes, force_write, ignore_pv, is_bpm)
 
-        if (pv.host == None or pv_enable.host == None):
-          if (not ignore_pv):
-            valid_pvs = False
-            bad_pv_names = '{} {}'.format(bad_pv_names, pv_name)
-        elif (not force_write):
-          if (not pv.write_access):
-            ro_pvs = True
-            ro_pv_names = '{} {}'.format(ro_pv_names, pv_name)
+  def connect_threshold_pvs(self, rt_d, changes, force_write, ignore_pv, is_bpm):
+    """
+    Creates the threshold and enable PVs of the changes (ThresholdArrays),
+    kept with the changes until close(). Returns the error message, the
+    names of the PVs not reachable or read-only, and False if the change
+    is not allowed.
+    """
+    valid_pvs = True
+    bad_pv_names = ''
+    ro_pvs = False
+    ro_pv_names = '' # read-only pv names
+    self.force_write = force_write
+    self.ignore_pv = ignore_pv
 
-#    pp=PrettyPrinter(indent=4)
-#    pp.pprint(self.table)
+    self.close()
+    self.changes = changes
+    device_name = self.mps_names.getAnalogDeviceNameFromId(rt_d.mpsdb_id)
+    for field, value in changes.get_changes():
+      pv_name = self.mps_names.getThresholdPv(device_name, field.table, field.t_index,
+                                              field.integrator, field.t_type, is_bpm)
+      pv_name_enable = pv_name + '_EN'
+      pv = self.get_pv(pv_name)
+      pv_enable = self.get_pv(pv_name_enable)
+      self.pvs[field] = (pv, pv_enable)
+
+      if (pv.host == None or pv_enable.host == None):
+        if (not ignore_pv):
+          valid_pvs = False
+          bad_pv_names = '{} {}'.format(bad_pv_names, pv_name)
+      elif (not force_write):
+        if (not pv.write_access):
+          ro_pvs = True
+          ro_pv_names = '{} {}'.format(ro_pv_names, pv_name)
 
     if (not valid_pvs):
       error_message = 'Cannot find PV(s)'
@@ -428,35 +424,109 @@ class ThresholdManager:
     message = MpsManagerThresholdRequest(device_id=rt_d.mpsdb_id, device_name=rt_d.mpsdb_name,
                                          user_name="Reader", reason=str(pv_name))
 
-    for table_k in ['lc1', 'idl', 'lc2', 'alt']:
-      if table_k == 'lc1' or table_k is 'idl':
-        thr_count = 1
-      else:
-        thr_count = 8
-      for threshold_i in range(0, thr_count):
-        threshold_k = 't{}'.format(threshold_i)
-        for integrator_i in range(0, 4):
-          integrator_k = 'i{}'.format(integrator_i)
-          t_table = self.get_threshold_table_name(table_k, integrator_k, threshold_k)
-          for value_k in ['l', 'h']:
-            t_i = threshold_i
-            if value_k == 'h':
-              t_i += thr_count
-            if table_k == 'lc1':
-              value, active = self.get_threshold(rt_d, t_table, integrator_k, value_k)
-              message.lc1_value[t_i][integrator_i] = value
-              message.lc1_active[t_i][integrator_i] = active
-            elif table_k == 'idl':
-              value, active = self.get_threshold(rt_d, t_table, integrator_k, value_k)
-              message.idl_value[t_i][integrator_i] = value
-              message.idl_active[t_i][integrator_i] = active
-            elif table_k == 'lc2':
-              value, active = self.get_threshold(rt_d, t_table, integrator_k, value_k)
-              message.lc2_value[t_i][integrator_i] = value
-              message.lc2_active[t_i][integrator_i] = active
-            else:
-              value, active = self.get_threshold(rt_d, t_table, integrator_k, value_k)
-              message.alt_value[t_i][integrator_i] = value
-              message.alt_active[t_i][integrator_i] = active
+    get_device_arrays(rt_d).to_request(message)
 
     return message
+
+def put_thresholds(value_puts, enable_puts, connect_timeout, put_timeout, force_write):
+  """
+  Writes threshold PVs at once (see pv_batch.put_many()): all the values
+  first, then the enable PVs of the values written, each group bound by
+  put_timeout. Puts rejected because the PV is read-only count as done if
+  force_write is set (only the database is changed). Returns the error of
+  each threshold, None if both its PVs were written, e.g. 'PV=1.0 (timeout)'.
+  """
+  wait_connected([pv for pv, value in value_puts + enable_puts], connect_timeout)
+
+  errors = []
+  for (pv, value), error in zip(value_puts, put_many(value_puts, put_timeout)):
+    if (error == None or (error == 'read-only' and force_write)):
+      errors.append(None)
+    else:
+      errors.append('{}={} ({})'.format(pv.pvname, value, error))
+
+  written = [index for index, error in enumerate(errors) if error == None]
+  results = put_many([enable_puts[index] for index in written], put_timeout)
+  for index, error in zip(written, results):
+    if (error != None and not (error == 'read-only' and force_write)):
+      pv, value = enable_puts[index]
+      errors[index] = '{}={} ({})'.format(pv.pvname, value, error)
+
+  return errors
+
+class ThresholdChangeBatch:
+  """
+  Threshold changes of many devices made together: add() checks the change
+  of each device (PVs, HIHI > LOLO) without changing anything, apply()
+  writes the PVs of all the devices at once - the values first, then the
+  enable PVs - and commits the thresholds and history entries of all the
+  devices in one transaction.
+  """
+  def __init__(self, session, rt_session, mps_names, commit_lock=None, timing=None,
+               plan_cache=None, pv_cache=None, connect_timeout=5, put_timeout=10):
+    self.tm = ThresholdManager(session, rt_session, mps_names, commit_lock, timing,
+                               plan_cache, pv_cache, connect_timeout, put_timeout)
+    self.entries = [] # (ThresholdManager, rt_d, MpsManagerThresholdRequest)
+
+  def add(self, rt_d, is_bpm, request):
+    """
+    Checks the change of one device (request is its
+    MpsManagerThresholdRequest), returns the error message, the names of the
+    PVs at fault and False if the change is not allowed
+    """
+    tm = ThresholdManager(self.tm.session, self.tm.rt_session, self.tm.mps_names,
+                          self.tm.commit_lock, self.tm.timing, self.tm.plan_cache,
+                          self.tm.pv_cache, self.tm.connect_timeout, self.tm.put_timeout)
+    self.entries.append((tm, rt_d, request))
+    return tm.prepare_change(rt_d, is_bpm,
+                             request.lc1_active, request.lc1_value,
+                             request.idl_active, request.idl_value,
+                             request.lc2_active, request.lc2_value,
+                             request.alt_active, request.alt_value)
+
+  def apply(self):
+    """
+    Makes the changes added, all of them must be valid. Returns the log and
+    the failed PVs (empty if all were written) of each device, in order.
+    """
+    value_puts = []
+    enable_puts = []
+    owners = [] # index of the entry of each put
+    for index, (tm, rt_d, request) in enumerate(self.entries):
+      values, enables = tm.get_puts(0 if request.disable else 1)
+      value_puts += values
+      enable_puts += enables
+      owners += [index] * len(values)
+
+    self.tm.timing.start('pv_put')
+    try:
+      errors = put_thresholds(value_puts, enable_puts, self.tm.connect_timeout,
+                              self.tm.put_timeout, True)
+    finally:
+      self.tm.timing.stop('pv_put')
+
+    pv_names = [''] * len(self.entries)
+    for index, error in zip(owners, errors):
+      if (error != None):
+        pv_names[index] += '* {}\n'.format(error)
+
+    logs = []
+    hists = []
+    try:
+      for tm, rt_d, request in self.entries:
+        log = tm.get_log_header(rt_d, request.user_name, request.reason)
+        log = log + tm.update_database(rt_d, request.user_name, request.reason,
+                                       not request.disable, hists)
+        logs.append(log + '===')
+      self.tm.add_history(hists)
+      self.tm.commit([rt_d.id for tm, rt_d, request in self.entries])
+    except:
+      self.tm.rollback()
+      raise
+
+    return zip(logs, pv_names)
+
+  def close(self):
+    for tm, rt_d, request in self.entries:
+      tm.close()
+    self.entries = []
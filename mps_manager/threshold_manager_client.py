@@ -8,30 +8,121 @@ import subprocess
 from argparse import RawTextHelpFormatter
 from mps_manager_protocol import *
 import socket
+import select
 from ctypes import *
 from struct import *
 
 class ThresholdManagerClient:
+  """
+  The connection to the server is kept open, so the same client object can
+  be used for many requests (e.g. from a python display). If the server has
+  closed an idle connection it is reopened on the next request.
+  """
   def __init__(self, host='lcls-daemon2', port=1975):
     self.host = host
     self.port = port
     self.num_thresholds = 0
-    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.sock.connect((self.host, self.port))
+    self.sock = None
+    self.connect()
     self.device_id = -1
 
-  def restore(self, app_id):
-    message = MpsManagerRequest(request_type=int(MpsManagerRequestType.RESTORE_APP_THRESHOLDS.value),
-                                request_device_id=app_id)
-    self.sock.send(message.pack())
+  def connect(self):
+    self.close()
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.connect((self.host, self.port))
 
-    response = MpsManagerResponse()
-    data = self.sock.recv(response.size())
-    response.unpack(data)
+  def close(self):
+    if (self.sock != None):
+      self.sock.close()
+      self.sock = None
+
+  def check_connection(self):
+    """
+    Reopens the connection if the server has closed it (e.g. after the idle
+    timeout), found out without sending anything
+    """
+    if (self.sock != None):
+      try:
+        readable, writable, errors = select.select([self.sock], [], [], 0)
+        if (len(readable) == 0 or self.sock.recv(1, socket.MSG_PEEK) != ''):
+          return
+      except socket.error:
+        pass
+    self.connect()
+
+  def request(self, message, response, data='', retry=True, timeout=None):
+    """
+    Sends a request (followed by data) and receives the first response. A
+    connection closed by the server is reopened before sending. If the
+    request fails once sent it is sent again on a new connection only if
+    retry is set, write requests must not be retried as the server may
+    have processed them already. If timeout is given socket.timeout is
+    raised when the response takes longer (the request is not retried).
+    """
+    self.check_connection()
+    payload = message.pack() + data
+    for attempt in range(2 if retry else 1):
+      previous_timeout = self.sock.gettimeout()
+      if (timeout != None):
+        self.sock.settimeout(timeout)
+      try:
+        self.sock.sendall(payload)
+        reply = receive(self.sock, response.size())
+      except socket.timeout:
+        raise
+      except socket.error:
+        reply = None
+      finally:
+        if (self.sock != None):
+          self.sock.settimeout(previous_timeout)
+
+      if (reply != None):
+        response.unpack(reply)
+        return response
+
+      if (not retry):
+        self.close()
+        break
+      self.connect()
+
+    raise socket.error('Connection closed by server {}:{}'.format(self.host, self.port))
+
+  def restore(self, app_id, progress=None, liveness_timeout=None):
+    """
+    Restores the thresholds of an application. If progress is given the
+    server sends MpsManagerProgressResponses while the restore runs and
+    progress() is called with each one. liveness_timeout is then the
+    longest wait (in seconds) for the next frame, from the request on (the
+    server reports the restore while it is queued or waiting for locks too),
+    so a slow restore that is still making progress is not mistaken for a
+    dead server.
+    """
+    request_type = int(MpsManagerRequestType.RESTORE_APP_THRESHOLDS.value)
+    if (progress != None):
+      request_type |= int(MpsManagerRequestFlags.PROGRESS.value)
+    else:
+      liveness_timeout = None
+    message = MpsManagerRequest(request_type=request_type, request_device_id=app_id)
+    try:
+      response = self.request(message, MpsManagerResponse(), timeout=liveness_timeout)
+      if (progress != None):
+        response = self.receive_progress(response, progress, liveness_timeout)
+    except socket.timeout:
+      self.connect() # Drop the late reply
+      print('ERROR: No restore progress from server for {} seconds'.format(liveness_timeout))
+      return False
+    if (progress != None):
+      if (response == None):
+        self.close()
+        print('ERROR: Connection closed by server during restore')
+        return False
 
     if (response.status == int(MpsManagerResponseType.OK.value)):
       print(response.status_message)
       return True
+    elif (response.status == int(MpsManagerResponseType.BUSY.value)):
+      print('ERROR: Failed to restore thresholds, server busy')
+      return False
     else:
       print('ERROR: Failed to restore thresholds')
       if (len(response.status_message) > 0):
@@ -41,28 +132,226 @@ class ThresholdManagerClient:
   def check_device(self, dev_id, dev_name, request_type=int(MpsManagerRequestType.DEVICE_CHECK.value)):
     message = MpsManagerRequest(request_type=request_type,
                                 request_device_id=dev_id, request_device_name=dev_name)
-    self.sock.send(message.pack())
-
-    response = MpsManagerResponse()
-    data = self.sock.recv(response.size())
-    response.unpack(data)
+    response = self.request(message, MpsManagerResponse())
 
     if (response.status == int(MpsManagerResponseType.OK.value)):
       self.device_id = response.device_id
       print(response.status_message)
       return True
+    elif (response.status == int(MpsManagerResponseType.BUSY.value)):
+      print(response.status_message)
+      print('ERROR: Server busy')
+      return False
     else:
       print(response.status_message)
       print('ERROR: Invalid device')
       return False
 
+  def get_stats(self, reset=False):
+    """
+    Requests the server statistics (latency histograms per request type and
+    phase, reply statuses, pools/locks/connections state). If reset is True
+    the server latency/status statistics start over. Returns the stats dict.
+    """
+    message = MpsManagerRequest(request_type=int(MpsManagerRequestType.STATS.value),
+                                request_device_id=1 if reset else 0)
+    response = MpsManagerStatsResponse()
+    self.check_connection()
+    for attempt in range(2):
+      try:
+        self.sock.sendall(message.pack())
+        data = receive(self.sock, response.size())
+        if (data != None):
+          data = receive(self.sock, response.unpack(data))
+      except socket.error:
+        data = None
+
+      if (data != None):
+        response.unpack_stats(data)
+        return response.stats
+
+      self.connect()
+
+    raise socket.error('Connection closed by server {}:{}'.format(self.host, self.port))
+
   def get_thresholds(self):
     thresholds = MpsManagerThresholdRequest()
-    data = self.sock.recv(thresholds.size())
+    data = receive(self.sock, thresholds.size())
+    if (data == None):
+      raise socket.error('Connection closed by server {}:{}'.format(self.host, self.port))
     thresholds.unpack(data)
     return thresholds
 
+  def get_thresholds_pipelined(self, devices):
+    """
+    Requests the thresholds for many devices at once: all requests are sent
+    as tagged requests without waiting for replies, the server processes
+    them concurrently. devices is a list of [dev_id, dev_name] (dev_id=-1 to
+    select by name). Returns a list with the MpsManagerThresholdRequest for
+    each device, or None for the devices that failed.
+    """
+    request_type = int(MpsManagerRequestType.GET_THRESHOLD.value) | \
+        int(MpsManagerRequestFlags.TAGGED.value)
+    data = ''
+    for request_id, [dev_id, dev_name] in enumerate(devices):
+      message = MpsManagerRequest(request_type=request_type,
+                                  request_device_id=dev_id, request_device_name=dev_name)
+      data += message.pack() + MpsManagerRequestTag(request_id).pack()
+
+    self.check_connection()
+    for attempt in range(2):
+      try:
+        self.sock.sendall(data)
+        replies = self.receive_tagged(len(devices))
+      except socket.error:
+        replies = None
+
+      if (replies != None):
+        break
+      self.connect()
+
+    if (replies == None):
+      raise socket.error('Connection closed by server {}:{}'.format(self.host, self.port))
+
+    thresholds = [None] * len(devices)
+    for request_id, reply in replies.items():
+      response = MpsManagerResponse()
+      if (len(reply) < response.size()):
+        print('ERROR: No reply for device {}'.format(devices[request_id]))
+        continue
+
+      response.unpack(reply[:response.size()])
+      if (response.status != int(MpsManagerResponseType.OK.value)):
+        print(response.status_message)
+        continue
+
+      threshold_message = MpsManagerThresholdRequest()
+      if (len(reply) - response.size() != threshold_message.size()):
+        print('ERROR: Invalid reply for device {}'.format(devices[request_id]))
+        continue
+
+      threshold_message.unpack(reply[response.size():])
+      thresholds[request_id] = threshold_message
+
+    return thresholds
+
+  def receive_progress(self, response, progress, liveness_timeout=None):
+    """
+    Receives MpsManagerResponse sized frames, calling progress() with the
+    MpsManagerProgressResponse ones, until the final reply (returned, None
+    if the connection is closed). response is the first frame.
+    """
+    timeout = self.sock.gettimeout()
+    self.sock.settimeout(liveness_timeout)
+    try:
+      while (response.status == int(MpsManagerResponseType.PROGRESS.value)):
+        frame = MpsManagerProgressResponse()
+        frame.unpack(response.pack())
+        progress(frame)
+
+        data = receive(self.sock, response.size())
+        if (data == None):
+          return None
+        response = MpsManagerResponse()
+        response.unpack(data)
+    finally:
+      if (self.sock != None):
+        self.sock.settimeout(timeout)
+    return response
+
+  def receive_tagged(self, count):
+    """
+    Receives count MpsManagerTaggedResponses, returns a dict with the reply
+    data for each request id or None if the connection is closed
+    """
+    replies = {}
+    while (len(replies) < count):
+      response = MpsManagerTaggedResponse()
+      data = receive(self.sock, response.size())
+      if (data == None):
+        return None
+
+      length = response.unpack(data)
+      data = ''
+      if (length > 0):
+        data = receive(self.sock, length)
+        if (data == None):
+          return None
+
+      replies[response.request_id] = data
+
+    return replies
+
   def change_thresholds(self, user, reason, dev_id, dev_name, disable):
+    message = self.build_threshold_request(user, reason, dev_id, dev_name, disable)
+    self.sock.sendall(message.pack())
+
+    response = MpsManagerThresholdResponse()
+    data = receive(self.sock, response.size())
+    if (data == None):
+      print('ERROR: Operation failed - connection closed by server')
+      return False
+    response.unpack(data)
+
+    if response.status != 0:
+      print('ERROR: Operation failed - {}'.format(response.message))
+      return False
+
+    return True
+
+  def change_thresholds_batch(self, user, reason, entries):
+    """
+    Changes the thresholds of many devices with a single request, no
+    check_device() needed. entries is a list of [dev_id, dev_name, t,
+    disable] (dev_id=-1 to select by name), t is the list of threshold
+    parameters as for build_threshold_table(). Nothing is changed unless
+    all the entries are valid. Returns the list of (status, message) of
+    each entry (MpsManagerResponseType values), or None if the request
+    failed as a whole.
+    """
+    data = ''
+    for dev_id, dev_name, t, disable in entries:
+      if (self.build_threshold_table(t) == False):
+        return None
+      data += self.build_threshold_request(user, reason, dev_id, dev_name, disable).pack()
+
+    message = MpsManagerRequest(request_type=int(MpsManagerRequestType.CHANGE_THRESHOLD_BATCH.value),
+                                request_device_id=len(entries))
+    try:
+      response = self.request(message, MpsManagerResponse(), data, retry=False)
+    except socket.error as e:
+      self.close()
+      print('ERROR: Batch request failed ({}), it may have been applied by the server'.format(str(e)))
+      return None
+
+    results = []
+    for index in range(response.device_id):
+      data = receive(self.sock, response.size())
+      if (data == None):
+        self.close()
+        print('ERROR: Operation failed - connection closed by server')
+        return None
+      entry = MpsManagerResponse()
+      entry.unpack(data)
+      results.append((entry.status, entry.status_message))
+
+    if (response.status == int(MpsManagerResponseType.OK.value)):
+      print(response.status_message)
+    elif (response.status == int(MpsManagerResponseType.BUSY.value)):
+      print('ERROR: Failed to change thresholds, server busy')
+      return None
+    else:
+      print('ERROR: {}'.format(response.status_message))
+      if (len(results) == 0):
+        return None
+
+    return results
+
+  def build_threshold_request(self, user, reason, dev_id, dev_name, disable):
+    """
+    Returns the MpsManagerThresholdRequest with the thresholds in self.table
+    (see build_threshold_table())
+    """
     message = MpsManagerThresholdRequest(device_id=dev_id, device_name=dev_name,
                                          user_name=user, reason=reason)
 
@@ -94,15 +383,8 @@ class ThresholdManagerClient:
             elif thr_table == 'alt':
               message.alt_active[thr_type_index * 8 + thr_index_index][thr_int_index] = 1
               message.alt_value[thr_type_index * 8 + thr_index_index][thr_int_index] = float(thr_value)
-    
-    self.sock.send(message.pack())
 
-    response = MpsManagerThresholdResponse()
-    data = self.sock.recv(response.size())
-    response.unpack(data)
-
-    if response.status != 0:
-      print('ERROR: Operation failed - {}'.format(response.message))
+    return message
 
   #
   # build a table/dictionary from the command line parameters
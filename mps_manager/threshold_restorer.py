@@ -11,28 +11,42 @@ import re
 import subprocess
 import yaml
 import epics
+import numpy
 from epics import PV
 from argparse import RawTextHelpFormatter
+from request_stats import RequestTiming
+from pv_batch import wait_connected, put_many, get_many
+from restore_plan import RestorePlan
+from restore_policy import RestorePolicy
+from threshold_fields import FIELDS
 
 class ThresholdRestorer:
-  threshold_tables = ['threshold0','threshold1','threshold2','threshold3',
-                      'threshold4','threshold5','threshold6','threshold7',
-                      'threshold_alt0', 'threshold_alt1','threshold_alt2', 'threshold_alt3',
-                      'threshold_alt4', 'threshold_alt5','threshold_alt6', 'threshold_alt7',
-                      'threshold_lc1', 'threshold_idl']
-  threshold_tables_pv = ['lc2', 'lc2', 'lc2', 'lc2', 'lc2', 'lc2', 'lc2', 'lc2',
-                         'alt', 'alt', 'alt', 'alt', 'alt', 'alt', 'alt', 'alt', 
-                         'lc1', 'idl']
-  threshold_types = ['l','h']
-  integrators = ['i0','i1','i2','i3']
-  threshold_index = ['t0', 't1', 't2', 't3', 't4', 't5', 't6', 't7',
-                     't0', 't1', 't2', 't3', 't4', 't5', 't6', 't7',
-                     't0', 't0']
-  def __init__(self, db=None, rt_db=None, mps_names=None, force_write=False, verbose=False):
+  # Tolerance of the readback verification (the IOCs may keep the
+  # thresholds in single precision)
+  verify_rtol = 1e-5
+  verify_atol = 1e-9
+  # Time to wait for the IOC values read by the differential restore, PVs
+  # not read in time are written
+  diff_timeout = 2.0
+
+  def __init__(self, db=None, rt_db=None, mps_names=None, force_write=False, verbose=False,
+               timing=None, connect_timeout=20, put_timeout=10, pv_cache=None,
+               differential=False, policy=None):
     """
     Restore thresholds of analog devices - using latest thresholds saved in database
     force_write: True -> ignore PV read-only errors
                  False -> return error when writing to read-only PVs
+    timing: RequestTiming where the time spent reading the database,
+            connecting/writing PVs and verifying is added
+    connect_timeout: seconds to wait for the application PVs to connect
+    put_timeout: seconds to wait for each batch of PV writes to complete
+    pv_cache: PVCache the PVs are taken from (and released to, instead of
+              being disconnected)
+    differential: True -> read the IOC values first and write only the
+                          thresholds/enable PVs that differ
+                  False -> write all active thresholds and enable PVs
+    policy: RestorePolicy with the timeouts and retries (replaces
+            connect_timeout/put_timeout), a single attempt if not given
     """
     self.session = db
     self.rt_session = rt_db
@@ -42,14 +56,36 @@ class ThresholdRestorer:
     self.verbose = verbose
     self.force_write = force_write
     self.rt = RuntimeChecker(self.session, self.rt_session, self.verbose)
+    self.timing = timing
+    if (self.timing == None):
+      self.timing = RequestTiming()
+    self.policy = policy
+    if (self.policy == None):
+      self.policy = RestorePolicy(connect_timeout=connect_timeout, put_timeout=put_timeout,
+                                  max_attempts=1)
+    self.connect_timeout = self.policy.connect_timeout
+    self.put_timeout = self.policy.put_timeout
+    self.attempts = 0
+    self.connect_time = None # seconds until all PVs connected in restore()
+    self.put_results = [] # [(pv name, value, error), ...] of the last restore
+    self.mismatches = [] # [{'pv':, 'expected':, 'read':}, ...] of the last check
+    self.restore_list = None # held from prepare() until close()
+    self.pv_cache = pv_cache
+    self.differential = differential
+    self.skipped = 0 # PVs not written by the last differential restore
 
     self.app = None
+    self.app_pv_name = None # release PVs prefix, from the app or its RestorePlan
+    self.restore_list_complete = False
+    self.release_pvs = None
 
   def check_app(self, app_id):
     if (self.verbose):
       sys.stdout.write('Checking app_id {}... '.format(app_id))
     
+    self.close()
     self.app = None
+    self.app_pv_name = None
     try:
       self.app = self.session.query(models.ApplicationCard).\
           filter(models.ApplicationCard.global_id==app_id).one()
@@ -75,6 +111,7 @@ class ThresholdRestorer:
     print('Description: {}'.format(self.app.description))
     print('Crate: {}, Slot: {}'.format(self.app.crate.get_name(), self.app.slot_number))
 
+    self.app_pv_name = self.app.get_pv_name()
     return self.app
 
   def check_devices(self, app):
@@ -96,10 +133,12 @@ class ThresholdRestorer:
 
   def get_restore_list(self, devices):
     """
-    Assembles and returns a list of dicts [{ 'device': device, 'pv': pyepicspv,
+    Assembles and returns a list of dicts [{ 'device_id': id, 'pv': pyepicspv,
                                              'pv_enable': pyepicspv, 'value': threshold},...].
     The thresholds in the list are only those that have been set in the past,
-    that is given by the '*_active' table field.
+    that is given by the '*_active' table field. The thresholds are read
+    through the ThresholdField table, PVs are created only for the active
+    ones. Threshold rows missing from the database are skipped.
 
     The input parameter devices in a list of pairs [[device, rt_device],...]
     """
@@ -107,121 +146,233 @@ class ThresholdRestorer:
       print('Retrieving thresholds from database:')
 
     restore_list=[]
+    self.restore_list_complete = False
     for [d, rt_d] in devices:
       is_bpm = False
       if (d.device_type.name == 'BPMS'):
         is_bpm = True
 
-      threshold_list = self.rt.get_thresholds(d)
-      if (threshold_list == None):
-        return restore_list
-
-      for threshold_item in threshold_list:
+      device_name = self.mps_names.getAnalogDeviceNameFromId(d.id)
+      missing = set()
+      for field in FIELDS:
+        if (getattr(rt_d, field.relation) == None):
+          missing.add(field.relation)
+          continue
+        if (not field.get_active(rt_d)):
+          continue
+        value = field.get_value(rt_d)
+        pv_name = self.mps_names.getThresholdPv(device_name, field.table, field.t_index,
+                                                field.integrator, field.t_type, is_bpm)
         restore_item = {}
-        if (threshold_item['active']):
-          restore_item['device'] = rt_d
-          restore_item['pv'] = threshold_item['pv']
-          restore_item['pv_enable'] = threshold_item['pv_enable']
-          restore_item['value'] = threshold_item['value']
-          restore_list.append(restore_item)
-          if (self.verbose):
-            print('{}={}'.format(threshold_item['pv'].pvname, threshold_item['value']))
-        else:
-          if (threshold_item['pv'] != None):
-            threshold_item['pv'].disconnect()
-          if (threshold_item['pv_enable'] != None):
-            threshold_item['pv_enable'].disconnect()
+        restore_item['device_id'] = rt_d.id
+        restore_item['pv'] = self.get_pv(pv_name)
+        restore_item['pv_enable'] = self.get_pv(pv_name + '_EN')
+        restore_item['value'] = value
+        restore_list.append(restore_item)
+        if (self.verbose):
+          print('{}={}'.format(pv_name, value))
+
+      if (len(missing) > 0):
+        print('WARNING: No {} thresholds for device {}, skipped'.\
+                format(', '.join(sorted(missing)), device_name))
 
     if (self.verbose):
       print('done.')
  
+    self.restore_list_complete = True
     return restore_list
 
-  def check_pvs(self, restore_list, max_fail_pvs=0):
+  def check_pvs(self, restore_list, timeout=None):
     """
-    Check if the PVs in the restore list are available
-    max_fail_pvs: number of PVs allowed to fail (host==None) before returning, if 0 then test them all
+    Waits for the threshold and enable PVs in the restore list to connect,
+    returns as soon as all are connected, or False if some are still not
+    connected after timeout seconds (default is the connect_timeout)
     """
-    print('Sleep...')
-    time.sleep(10)
-    fail_count = 0
+    if (timeout == None):
+      timeout = self.connect_timeout
+
     if (self.verbose):
-      print('Checking PVs...')
-    valid_pvs = True
-    bad_pv_names = ''
-    for restore_item in restore_list:
-      print(restore_item['pv'].pvname)
-      if (restore_item['pv'].host == None):
-        valid_pvs = False
-        bad_pv_names = '{} * {}\n'.format(bad_pv_names, restore_item['pv'].pvname)
-        fail_count += 1
-      print(restore_item['pv_enable'].pvname)
-      if (restore_item['pv_enable'].host == None):
-        valid_pvs = False
-        bad_pv_names = '{} * {}\n'.format(bad_pv_names, restore_item['pv_enable'].pvname)
-        fail_count += 1
-      # Give up if to many PVs fail to connect
-      if (max_fail_pvs > 0 and fail_count >= max_fail_pvs):
-        break;
-    
-    if (not valid_pvs):
-      self.error_message = 'ERROR: PV(s) cannot be reached, threshold change not allowed.'
-      print('ERROR: The following PV(s) cannot be reached, threshold change not allowed:')
-      print(bad_pv_names)
+      print('Waiting for PVs to connect (timeout={}s)...'.format(timeout))
+
+    pvs = self.get_restore_pvs(restore_list)
+    start = time.time()
+    missing = wait_connected(pvs, timeout)
+    if (not self.check_connected(pvs, missing)):
       return False
 
     if (self.verbose):
-      print('done.')
+      print('done ({} PVs connected in {:.3f}s).'.format(len(pvs), time.time() - start))
+    return True
+
+  def get_restore_pvs(self, restore_list):
+    pvs = []
+    for restore_item in restore_list:
+      pvs.append(restore_item['pv'])
+      pvs.append(restore_item['pv_enable'])
+    return pvs
+
+  def get_restore_values(self, restore_list):
+    """
+    Returns the values for the PVs returned by get_restore_pvs()
+    """
+    values = []
+    for restore_item in restore_list:
+      values.append(restore_item['value'])
+      values.append(1)
+    return values
+
+  def check_connected(self, pvs, missing):
+    """
+    Sets the error message listing the PVs that did not connect, returns
+    True if all are connected
+    """
+    if (len(missing) > 0):
+      self.error_message = 'ERROR: {} of {} PV(s) cannot be reached: {}'.\
+          format(len(missing), len(pvs), ' '.join([pv.pvname for pv in missing]))
+      print('ERROR: The following PV(s) cannot be reached, threshold change not allowed:')
+      for pv in missing:
+        print(' * {}'.format(pv.pvname))
+      return False
     return True
 
   def do_restore(self, restore_list):
+    """
+    Writes all the threshold values at once, and once they are all written
+    sets all the threshold enable PVs. The outcome of every put is kept in
+    put_results. Read-only PVs are ignored if force_write is set, any other
+    failure aborts the restore (thresholds are not enabled if their values
+    could not be written).
+    """
     if (self.verbose):
       print('Starting restore process')
 
-    for restore_item in restore_list:
-      try:
-        restore_item['pv'].put(restore_item['value'])
-      except epics.ca.CASeverityException:
-        self.error_message='ERROR: Tried to write to a read-only PV ({}={})'.\
-            format(restore_item['pv'].pvname, restore_item['value'])
-        print self.error_message
-        if (self.force_write):
-          return True
-        else:
-          return False
-
-      try:
-        restore_item['pv_enable'].put(1)
-      except epics.ca.CASeverityException:
-        self.error_message='ERROR: Tried to write to a read-only PV ({}=1)'.\
-            format(restore_item['pv_enable'].pvname)
-        print self.error_message
-        if (self.force_write):
-          return True
-        else:
-          return False
+    self.put_results = []
+    value_puts, enable_puts = self.get_puts(restore_list)
+    if (not self.put_batch(value_puts)):
+      return False
+
+    if (not self.put_batch(enable_puts)):
+      return False
 
     if (self.verbose):
-      print('Finished restore process')
+      print('Finished restore process ({} PVs written, {} already set)'.\
+              format(len(self.put_results), self.skipped))
 
     return True
 
+  def get_puts(self, restore_list, values=None):
+    """
+    Returns the threshold value puts and the enable puts [(pv, value), ...]
+    for the restore list. In differential mode only the thresholds that
+    differ from the database are written, with their enable PVs, plus the
+    enable PVs that are not set. values are then the current IOC values of
+    the get_restore_pvs() (None for the PVs not read), if not given they are
+    read here (all at once, waiting at most diff_timeout).
+    """
+    value_puts = [(restore_item['pv'], restore_item['value']) for restore_item in restore_list]
+    enable_puts = [(restore_item['pv_enable'], 1) for restore_item in restore_list]
+    self.skipped = 0
+    if (not self.differential):
+      return value_puts, enable_puts
+
+    if (values == None):
+      values = get_many(self.get_restore_pvs(restore_list), self.diff_timeout)
+    current = numpy.array([self.to_float(value) for value in values], dtype=float)
+    same = numpy.isclose(current, numpy.array(self.get_restore_values(restore_list), dtype=float),
+                         rtol=self.verify_rtol, atol=self.verify_atol)
+    same_value = same[0::2]
+    same_enable = same[1::2] & same_value
+
+    self.skipped = int(numpy.count_nonzero(same_value) + numpy.count_nonzero(same_enable))
+    if (self.verbose):
+      print('Differential restore: {} of {} PVs already set'.format(self.skipped, len(values)))
+    return ([put for put, skip in zip(value_puts, same_value) if not skip],
+            [put for put, skip in zip(enable_puts, same_enable) if not skip])
+
+  def put_batch(self, puts):
+    return self.check_put_results(puts, put_many(puts, self.put_timeout))
+
+  def check_put_results(self, puts, results):
+    """
+    Adds the outcome of the puts to put_results, returns False (and sets
+    the error message) if any of them failed
+    """
+    failed = []
+    for (pv, value), error in zip(puts, results):
+      self.put_results.append((pv.pvname, value, error))
+      if (error == None):
+        continue
+      if (error == 'read-only' and self.force_write):
+        print('WARNING: Tried to write to a read-only PV ({}={})'.format(pv.pvname, value))
+        continue
+      failed.append('{}={} ({})'.format(pv.pvname, value, error))
+
+    if (len(failed) > 0):
+      self.error_message = 'ERROR: Failed to write {} of {} PV(s): {}'.\
+          format(len(failed), len(puts), ', '.join(failed))
+      print(self.error_message)
+      return False
+
+    return True
+
+  def get_pv(self, pv_name):
+    if (self.pv_cache != None):
+      return self.pv_cache.get(pv_name)
+    return PV(pv_name)
+
+  def release_pv(self, pv):
+    if (self.pv_cache != None):
+      self.pv_cache.release(pv)
+    else:
+      pv.disconnect()
+
   def disconnect(self, restore_list):
     for restore_item in restore_list:
-      restore_item['pv'].disconnect()
-      restore_item['pv_enable'].disconnect()
+      self.release_pv(restore_item['pv'])
+      self.release_pv(restore_item['pv_enable'])
+
+  def close(self):
+    """
+    Releases the PVs of the restore list and the THR_LOADED and MPS_EN PVs,
+    if still held
+    """
+    if (self.restore_list != None):
+      self.disconnect(self.restore_list)
+      self.restore_list = None
+    if (self.release_pvs != None):
+      for pv in self.release_pvs:
+        self.release_pv(pv)
+      self.release_pvs = None
 
   def release(self):
-    if (self.app == None):
+    if (self.app_pv_name == None):
       return False
 
-    release_pv = PV('{}:THR_LOADED'.format(self.app.get_pv_name()))
+    self.timing.start('pv_put')
+    try:
+      return self.release_app()
+    finally:
+      self.timing.stop('pv_put')
+
+  def connect_release_pvs(self):
+    """
+    Creates the THR_LOADED and MPS_EN PVs of the application, called by
+    restore() so they connect while the thresholds are being restored
+    (they are released by close())
+    """
+    if (self.release_pvs == None):
+      self.release_pvs = [self.get_pv('{}:THR_LOADED'.format(self.app_pv_name)),
+                          self.get_pv('{}:MPS_EN'.format(self.app_pv_name))]
+    return self.release_pvs
+
+  def release_app(self):
+    [release_pv, enable_pv] = self.connect_release_pvs()
 
     if (self.verbose):
       sys.stdout.write('Releasing IOC (setting {})...'.format(release_pv.pvname))
 
     # do release
-    if (release_pv.host == None):
+    if (len(wait_connected([release_pv], self.connect_timeout)) > 0):
       print('ERROR: Failed to read release PV {}'.format(release_pv.pvname))
       return False
 
@@ -231,16 +382,12 @@ class ThresholdRestorer:
       print('ERROR: Tried to write to a read-only PV ({}=1)'.\
               format(release_pv.pvname))
       return False
-      
-    release_pv.disconnect()
-
-    enable_pv = PV('{}:MPS_EN'.format(self.app.get_pv_name()))
 
     if (self.verbose):
       sys.stdout.write('Releasing IOC (setting {})...'.format(enable_pv.pvname))
 
     # do release
-    if (enable_pv.host == None):
+    if (len(wait_connected([enable_pv], self.connect_timeout)) > 0):
       print('ERROR: Failed to read release PV {}'.format(enable_pv.pvname))
       return False
 
@@ -251,44 +398,190 @@ class ThresholdRestorer:
               format(enable_pv.pvname))
       return False
       
-    enable_pv.disconnect()
+    self.release_pvs = None
+    self.release_pv(release_pv)
+    self.release_pv(enable_pv)
 
     if (self.verbose):
       print(' done.')
 
-  def restore(self, app_id, release=False):
-    tries = 0
+  def prepare(self, app_id, plan_cache=None):
+    """
+    Reads the application, its devices and thresholds from the database.
+    Returns the restore list, or None if there is nothing to restore.
+    If a RestorePlanCache is given the restore list is built from the
+    cached plan of the application, without reading the database, and the
+    plan is compiled and added to the cache if not there yet.
+    """
+    self.timing.start('db')
+    try:
+      plan = None
+      if (plan_cache != None):
+        plan = plan_cache.get(app_id)
+      if (plan != None):
+        restore_list = self.get_plan_restore_list(plan)
+      else:
+        if (plan_cache != None):
+          token = plan_cache.token()
+        restore_list = self.read_restore_list(app_id)
+        if (restore_list == None):
+          return None
+        if (plan_cache != None and self.restore_list_complete):
+          plan_cache.add(self.compile_plan(app_id, restore_list), token)
+
+      if (len(restore_list) == 0):
+        return None
+
+      self.put_results = []
+      self.restore_list = restore_list
+      return restore_list
+    finally:
+      self.timing.stop('db')
+
+  def read_restore_list(self, app_id):
     app = self.check_app(app_id)
     if (app == None):
-      return False
+      return None
+    self.connect_release_pvs()
 
     devices = self.check_devices(app)
     if (devices == None):
       self.error_message = 'ERROR: found no devices for application {}'.format(app_id)
       print(self.error_message)
-      return False
-      
-    restore_list = self.get_restore_list(devices)
-    if (len(restore_list) == 0):
+      return None
+
+    return self.get_restore_list(devices)
+
+  def compile_plan(self, app_id, restore_list):
+    """
+    Returns the RestorePlan of the application read by read_restore_list()
+    """
+    items = [(restore_item['pv'].pvname, restore_item['pv_enable'].pvname,
+              restore_item['value'], restore_item['device_id'])
+             for restore_item in restore_list]
+    return RestorePlan(app_id, self.app.name, self.app.description,
+                       self.app.crate.get_name(), self.app.slot_number,
+                       self.app_pv_name,
+                       [c.analog_device.id for c in self.app.analog_channels], items)
+
+  def get_plan_restore_list(self, plan):
+    """
+    Returns the restore list of a RestorePlan, only the PVs are created
+    (or taken from the PV cache)
+    """
+    print('Name: {}'.format(plan.name))
+    print('Description: {}'.format(plan.description))
+    print('Crate: {}, Slot: {}'.format(plan.crate, plan.slot))
+
+    self.close()
+    self.app = None
+    self.app_pv_name = plan.pv_name
+    self.connect_release_pvs()
+
+    restore_list = []
+    for pv_name, pv_enable_name, value, device_id in plan.items:
+      restore_list.append({'device_id': device_id, 'pv': self.get_pv(pv_name),
+                           'pv_enable': self.get_pv(pv_enable_name), 'value': value})
+      if (self.verbose):
+        print('{}={}'.format(pv_name, value))
+    return restore_list
+
+  def restore(self, app_id, release=False):
+    """
+    Restores the application thresholds, making as many attempts as the
+    policy allows. The PVs are kept for check() until close() is called.
+    """
+    restore_list = self.prepare(app_id)
+    if (restore_list == None):
+      self.close()
       return False
     
-    if (not self.check_pvs(restore_list, max_fail_pvs=2)):
-      tries += 1
-    
-    if (tries == 1):
-          if (not self.check_pvs(restore_list, max_fail_pvs=2)):
+    restored = False
+    start = time.time()
+    self.attempts = 0
+    self.connect_time = None
+    try:
+      while (not restored):
+        self.attempts += 1
+        self.timing.start('pv_connect')
+        connected = self.check_pvs(restore_list)
+        self.timing.stop('pv_connect')
+        if (connected):
+          if (self.connect_time == None):
+            self.connect_time = time.time() - start
+          self.timing.start('pv_put')
+          restored = self.do_restore(restore_list)
+          self.timing.stop('pv_put')
+
+        if (not restored):
+          if (not self.policy.retry(self.attempts, time.time() - start)):
             return False
+          print('Attempt {} failed, retrying in {:.1f}s'.\
+                  format(self.attempts, self.policy.get_backoff(self.attempts)))
+          time.sleep(self.policy.get_backoff(self.attempts))
+
+      if (release):
+        self.release()
+    finally:
+      if (not restored):
+        self.close()
+      
+    return True
 
-    if (not self.do_restore(restore_list)):
-      return False
+  def check(self, app_id):
+    """
+    Verifies the restored thresholds by reading them back (see verify()),
+    if the application was not restored by this ThresholdRestorer the
+    RuntimeChecker compares the database and PV values one at a time
+    """
+    self.timing.start('verify')
+    try:
+      if (self.restore_list == None):
+        return self.rt.check_app_thresholds(app_id)
+      return self.verify(self.restore_list)
+    finally:
+      self.timing.stop('verify')
 
-    if (release):
-      self.release(app)
+  def verify(self, restore_list):
+    """
+    Reads back all the threshold and enable PVs of the restore list at once
+    and compares them with the restored values (enable PVs must be 1) in a
+    single vectorized pass, within verify_rtol/verify_atol. The PVs that
+    don't match (or could not be read) are kept in mismatches as
+    {'pv': name, 'expected': value, 'read': value or None}. PVs that were
+    found read-only when restoring with force_write are not checked.
+    Returns True if all match.
+    """
+    pvs = self.get_restore_pvs(restore_list)
+    expected = self.get_restore_values(restore_list)
+
+    values = get_many(pvs, self.put_timeout)
+    read = numpy.array([self.to_float(value) for value in values], dtype=float)
+    matched = numpy.isclose(read, numpy.array(expected, dtype=float),
+                            rtol=self.verify_rtol, atol=self.verify_atol)
+
+    read_only = set([pv_name for pv_name, value, error in self.put_results
+                     if error == 'read-only'])
+    self.mismatches = [{'pv': pvs[index].pvname, 'expected': expected[index],
+                        'read': values[index]}
+                       for index in numpy.flatnonzero(~matched)
+                       if pvs[index].pvname not in read_only]
+
+    if (len(self.mismatches) > 0):
+      self.error_message = 'ERROR: {} of {} PV(s) do not match the restored values: {}'.\
+          format(len(self.mismatches), len(pvs),
+                 ', '.join(['{}={} (expected {})'.format(m['pv'], m['read'], m['expected'])
+                            for m in self.mismatches]))
+      print(self.error_message)
+      return False
 
-    self.disconnect(restore_list)
-      
+    if (self.verbose):
+      print('Verified {} PVs'.format(len(pvs)))
     return True
 
-  def check(self, app_id):
-    return self.rt.check_app_thresholds(app_id)
+  def to_float(self, value):
+    try:
+      return float(value)
+    except (TypeError, ValueError):
+      return numpy.nan
     
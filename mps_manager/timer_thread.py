@@ -0,0 +1,123 @@
+import threading
+import traceback
+import time
+
+class Timer:
+  """
+  Periodic function run by the TimerThread, with the statistics of how
+  late each run started with respect to its schedule (jitter)
+  """
+  def __init__(self, name, interval, function):
+    self.name = name
+    self.interval = interval
+    self.function = function
+    self.next_time = 0.0
+    self.runs = 0
+    self.skipped = 0
+    self.jitter = 0.0
+    self.total_jitter = 0.0
+    self.max_jitter = 0.0
+
+class TimerThread:
+  """
+  Runs periodic functions (heartbeat, statistics, housekeeping) from a
+  dedicated thread, at a fixed rate that does not depend on the request
+  load. Each timer is scheduled relative to its previous deadline, not to
+  when it actually ran, so delays don't accumulate. If a timer falls more
+  than a whole interval behind, the missed runs are skipped (and counted)
+  instead of being run back to back.
+
+  thread_init: optional function called once by the thread when it starts
+               (e.g. to attach the thread to the channel access context)
+  """
+  def __init__(self, name, log=None, thread_init=None):
+    self.name = name
+    self.log = log
+    self.thread_init = thread_init
+    self.timers = []
+    self.lock = threading.Lock()
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  def add(self, name, interval, function):
+    timer = Timer(name, interval, function)
+    timer.next_time = time.time() + interval
+    self.lock.acquire()
+    self.timers.append(timer)
+    self.lock.release()
+    return timer
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name=self.name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    if (self.thread_init != None):
+      self.thread_init()
+
+    while not self.stop_event.is_set():
+      self.lock.acquire()
+      timer = min(self.timers, key=lambda t: t.next_time) if len(self.timers) > 0 else None
+      self.lock.release()
+
+      if (timer == None):
+        self.stop_event.wait(1)
+        continue
+
+      delay = timer.next_time - time.time()
+      if (delay > 0):
+        self.stop_event.wait(delay)
+        continue
+
+      self.fire(timer)
+
+  def fire(self, timer):
+    now = time.time()
+    jitter = now - timer.next_time
+    self.lock.acquire()
+    timer.runs += 1
+    timer.jitter = jitter
+    timer.total_jitter += jitter
+    if (jitter > timer.max_jitter):
+      timer.max_jitter = jitter
+    timer.next_time += timer.interval
+    if (timer.next_time <= now):
+      missed = int((now - timer.next_time) / timer.interval) + 1
+      timer.skipped += missed
+      timer.next_time += missed * timer.interval
+    self.lock.release()
+
+    try:
+      timer.function()
+    except Exception as e:
+      if (self.log != None):
+        self.log('ERROR: {} timer failed: {}\n{}'.\
+                   format(timer.name, str(e), traceback.format_exc()))
+
+  def stop(self):
+    self.stop_event.set()
+    if (self.thread != None):
+      self.thread.join()
+
+  def get_stats(self, reset=False):
+    """
+    Returns a dict with the number of runs, skipped runs and the last,
+    average and max jitter (seconds) of each timer. If reset is True the
+    counters start over.
+    """
+    stats = {}
+    self.lock.acquire()
+    for timer in self.timers:
+      stats[timer.name] = {'runs': timer.runs,
+                           'skipped': timer.skipped,
+                           'jitter': timer.jitter,
+                           'avg_jitter': timer.total_jitter / timer.runs if timer.runs > 0 else 0.0,
+                           'max_jitter': timer.max_jitter}
+      if (reset):
+        timer.runs = 0
+        timer.skipped = 0
+        timer.total_jitter = 0.0
+        timer.max_jitter = 0.0
+    self.lock.release()
+    return stats
@@ -0,0 +1,186 @@
+import threading
+import traceback
+import time
+import heapq
+
+class WorkerPool:
+  """
+  Fixed-size pool of worker threads consuming tasks from a queue. The number
+  of threads is set when the pool is created and does not grow with the
+  number of requests, queued tasks simply wait for a free worker.
+
+  Tasks are taken from the queue by priority (lower value first), tasks with
+  the same priority in the order they were submitted. If max_queued is set
+  the queue is bounded: when it is full a new task replaces the queued task
+  with the lowest priority (the most recent one if several), or is itself
+  refused if nothing queued has a lower priority. The tasks that don't make
+  it into the queue are passed to reject(task, args).
+
+  thread_init: optional function called once by each worker thread when it
+               starts (e.g. to attach the thread to the channel access context)
+  max_queued: maximum number of tasks waiting for a worker, 0 for no limit
+  reject: function(task, args) called with the tasks dropped from the queue
+  """
+  def __init__(self, name, num_workers, log=None, thread_init=None,
+               max_queued=0, reject=None):
+    self.name = name
+    self.num_workers = num_workers
+    self.log = log
+    self.thread_init = thread_init
+    self.max_queued = max_queued
+    self.reject = reject
+    self.cond = threading.Condition(threading.Lock())
+    self.queue = [] # heap of (priority, sequence, submit time, task, args)
+    self.sequence = 0
+    self.stopping = False
+    self.stats_lock = threading.Lock()
+
+    self.active = 0
+    self.started = 0
+    self.completed = 0
+    self.rejected = 0
+    self.max_depth = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+    self.workers = []
+    for i in range(num_workers):
+      worker = threading.Thread(target=self.work, name='{}-{}'.format(name, i))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def submit(self, task, *args):
+    """
+    Queue task(*args) for execution by one of the workers
+    """
+    return self.submit_priority(0, task, *args)
+
+  def submit_priority(self, priority, task, *args):
+    """
+    Queue task(*args) with the given priority (lower values run first).
+    Returns False if the queue is full and the task was refused.
+    """
+    item = (priority, self.sequence, time.time(), task, args)
+    dropped = None
+
+    self.cond.acquire()
+    self.sequence += 1
+    if (self.max_queued > 0 and len(self.queue) >= self.max_queued):
+      # Lowest priority, most recently submitted task
+      lowest = max(self.queue)
+      if (lowest[0] > priority):
+        self.queue.remove(lowest)
+        heapq.heapify(self.queue)
+        dropped = lowest
+      else:
+        dropped = item
+
+    if (dropped is not item):
+      heapq.heappush(self.queue, item)
+      self.cond.notify()
+    depth = len(self.queue)
+    self.cond.release()
+
+    self.stats_lock.acquire()
+    if (depth > self.max_depth):
+      self.max_depth = depth
+    if (dropped != None):
+      self.rejected += 1
+    self.stats_lock.release()
+
+    if (dropped != None):
+      if (self.log != None):
+        self.log('{} queue full ({} tasks), dropped task with priority {}'.\
+                   format(self.name, depth, dropped[0]))
+      if (self.reject != None):
+        try:
+          self.reject(dropped[3], dropped[4])
+        except Exception as e:
+          if (self.log != None):
+            self.log('ERROR: {} reject failed: {}\n{}'.\
+                       format(self.name, str(e), traceback.format_exc()))
+
+    return dropped is not item
+
+  def get(self):
+    """
+    Waits for the next task, returns None once the pool is stopped and
+    the queue is empty
+    """
+    self.cond.acquire()
+    while (len(self.queue) == 0 and not self.stopping):
+      self.cond.wait()
+    item = None
+    if (len(self.queue) > 0):
+      item = heapq.heappop(self.queue)
+    self.cond.release()
+    return item
+
+  def work(self):
+    if (self.thread_init != None):
+      self.thread_init()
+
+    while True:
+      item = self.get()
+      if (item == None):
+        break
+
+      priority, sequence, submit_time, task, args = item
+      wait = time.time() - submit_time
+      self.stats_lock.acquire()
+      self.active += 1
+      self.started += 1
+      self.total_wait += wait
+      if (wait > self.max_wait):
+        self.max_wait = wait
+      self.stats_lock.release()
+
+      try:
+        task(*args)
+      except Exception as e:
+        if (self.log != None):
+          self.log('ERROR: {} worker failed: {}\n{}'.\
+                     format(self.name, str(e), traceback.format_exc()))
+
+      self.stats_lock.acquire()
+      self.active -= 1
+      self.completed += 1
+      self.stats_lock.release()
+
+  def stop(self):
+    """
+    Lets the workers finish the queued tasks and waits for them to exit
+    """
+    self.cond.acquire()
+    self.stopping = True
+    self.cond.notify_all()
+    self.cond.release()
+    for worker in self.workers:
+      worker.join()
+
+  def get_stats(self, reset=False):
+    """
+    Returns a dict with the current queue depth, active workers, completed
+    and rejected tasks and queue wait times. If reset is True the max
+    depth/wait values start over, so each log_stats() period reports its
+    own peaks.
+    """
+    self.cond.acquire()
+    depth = len(self.queue)
+    self.cond.release()
+
+    self.stats_lock.acquire()
+    stats = {'workers': self.num_workers,
+             'active': self.active,
+             'depth': depth,
+             'max_depth': self.max_depth,
+             'completed': self.completed,
+             'rejected': self.rejected,
+             'avg_wait': self.total_wait / self.started if self.started > 0 else 0.0,
+             'max_wait': self.max_wait}
+    if (reset):
+      self.max_depth = 0
+      self.max_wait = 0.0
+    self.stats_lock.release()
+    return stats
@@ -56,7 +56,7 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires=['sqlalchemy', 'pyepics', 'alembic', 'PyYAML'],
+    install_requires=['sqlalchemy', 'pyepics', 'alembic', 'PyYAML', 'numpy', 'tabulate'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
@@ -0,0 +1,95 @@
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mps_manager'))
+
+from request_server import RequestServer
+
+# Test frames: 'P' (pipelined) or 'R' (regular) followed by 4 bytes, echoed
+# back. Pipelined 'stop' can't be followed by other requests, 'last' is the
+# last request of the connection.
+FRAME_SIZE = 5
+
+def frame_size(data):
+  return FRAME_SIZE, data[:1] == 'P'
+
+class RequestServerTest(unittest.TestCase):
+  def setUp(self):
+    tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_server.bind(('127.0.0.1', 0))
+    tcp_server.listen(5)
+    self.address = tcp_server.getsockname()
+    self.server = RequestServer(tcp_server, frame_size, self.dispatch,
+                                self.dispatch_pipelined, lambda message: None,
+                                expire_interval=0.1, max_requests=5)
+    self.thread = threading.Thread(target=self.server.run)
+    self.thread.daemon = True
+    self.thread.start()
+    self.dispatched = []
+    self.sock = socket.create_connection(self.address)
+    self.sock.settimeout(5)
+
+  def tearDown(self):
+    self.sock.close()
+    self.server.stop()
+    self.thread.join(5)
+
+  def dispatch(self, data, sock, ip, port):
+    def run():
+      sock.sendall(data)
+      self.server.resume(sock)
+    threading.Thread(target=run).start()
+
+  def dispatch_pipelined(self, data, conn, ip, port):
+    self.dispatched.append(data)
+    self.server.reply(conn, data, data[1:] != 'last')
+    return data[1:] != 'stop'
+
+  def receive(self, size):
+    data = ''
+    while (len(data) < size):
+      chunk = self.sock.recv(size - len(data))
+      if (not chunk):
+        break
+      data += chunk
+    return data
+
+  def test_regular_requests_limit(self):
+    for i in range(5):
+      self.sock.sendall('R{:04d}'.format(i))
+      self.assertEqual(self.receive(FRAME_SIZE), 'R{:04d}'.format(i))
+    # Closed after max_requests
+    self.assertEqual(self.sock.recv(FRAME_SIZE), '')
+
+  def test_pipelined_not_limited(self):
+    frames = ['P{:04d}'.format(i) for i in range(20)]
+    self.sock.sendall(''.join(frames))
+    replies = self.receive(FRAME_SIZE * len(frames))
+    self.assertEqual(len(replies), FRAME_SIZE * len(frames))
+    self.assertEqual(sorted([replies[i:i + FRAME_SIZE] for i in range(0, len(replies), FRAME_SIZE)]),
+                     frames)
+    # The connection is still usable
+    self.sock.sendall('R0000')
+    self.assertEqual(self.receive(FRAME_SIZE), 'R0000')
+
+  def test_pipelined_stop(self):
+    self.sock.sendall('P0000Pstop' + 'P0001' * 10000)
+    # The replies are followed by the end of the stream
+    self.assertEqual(self.receive(FRAME_SIZE * 3), 'P0000Pstop')
+    # Nothing after the invalid request is dispatched
+    self.assertEqual(self.dispatched, ['P0000', 'Pstop'])
+
+  def test_pipelined_close(self):
+    self.sock.sendall('Plast')
+    self.assertEqual(self.receive(FRAME_SIZE * 2), 'Plast')
+    # Requests after the last one are ignored
+    self.sock.sendall('P0001')
+    self.assertEqual(self.sock.recv(FRAME_SIZE), '')
+    self.assertEqual(self.dispatched, ['Plast'])
+
+if __name__ == '__main__':
+  unittest.main()
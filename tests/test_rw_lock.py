@@ -0,0 +1,138 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mps_manager'))
+
+from rw_lock import ReadWriteLock, LockManager
+
+def start(target, *args):
+  thread = threading.Thread(target=target, args=args)
+  thread.daemon = True
+  thread.start()
+  return thread
+
+class ReadWriteLockTest(unittest.TestCase):
+  def test_readers_share(self):
+    lock = ReadWriteLock()
+    self.assertNotEqual(lock.acquire_read(0.1), None)
+    self.assertNotEqual(lock.acquire_read(0.1), None)
+    self.assertEqual(lock.readers, 2)
+    lock.release_read()
+    lock.release_read()
+
+  def test_writer_excludes(self):
+    lock = ReadWriteLock()
+    self.assertNotEqual(lock.acquire_write(0.1), None)
+    self.assertEqual(lock.acquire_read(0.1), None)
+    self.assertEqual(lock.acquire_write(0.1), None)
+    lock.release_write()
+    self.assertNotEqual(lock.acquire_read(0.1), None)
+    self.assertEqual(lock.acquire_write(0.1), None)
+    lock.release_read()
+
+  def test_writer_preference(self):
+    lock = ReadWriteLock()
+    lock.acquire_read()
+    result = []
+    writer = start(lambda: result.append(lock.acquire_write(5)))
+    while (lock.waiting_writers == 0):
+      time.sleep(0.01)
+
+    # A writer is waiting, new readers are held back
+    self.assertEqual(lock.acquire_read(0.1), None)
+    lock.release_read()
+    writer.join(5)
+    self.assertEqual(len(result), 1)
+    self.assertNotEqual(result[0], None)
+    self.assertTrue(lock.writer)
+    lock.release_write()
+
+  def test_writer_timeout_releases_readers(self):
+    lock = ReadWriteLock()
+    lock.acquire_read()
+    result = []
+    reader = None
+    writer = start(lambda: result.append(lock.acquire_write(0.3)))
+    while (lock.waiting_writers == 0):
+      time.sleep(0.01)
+
+    # The reader waiting behind the writer proceeds once the writer gives up
+    reader = start(lambda: result.append(lock.acquire_read(5)))
+    writer.join(5)
+    reader.join(5)
+    self.assertEqual(result[0], None)
+    self.assertNotEqual(result[1], None)
+    self.assertEqual(lock.waiting_writers, 0)
+    self.assertEqual(lock.readers, 2)
+
+  def test_wait_time(self):
+    lock = ReadWriteLock()
+    lock.acquire_write()
+    threading.Timer(0.2, lock.release_write).start()
+    wait = lock.acquire_read(5)
+    self.assertTrue(wait >= 0.15)
+    lock.release_read()
+
+class LockManagerTest(unittest.TestCase):
+  def test_shared_and_exclusive(self):
+    manager = LockManager()
+    reader = manager.acquire(shared=[('device', 1)], timeout=0.1)
+    self.assertNotEqual(reader, None)
+    self.assertNotEqual(manager.acquire(shared=[('device', 1)], timeout=0.1), None)
+    self.assertEqual(manager.acquire(exclusive=[('device', 1)], timeout=0.1), None)
+    # Other keys are not affected
+    other = manager.acquire(exclusive=[('device', 2)], timeout=0.1)
+    self.assertNotEqual(other, None)
+    manager.release(other)
+
+  def test_failed_acquire_holds_nothing(self):
+    manager = LockManager()
+    held = manager.acquire(exclusive=[('device', 2)])
+    # ('app', 1) is taken first (sorted order), then released when
+    # ('device', 2) times out
+    self.assertEqual(manager.acquire(shared=[('device', 2)], exclusive=[('app', 1)],
+                                     timeout=0.1), None)
+    app = manager.acquire(exclusive=[('app', 1)], timeout=0.1)
+    self.assertNotEqual(app, None)
+    manager.release(app)
+    manager.release(held)
+    self.assertEqual(manager.get_stats()['keys'], 0)
+
+  def test_sorted_order_no_deadlock(self):
+    manager = LockManager()
+    keys = [('device', d) for d in range(5)]
+    failures = []
+
+    def run(order):
+      for i in range(200):
+        lock_set = manager.acquire(exclusive=order, timeout=5)
+        if (lock_set == None):
+          failures.append(order)
+          return
+        manager.release(lock_set)
+
+    threads = [start(run, keys), start(run, list(reversed(keys))),
+               start(run, keys[2:] + keys[:2])]
+    for thread in threads:
+      thread.join(30)
+    self.assertEqual(failures, [])
+    self.assertEqual(manager.get_stats()['keys'], 0)
+
+  def test_stats(self):
+    manager = LockManager()
+    lock_set = manager.acquire(exclusive=[('device', 1)])
+    self.assertEqual(manager.acquire(shared=[('device', 1)], timeout=0.05), None)
+    stats = manager.get_stats(reset=True)
+    self.assertEqual(stats['write']['count'], 1)
+    self.assertEqual(stats['read']['timeouts'], 1)
+    self.assertEqual(stats['keys'], 1)
+    manager.release(lock_set)
+    stats = manager.get_stats()
+    self.assertEqual(stats['write']['count'], 0)
+    self.assertEqual(stats['keys'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
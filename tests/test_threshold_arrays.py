@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mps_manager'))
+
+from threshold_arrays import ThresholdArrays
+from threshold_fields import get_field
+
+def make_db(lolo=-1.0, hihi=1.0):
+  """
+  Database thresholds, all the LOLO set to lolo and the HIHI to hihi
+  """
+  db = ThresholdArrays()
+  for table in db.value:
+    count = len(db.value[table]) / 2
+    db.value[table][:count] = lolo
+    db.value[table][count:] = hihi
+    db.mask[table][:] = True
+  return db
+
+class GetInvalidTest(unittest.TestCase):
+  def setUp(self):
+    self.lolo = get_field('lc2', 't3', 'i1', 'l')
+    self.hihi = get_field('lc2', 't3', 'i1', 'h')
+
+  def test_valid(self):
+    request = ThresholdArrays()
+    request.set(self.lolo, -5)
+    request.set(self.hihi, 5)
+    request.set(get_field('lc1', 't0', 'i0', 'h'), 2)
+    self.assertEqual(request.get_invalid(make_db()), [])
+
+  def test_both_set(self):
+    request = ThresholdArrays()
+    request.set(self.lolo, 5)
+    request.set(self.hihi, 4)
+    self.assertEqual(request.get_invalid(make_db()), [(self.lolo, self.hihi)])
+
+  def test_equal(self):
+    request = ThresholdArrays()
+    request.set(self.lolo, 3)
+    request.set(self.hihi, 3)
+    self.assertEqual(request.get_invalid(make_db()), [(self.lolo, self.hihi)])
+
+  def test_hihi_below_database_lolo(self):
+    request = ThresholdArrays()
+    request.set(self.hihi, -2)
+    self.assertEqual(request.get_invalid(make_db()), [(self.lolo, self.hihi)])
+
+  def test_lolo_above_database_hihi(self):
+    lolo = get_field('alt', 't7', 'i3', 'l')
+    hihi = get_field('alt', 't7', 'i3', 'h')
+    request = ThresholdArrays()
+    request.set(lolo, 2)
+    self.assertEqual(request.get_invalid(make_db()), [(lolo, hihi)])
+
+  def test_unset_pairs_not_checked(self):
+    # Database pairs already invalid are only reported when changed
+    request = ThresholdArrays()
+    request.set(self.hihi, 10)
+    self.assertEqual(request.get_invalid(make_db(lolo=5, hihi=1)), [])
+
+  def test_tables_independent(self):
+    request = ThresholdArrays()
+    request.set(get_field('idl', 't0', 'i2', 'l'), 8)
+    request.set(get_field('lc2', 't0', 'i2', 'h'), 9)
+    self.assertEqual(request.get_invalid(make_db(lolo=0, hihi=5)),
+                     [(get_field('idl', 't0', 'i2', 'l'), get_field('idl', 't0', 'i2', 'h'))])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,28 @@
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mps_manager'))
+
+from threshold_fields import FIELDS, HISTORY_COLUMNS, get_field
+
+class ThresholdFieldsTest(unittest.TestCase):
+  def test_history_columns(self):
+    # Same columns as copied by matching the threshold row attributes with
+    # 'i[0-3]_[lh]': the values and their active flags
+    columns = set([field.column for field in FIELDS] + [field.active_column for field in FIELDS])
+    self.assertEqual(sorted(HISTORY_COLUMNS),
+                     sorted([column for column in columns if re.match('i[0-3]_[lh]', column)]))
+    self.assertEqual(len(HISTORY_COLUMNS), 16)
+
+  def test_layout(self):
+    self.assertEqual(len(FIELDS), 2 * 4 * (1 + 1 + 8 + 8))
+    field = get_field('alt', 't3', 'i1', 'h')
+    self.assertEqual((field.relation, field.column, field.active_column, field.row, field.col),
+                     ('threshold_alt3', 'i1_h', 'i1_h_active', 11, 1))
+    field = get_field('lc1', 't0', 'i3', 'l')
+    self.assertEqual((field.relation, field.row, field.col), ('threshold_lc1', 0, 3))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mps_manager'))
+
+from worker_pool import WorkerPool
+
+class WorkerPoolTest(unittest.TestCase):
+  def setUp(self):
+    self.done = []
+    self.rejected = []
+    self.blocked = threading.Event()
+    self.running = threading.Event()
+
+  def block(self):
+    self.running.set()
+    self.blocked.wait(5)
+
+  def make_pool(self, max_queued=0):
+    pool = WorkerPool('Test', 1, max_queued=max_queued,
+                      reject=lambda task, args: self.rejected.append(args[0]))
+    # Keep the only worker busy while the queue is filled
+    pool.submit(self.block)
+    self.running.wait(5)
+    return pool
+
+  def test_priority_order(self):
+    pool = self.make_pool()
+    for name, priority in [('a', 2), ('b', 0), ('c', 1), ('d', 0), ('e', 2)]:
+      pool.submit_priority(priority, self.done.append, name)
+    self.blocked.set()
+    pool.stop()
+    # Lower priority first, same priority in submission order
+    self.assertEqual(self.done, ['b', 'd', 'c', 'a', 'e'])
+
+  def test_full_queue_drops_lowest_priority(self):
+    pool = self.make_pool(max_queued=2)
+    self.assertTrue(pool.submit_priority(1, self.done.append, 'a'))
+    self.assertTrue(pool.submit_priority(2, self.done.append, 'b'))
+    # Replaces the queued task with the lowest priority
+    self.assertTrue(pool.submit_priority(0, self.done.append, 'c'))
+    self.assertEqual(self.rejected, ['b'])
+    # Nothing queued has a lower priority, the new task is refused
+    self.assertFalse(pool.submit_priority(1, self.done.append, 'd'))
+    self.assertEqual(self.rejected, ['b', 'd'])
+    self.blocked.set()
+    pool.stop()
+    self.assertEqual(self.done, ['c', 'a'])
+    self.assertEqual(pool.get_stats()['rejected'], 2)
+
+  def test_drops_most_recent_of_lowest_priority(self):
+    pool = self.make_pool(max_queued=2)
+    pool.submit_priority(3, self.done.append, 'a')
+    pool.submit_priority(3, self.done.append, 'b')
+    pool.submit_priority(1, self.done.append, 'c')
+    self.assertEqual(self.rejected, ['b'])
+    self.blocked.set()
+    pool.stop()
+    self.assertEqual(self.done, ['c', 'a'])
+
+  def test_failed_task_does_not_stop_worker(self):
+    pool = WorkerPool('Test', 1)
+    pool.submit(lambda: 1 / 0)
+    pool.submit(self.done.append, 'a')
+    pool.stop()
+    self.assertEqual(self.done, ['a'])
+    self.assertEqual(pool.get_stats()['completed'], 2)
+
+if __name__ == '__main__':
+  unittest.main()